@@ -8,6 +8,7 @@ from django.conf import settings
 
 from django.test import TestCase
 
+from webhook_receiver.lmsclient import reset_lms_client
 from webhook_receiver.models import JSONWebhookData
 
 from unittest.mock import Mock
@@ -42,6 +43,7 @@ class WebhookTestCase(TestCase):
         course.id = self.COURSE_ID_STRING
 
     def setup_requests(self):
+        reset_lms_client()
         self.token_uri = '%s/oauth2/access_token' % settings.WEBHOOK_RECEIVER_LMS_BASE_URL  # noqa: E501
         self.enroll_uri = '%s/api/bulk_enroll/v1/bulk_enroll' % settings.WEBHOOK_RECEIVER_LMS_BASE_URL  # noqa: E501
 
@@ -0,0 +1,229 @@
+from __future__ import unicode_literals
+
+import base64
+import hashlib
+import hmac
+import threading
+
+from unittest.mock import MagicMock, patch
+
+import requests_mock
+
+from django.conf import settings
+from django.test import TestCase, Client, AsyncRequestFactory
+from django.test import override_settings
+
+from webhook_receiver import admission
+from webhook_receiver.admission import (
+    LatencyWindow,
+    check_admission,
+    read_queue_depth,
+    record_latency,
+    reset_admission,
+)
+from webhook_receiver.models import JSONWebhookData
+from webhook_receiver_shopify.models import ShopifyOrder
+from webhook_receiver_shopify.views import aorder_create
+
+from . import ShopifyTestCase
+
+
+class LatencyWindowTest(TestCase):
+
+    def test_mean(self):
+        window = LatencyWindow()
+        self.assertIsNone(window.mean(10))
+        with patch('webhook_receiver.admission.time.monotonic',
+                   return_value=100.0):
+            window.add(1.0, 10)
+            window.add(3.0, 10)
+            self.assertEqual(window.mean(10), 2.0)
+        with patch('webhook_receiver.admission.time.monotonic',
+                   return_value=105.0):
+            window.add(5.0, 10)
+            self.assertEqual(window.mean(10), 3.0)
+        # The first two samples have left the window.
+        with patch('webhook_receiver.admission.time.monotonic',
+                   return_value=111.0):
+            self.assertEqual(window.mean(10), 5.0)
+        with patch('webhook_receiver.admission.time.monotonic',
+                   return_value=116.0):
+            self.assertIsNone(window.mean(10))
+
+
+@override_settings(WEBHOOK_RECEIVER_MAX_INGEST_LATENCY=0.5,
+                   WEBHOOK_RECEIVER_INGEST_LATENCY_WINDOW=10,
+                   WEBHOOK_RECEIVER_MAX_QUEUE_DEPTH=100,
+                   WEBHOOK_RECEIVER_RETRY_AFTER=30)
+class AdmissionControlTest(ShopifyTestCase):
+
+    def setUp(self):
+        super().setUp()
+        reset_admission()
+        self.addCleanup(reset_admission)
+        self.client = Client()
+
+        conf = settings.WEBHOOK_RECEIVER_SETTINGS['shopify']
+        correct_hash = hmac.new(conf['api_key'].encode('utf-8'),
+                                self.raw_payload,
+                                hashlib.sha256).digest()
+        self.correct_signature = base64.b64encode(correct_hash).decode()
+
+    def post(self):
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json={})
+            return self.client.post(
+                '/webhooks/shopify/order/create',
+                self.raw_payload,
+                content_type='application/json',
+                HTTP_X_SHOPIFY_HMAC_SHA256=self.correct_signature,
+                HTTP_X_SHOPIFY_SHOP_DOMAIN='example.com')
+
+    def overload(self):
+        for i in range(3):
+            record_latency(2.0)
+
+    def test_admitted(self):
+        response = self.post()
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('Retry-After'))
+        self.assertEqual(ShopifyOrder.objects.count(), 1)
+
+    def test_latency(self):
+        self.assertIsNone(check_admission())
+        record_latency(0.1)
+        self.assertIsNone(check_admission())
+        self.overload()
+        self.assertIn('latency', check_admission())
+
+    def sampled(self):
+        # Wait for the queue depth sample in the background.
+        admission._queue_depth.thread.join()
+
+    def test_queue_depth(self):
+        with patch('webhook_receiver.admission.read_queue_depth',
+                   return_value=101) as read_queue_depth:
+            check_admission()
+            self.sampled()
+            self.assertIn('101 messages', check_admission())
+            # We don't sample the queue for every webhook.
+            check_admission()
+            self.assertEqual(read_queue_depth.call_count, 1)
+
+    def test_queue_depth_unavailable(self):
+        with patch('webhook_receiver.admission.read_queue_depth',
+                   side_effect=OSError('Connection refused')):
+            with self.assertLogs('webhook_receiver.admission', 'WARNING'):
+                check_admission()
+                self.sampled()
+            self.assertIsNone(check_admission())
+
+    def test_queue_depth_slow(self):
+        # Webhooks don't wait for the broker.
+        done = threading.Event()
+
+        def read_queue_depth():
+            done.wait(5)
+            return 101
+
+        with patch('webhook_receiver.admission.read_queue_depth',
+                   read_queue_depth):
+            self.assertIsNone(check_admission())
+            self.assertIsNone(check_admission())
+            done.set()
+            self.sampled()
+            self.assertIn('101 messages', check_admission())
+
+    def test_read_queue_depth(self):
+        app = MagicMock()
+        app.conf.task_always_eager = False
+        app.conf.task_default_queue = 'celery'
+        connection = app.connection_for_read.return_value.__enter__()
+        connection.default_channel.queue_declare.return_value.message_count = 7  # noqa: E501
+        with patch('webhook_receiver.admission.current_app', app):
+            self.assertEqual(read_queue_depth(), 7)
+        # We don't keep retrying to connect to the broker.
+        kwargs = connection.ensure_connection.call_args.kwargs
+        self.assertEqual(kwargs['max_retries'], 1)
+        self.assertEqual(kwargs['timeout'], admission.QUEUE_DEPTH_TIMEOUT)
+
+    def test_reject(self):
+        self.overload()
+        response = self.post()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '30')
+        # We did not even read the webhook.
+        self.assertFalse(JSONWebhookData.objects.exists())
+
+    def test_recovery(self):
+        self.overload()
+        self.assertEqual(self.post().status_code, 503)
+        # Once the slow samples have left the window, we admit
+        # webhooks again.
+        later = self.settings(WEBHOOK_RECEIVER_INGEST_LATENCY_WINDOW=0)
+        with later, self.assertLogs('webhook_receiver.admission', 'INFO'):
+            self.assertEqual(self.post().status_code, 200)
+        self.assertEqual(ShopifyOrder.objects.count(), 1)
+
+    @override_settings(WEBHOOK_RECEIVER_SHED_MODE='defer')
+    def test_defer(self):
+        self.overload()
+        response = self.post()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '30')
+        # We stored the webhook, but left its order to a redelivery.
+        data = JSONWebhookData.objects.get()
+        self.assertEqual(data.status, JSONWebhookData.PROCESSED)
+        self.assertFalse(ShopifyOrder.objects.exists())
+
+    @override_settings(WEBHOOK_RECEIVER_SHED_MODE='defer',
+                       WEBHOOK_RECEIVER_FAST_ACK=True)
+    def test_defer_fast_ack(self):
+        self.overload()
+        response = self.post()
+        self.assertEqual(response.status_code, 429)
+        # We did not store the webhook, which nothing would ingest.
+        self.assertFalse(JSONWebhookData.objects.exists())
+        self.assertFalse(ShopifyOrder.objects.exists())
+
+    @override_settings(WEBHOOK_RECEIVER_MAX_INGEST_LATENCY=0,
+                       WEBHOOK_RECEIVER_MAX_QUEUE_DEPTH=0)
+    def test_disabled(self):
+        self.overload()
+        self.assertEqual(self.post().status_code, 200)
+
+    async def test_async_reject(self):
+        self.overload()
+        request = AsyncRequestFactory().post(
+            '/webhooks/shopify/order/create',
+            self.raw_payload,
+            content_type='application/json',
+            headers={
+                'X-Shopify-Hmac-Sha256': self.correct_signature,
+                'X-Shopify-Shop-Domain': 'example.com',
+            })
+        response = await aorder_create(request)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '30')
+        self.assertFalse(await JSONWebhookData.objects.aexists())
+
+    @override_settings(WEBHOOK_RECEIVER_SHED_MODE='defer',
+                       WEBHOOK_RECEIVER_FAST_ACK=True)
+    async def test_async_defer_fast_ack(self):
+        self.overload()
+        request = AsyncRequestFactory().post(
+            '/webhooks/shopify/order/create',
+            self.raw_payload,
+            content_type='application/json',
+            headers={
+                'X-Shopify-Hmac-Sha256': self.correct_signature,
+                'X-Shopify-Shop-Domain': 'example.com',
+            })
+        response = await aorder_create(request)
+        self.assertEqual(response.status_code, 429)
+        self.assertFalse(await JSONWebhookData.objects.aexists())
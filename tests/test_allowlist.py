@@ -0,0 +1,155 @@
+from __future__ import unicode_literals
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase, Client, override_settings
+from django.test import AsyncRequestFactory, RequestFactory
+
+from webhook_receiver.allowlist import Allowlist, client_ip, get_allowlist
+from webhook_receiver.models import JSONWebhookData
+from webhook_receiver.rejections import rejection_counts
+from webhook_receiver.rejections import reset_rejection_counts
+from webhook_receiver_shopify.views import aorder_create
+
+from . import ShopifyTestCase
+
+
+ALLOWLIST_SETTINGS = {
+    'shopify': {
+        'shop_domain': 'example.com',
+        'api_key': 'secret',
+        'allowed_networks': ['192.0.2.0/24', '198.51.100.7',
+                             '2001:db8::/32'],
+    },
+    'woocommerce': {
+        'source': 'http://example.com',
+        'secret': 'secret',
+    },
+}
+
+
+class AllowlistTest(SimpleTestCase):
+
+    def setUp(self):
+        self.allowlist = Allowlist(['192.0.2.0/24',
+                                    '192.0.2.128/25',
+                                    '198.51.100.7',
+                                    '10.1.0.0/16',
+                                    '2001:db8::/32'])
+
+    def test_contains(self):
+        for ip in ('192.0.2.1', '192.0.2.255', '198.51.100.7',
+                   '10.1.255.1', '2001:db8::1', '::ffff:192.0.2.1'):
+            self.assertIn(ip, self.allowlist)
+        for ip in ('192.0.3.1', '198.51.100.8', '10.2.0.1',
+                   '2001:db9::1', '::ffff:192.0.3.1', 'foo', ''):
+            self.assertNotIn(ip, self.allowlist)
+
+    def test_compiled(self):
+        # Overlapping networks collapse, and networks with the same
+        # prefix length share a set.
+        self.assertEqual(len(self.allowlist.masks[4]), 3)
+        self.assertEqual(len(self.allowlist.masks[6]), 1)
+
+    def test_invalid(self):
+        with self.assertRaises(ImproperlyConfigured):
+            Allowlist(['192.0.2.0/33'])
+
+    @override_settings(WEBHOOK_RECEIVER_SETTINGS=ALLOWLIST_SETTINGS)
+    def test_get_allowlist(self):
+        self.assertIn('198.51.100.7', get_allowlist('shopify'))
+        self.assertIsNone(get_allowlist('woocommerce'))
+
+
+class ClientIPTest(SimpleTestCase):
+
+    def request(self, ip, forwarded=None):
+        extra = {'REMOTE_ADDR': ip}
+        if forwarded is not None:
+            extra['HTTP_X_FORWARDED_FOR'] = forwarded
+        return RequestFactory().post('/', **extra)
+
+    def test_untrusted(self):
+        # Without trusted proxies, nobody gets to pick their address.
+        self.assertEqual(client_ip(self.request('203.0.113.9',
+                                                '23.227.38.1')),
+                         '203.0.113.9')
+
+    @override_settings(WEBHOOK_RECEIVER_TRUSTED_PROXIES=['10.0.0.0/8'])
+    def test_trusted(self):
+        self.assertEqual(client_ip(self.request('10.0.0.1',
+                                                '192.0.2.1')),
+                         '192.0.2.1')
+        # The client may have sent an X-Forwarded-For header of its
+        # own, but the proxies only append to it.
+        self.assertEqual(client_ip(self.request('10.0.0.1',
+                                                '23.227.38.1, 192.0.2.1, '
+                                                '10.0.0.2')),
+                         '192.0.2.1')
+        self.assertEqual(client_ip(self.request('10.0.0.1')), '10.0.0.1')
+        # Other clients still don't get to pick their address.
+        self.assertEqual(client_ip(self.request('203.0.113.9',
+                                                '23.227.38.1')),
+                         '203.0.113.9')
+
+
+@override_settings(WEBHOOK_RECEIVER_SETTINGS=ALLOWLIST_SETTINGS)
+class AllowlistViewTest(ShopifyTestCase):
+
+    def setUp(self):
+        super().setUp()
+        reset_rejection_counts()
+        self.client = Client()
+
+    def post(self, ip, **extra):
+        # The signature is invalid, which we only find out if we
+        # accept the request at all.
+        return self.client.post('/webhooks/shopify/order/create',
+                                self.raw_payload,
+                                content_type='application/json',
+                                HTTP_X_SHOPIFY_HMAC_SHA256='foo',
+                                HTTP_X_SHOPIFY_SHOP_DOMAIN='example.com',
+                                REMOTE_ADDR=ip,
+                                **extra)
+
+    def test_allowed(self):
+        response = self.post('192.0.2.1')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(JSONWebhookData.objects.count(), 1)
+        self.assertEqual(rejection_counts(), {})
+
+    def test_disallowed(self):
+        with self.assertLogs('webhook_receiver.rejections', 'WARNING'):
+            response = self.post('203.0.113.1')
+        self.assertEqual(response.status_code, 403)
+        # We did not store the webhook.
+        self.assertFalse(JSONWebhookData.objects.exists())
+        self.assertEqual(rejection_counts(),
+                         {('shopify', 'DisallowedNetworkException'): 1})
+
+    def test_forwarded(self):
+        with self.assertLogs('webhook_receiver.rejections', 'WARNING'):
+            response = self.post('203.0.113.1',
+                                 HTTP_X_FORWARDED_FOR='192.0.2.1')
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(JSONWebhookData.objects.exists())
+
+        with self.settings(WEBHOOK_RECEIVER_TRUSTED_PROXIES=['10.0.0.1']):
+            response = self.post('10.0.0.1',
+                                 HTTP_X_FORWARDED_FOR='192.0.2.1')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(JSONWebhookData.objects.count(), 1)
+
+    async def test_disallowed_async(self):
+        request = AsyncRequestFactory().post(
+            '/webhooks/shopify/order/create',
+            self.raw_payload,
+            content_type='application/json',
+            headers={
+                'X-Shopify-Hmac-Sha256': 'foo',
+                'X-Shopify-Shop-Domain': 'example.com',
+            },
+            REMOTE_ADDR='203.0.113.1')
+        with self.assertLogs('webhook_receiver.rejections', 'WARNING'):
+            response = await aorder_create(request)
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(await JSONWebhookData.objects.aexists())
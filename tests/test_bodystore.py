@@ -0,0 +1,88 @@
+from __future__ import unicode_literals
+
+from io import StringIO
+
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+
+from webhook_receiver.fields import COMPRESSED_PREFIX
+from webhook_receiver.groupcommit import insert_webhooks
+from webhook_receiver.models import JSONWebhookData, WebhookBody
+
+from .test_compact import stored_columns
+
+
+@override_settings(WEBHOOK_RECEIVER_BODY_STORE=True)
+class BodyStoreTest(TestCase):
+
+    BODY = b'{"id": 1}'
+
+    def create(self, body=BODY):
+        data = JSONWebhookData(headers={}, body=body)
+        data.save()
+        return data
+
+    def test_redelivery(self):
+        self.assertFalse(WebhookBody.seen(self.BODY))
+        first = self.create()
+        self.assertTrue(WebhookBody.seen(self.BODY))
+        second = self.create()
+        self.create(b'{"id": 2}')
+
+        self.assertEqual(WebhookBody.objects.count(), 2)
+        self.assertEqual(first.stored_body_id, second.stored_body_id)
+        self.assertEqual(first.stored_body_id,
+                         WebhookBody.digest_of(self.BODY))
+
+        # The webhook rows themselves don't store the body.
+        body, content = stored_columns(second)
+        self.assertEqual(body, b'')
+
+        second = JSONWebhookData.objects.get(pk=second.pk)
+        self.assertEqual(bytes(second.body), self.BODY)
+        self.assertEqual(second.content, {'id': 1})
+
+    def test_update(self):
+        data = self.create()
+        data = JSONWebhookData.objects.get(pk=data.pk)
+        data.start_processing()
+        data.save()
+        data = JSONWebhookData.objects.get(pk=data.pk)
+        self.assertEqual(bytes(data.body), self.BODY)
+        self.assertEqual(WebhookBody.objects.count(), 1)
+
+    def test_bulk_insert(self):
+        webhooks = insert_webhooks([
+            JSONWebhookData(headers={}, body=self.BODY),
+            JSONWebhookData(headers={}, body=self.BODY),
+        ])
+        self.assertEqual(WebhookBody.objects.count(), 1)
+        for data in webhooks:
+            data = JSONWebhookData.objects.get(pk=data.pk)
+            self.assertEqual(bytes(data.body), self.BODY)
+
+    def test_empty(self):
+        data = self.create(b'')
+        self.assertIsNone(data.stored_body_id)
+        self.assertFalse(WebhookBody.objects.exists())
+
+    @override_settings(WEBHOOK_RECEIVER_BODY_STORE=False)
+    def test_disabled(self):
+        data = self.create()
+        self.assertIsNone(data.stored_body_id)
+        self.assertFalse(WebhookBody.objects.exists())
+
+    def test_compact(self):
+        data = self.create()
+        call_command('compact_webhooks', stdout=StringIO())
+
+        data = JSONWebhookData.objects.get(pk=data.pk)
+        self.assertEqual(stored_columns(data)[0], b'')
+        self.assertEqual(bytes(data.body), self.BODY)
+
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT body FROM %s' %
+                           WebhookBody._meta.db_table)
+            body, = cursor.fetchone()
+        self.assertTrue(bytes(body).startswith(COMPRESSED_PREFIX))
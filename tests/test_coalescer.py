@@ -0,0 +1,97 @@
+from __future__ import unicode_literals
+
+import threading
+
+from django.test import SimpleTestCase
+
+from webhook_receiver.coalescer import EnrollmentCoalescer
+from webhook_receiver.coalescer import get_enrollment_coalescer
+from webhook_receiver.utils import EnrollmentException, send_enrollments
+
+
+class EnrollmentCoalescerTest(SimpleTestCase):
+
+    def setUp(self):
+        self.batches = []
+
+    def send(self, enrollments):
+        self.batches.append(list(enrollments))
+        return [EnrollmentException(email) if email.startswith('bad')
+                else None
+                for course_id, email in enrollments]
+
+    def enroll_concurrently(self, coalescer, submissions):
+        results = [None] * len(submissions)
+
+        def enroll(i):
+            results[i] = coalescer.enroll(submissions[i])
+
+        threads = [threading.Thread(target=enroll, args=(i,))
+                   for i in range(len(submissions))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_coalesce(self):
+        coalescer = EnrollmentCoalescer(self.send, window=0.1,
+                                        max_enrollments=100)
+        submissions = [[('course-v1:org+course+run1',
+                         'learner%d@example.com' % i)]
+                       for i in range(10)]
+        submissions.append([('course-v1:org+course+run1',
+                             'bad@example.com'),
+                            ('course-v1:org+course+run2',
+                             'learner0@example.com')])
+        results = self.enroll_concurrently(coalescer, submissions)
+
+        self.assertLess(len(self.batches), len(submissions))
+        self.assertEqual(sum(len(batch) for batch in self.batches), 12)
+        # Each thread gets the outcomes of its own enrollments.
+        for result in results[:10]:
+            self.assertEqual(result, [None])
+        self.assertIsInstance(results[10][0], EnrollmentException)
+        self.assertIsNone(results[10][1])
+
+    def test_max_enrollments(self):
+        coalescer = EnrollmentCoalescer(self.send, window=0.1,
+                                        max_enrollments=3)
+        submissions = [[('course-v1:org+course+run1',
+                         'learner%d@example.com' % i)]
+                       for i in range(10)]
+        self.enroll_concurrently(coalescer, submissions)
+        self.assertTrue(all(len(batch) <= 3 for batch in self.batches))
+        self.assertEqual(sum(len(batch) for batch in self.batches), 10)
+
+    def test_large_submission(self):
+        # A single task may submit more enrollments than fit into a
+        # batch.
+        coalescer = EnrollmentCoalescer(self.send, window=0.001,
+                                        max_enrollments=3)
+        enrollments = [('course-v1:org+course+run1',
+                        'learner%d@example.com' % i)
+                       for i in range(7)]
+        self.assertEqual(coalescer.enroll(enrollments), [None] * 7)
+        self.assertEqual([len(batch) for batch in self.batches],
+                         [3, 3, 1])
+
+    def test_send_error(self):
+        error = OSError('Connection refused')
+
+        def send(enrollments):
+            raise error
+
+        coalescer = EnrollmentCoalescer(send, window=0.001)
+        self.assertEqual(coalescer.enroll([('course-v1:org+course+run1',
+                                            'learner@example.com')]),
+                         [error])
+
+    def test_settings(self):
+        self.assertIsNone(get_enrollment_coalescer(send_enrollments))
+        with self.settings(WEBHOOK_RECEIVER_ENROLLMENT_WINDOW=0.01,
+                           WEBHOOK_RECEIVER_ENROLLMENT_MAX_BATCH=10):
+            coalescer = get_enrollment_coalescer(send_enrollments)
+            self.assertEqual(coalescer.max_enrollments, 10)
+            self.assertIs(get_enrollment_coalescer(send_enrollments),
+                          coalescer)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import zlib
+
+from io import StringIO
+
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+
+from webhook_receiver.fields import compress_body, decompress_body
+from webhook_receiver.fields import COMPRESSED_PREFIX
+from webhook_receiver.fields import OversizedBodyException
+from webhook_receiver.models import JSONWebhookData
+
+
+def stored_columns(data):
+    """Return the body and content of a webhook as stored in the
+    database."""
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT body, content FROM %s WHERE id = %%s' %
+                       JSONWebhookData._meta.db_table,
+                       [data.pk])
+        body, content = cursor.fetchone()
+    return bytes(body), content
+
+
+class CompressionTest(TestCase):
+
+    def test_roundtrip(self):
+        body = b'{"id": 1}' * 100
+        compressed = compress_body(body)
+        self.assertTrue(compressed.startswith(COMPRESSED_PREFIX))
+        self.assertLess(len(compressed), len(body))
+        self.assertEqual(decompress_body(compressed), body)
+        # A compressed body is a body, too.
+        self.assertEqual(decompress_body(compress_body(compressed)),
+                         compressed)
+
+    def test_uncompressed(self):
+        for body in (b'', b'{', b'\x1f\x8bnot gzip',
+                     zlib.compress(b'{}', wbits=31)):
+            self.assertEqual(decompress_body(body), body)
+
+    @override_settings(WEBHOOK_RECEIVER_MAX_BODY_SIZE=1000)
+    def test_oversized(self):
+        self.assertEqual(len(decompress_body(compress_body(b' ' * 1000))),
+                         1000)
+        with self.assertRaises(OversizedBodyException):
+            decompress_body(compress_body(b' ' * 1001))
+
+
+@override_settings(WEBHOOK_RECEIVER_BODY_STORE=False)
+class CompactStorageTest(TestCase):
+
+    BODY = '{"id": 1, "name": "Jöhn"}'.encode('utf-8')
+
+    def create(self, **kwargs):
+        data = JSONWebhookData(headers={'X-Forwarded-For': '10.0.0.1'},
+                               body=self.BODY,
+                               **kwargs)
+        data.save()
+        return data
+
+    @override_settings(WEBHOOK_RECEIVER_COMPACT_STORAGE=True)
+    def test_compact(self):
+        data = self.create(content={'id': 1, 'name': 'Jöhn'})
+        body, content = stored_columns(data)
+        self.assertTrue(body.startswith(COMPRESSED_PREFIX))
+        self.assertIsNone(content)
+
+        data = JSONWebhookData.objects.get(pk=data.pk)
+        self.assertEqual(bytes(data.body), self.BODY)
+        self.assertEqual(data.content, {'id': 1, 'name': 'Jöhn'})
+
+    @override_settings(WEBHOOK_RECEIVER_COMPACT_STORAGE=False)
+    def test_not_compact(self):
+        data = self.create(content={'id': 1})
+        body, content = stored_columns(data)
+        self.assertEqual(body, self.BODY)
+        self.assertIsNotNone(content)
+
+        # Reading back compact rows does not depend on compact
+        # storage being enabled.
+        with self.settings(WEBHOOK_RECEIVER_COMPACT_STORAGE=True):
+            compact = self.create()
+        compact = JSONWebhookData.objects.get(pk=compact.pk)
+        self.assertEqual(bytes(compact.body), self.BODY)
+
+    @override_settings(WEBHOOK_RECEIVER_COMPACT_STORAGE=False)
+    def test_gzip_body(self):
+        # A raw body that happens to be gzip-compressed is stored, and
+        # read back, as it was received.
+        gzipped = zlib.compress(b'{}' * 100000, wbits=31)
+        data = JSONWebhookData(headers={}, body=gzipped)
+        data.save()
+        self.assertEqual(stored_columns(data)[0], gzipped)
+        data = JSONWebhookData.objects.get(pk=data.pk)
+        self.assertEqual(bytes(data.body), gzipped)
+
+    @override_settings(WEBHOOK_RECEIVER_COMPACT_STORAGE=False)
+    def test_prefixed_body(self):
+        # A raw body that carries our prefix is stored compressed.
+        body = COMPRESSED_PREFIX + b'not gzip'
+        data = JSONWebhookData(headers={}, body=body)
+        data.save()
+        self.assertNotEqual(stored_columns(data)[0], body)
+        data = JSONWebhookData.objects.get(pk=data.pk)
+        self.assertEqual(bytes(data.body), body)
+
+    def test_lazy_content(self):
+        data = self.create()
+        data = JSONWebhookData.objects.get(pk=data.pk)
+        self.assertEqual(data.content, {'id': 1, 'name': 'Jöhn'})
+
+    def test_invalid_content(self):
+        data = JSONWebhookData(headers={}, body=b'{')
+        self.assertIsNone(data.content)
+        data = JSONWebhookData(headers={}, body=b'')
+        self.assertIsNone(data.content)
+
+
+@override_settings(WEBHOOK_RECEIVER_BODY_STORE=False)
+class CompactWebhooksCommandTest(TestCase):
+
+    def test_compact(self):
+        for i in range(5):
+            JSONWebhookData.objects.create(
+                headers={
+                    'Content-Type': 'application/json',
+                    'X-Forwarded-For': '10.0.0.1',
+                    'X-Shopify-Hmac-Sha256': 'signature',
+                },
+                body=b'{"id": %d}' % i,
+                content={'id': i},
+            )
+
+        out = StringIO()
+        call_command('compact_webhooks', chunk_size=2, stdout=out)
+        self.assertIn('Compacted 5 webhooks.', out.getvalue())
+
+        for data in JSONWebhookData.objects.all():
+            body, content = stored_columns(data)
+            self.assertTrue(body.startswith(COMPRESSED_PREFIX))
+            self.assertIsNone(content)
+            self.assertEqual(data.headers, {
+                'Content-Type': 'application/json',
+                'X-Shopify-Hmac-Sha256': 'signature',
+            })
+            self.assertEqual(data.content,
+                             {'id': int(bytes(data.body)[7:-1])})
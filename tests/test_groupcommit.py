@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import threading
+import time
+
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+
+from webhook_receiver.groupcommit import GroupCommit
+from webhook_receiver.models import JSONWebhookData
+from webhook_receiver.utils import receive_json_webhook, finish_and_save
+
+
+class GroupCommitTest(TestCase):
+
+    def setUp(self):
+        self.batches = []
+
+    def insert(self, instances):
+        # Simulate a slow database, so that rows pile up while we
+        # write a batch.
+        time.sleep(0.01)
+        self.batches.append(list(instances))
+
+    def run_threads(self, group_commit, count):
+        results = {}
+
+        def target(i):
+            try:
+                results[i] = group_commit.insert(i)
+            except Exception as e:
+                results[i] = e
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=target, args=(i,))
+                   for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_batching(self):
+        group_commit = GroupCommit(self.insert, window=0.05, max_rows=100)
+        results = self.run_threads(group_commit, 20)
+
+        self.assertEqual(results, {i: i for i in range(20)})
+        self.assertLess(len(self.batches), 20)
+        self.assertEqual(sorted(sum(self.batches, [])), list(range(20)))
+        self.assertFalse(group_commit.pending)
+        self.assertFalse(group_commit.collecting)
+
+    def test_max_rows(self):
+        group_commit = GroupCommit(self.insert, window=0.05, max_rows=3)
+        self.run_threads(group_commit, 10)
+
+        self.assertTrue(all(len(batch) <= 3 for batch in self.batches))
+        self.assertEqual(sorted(sum(self.batches, [])), list(range(10)))
+
+    def test_error(self):
+        def insert(instances):
+            raise ValueError('Database is on fire')
+
+        group_commit = GroupCommit(insert, window=0.01)
+        results = self.run_threads(group_commit, 5)
+
+        self.assertTrue(all(isinstance(result, ValueError)
+                            for result in results.values()))
+
+
+@override_settings(WEBHOOK_RECEIVER_SINGLE_WRITE=True,
+                   WEBHOOK_RECEIVER_GROUP_COMMIT_WINDOW=0.001)
+class GroupCommitWebhookTest(TestCase):
+
+    def test_finish_and_save(self):
+        request = RequestFactory().post('/webhooks/shopify/order/create',
+                                        b'{"id": 1}',
+                                        content_type='application/json')
+        data = receive_json_webhook(request)
+        finish_and_save(data)
+
+        self.assertIsNotNone(data.pk)
+        data = JSONWebhookData.objects.get(pk=data.pk)
+        self.assertEqual(data.status, JSONWebhookData.PROCESSED)
+        self.assertEqual(data.content, {'id': 1})
@@ -0,0 +1,114 @@
+from __future__ import unicode_literals
+
+import os
+
+from datetime import datetime
+from io import StringIO
+from unittest import skipUnless
+
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+
+from kombu.serialization import dumps as kombu_dumps
+from kombu.serialization import loads as kombu_loads
+
+from webhook_receiver import jsonbackend
+from webhook_receiver.models import JSONWebhookData
+
+
+class JSONBackendTestMixin(object):
+
+    def test_roundtrip(self):
+        obj = {'id': 1, 'name': 'Jöhn', 'items': [1.5, None, True]}
+        self.assertEqual(jsonbackend.loads(jsonbackend.dumps(obj)), obj)
+        self.assertEqual(jsonbackend.loads(b'{"id": 1}'), {'id': 1})
+
+    def test_stdlib_compatibility(self):
+        # Documents that the standard library accepts, but orjson
+        # does not
+        for s in ('[%d]' % 2 ** 64, b'[%d]' % 2 ** 70, '[%d]' % -2 ** 64):
+            value = jsonbackend.loads(s)[0]
+            self.assertIsInstance(value, int)
+            self.assertEqual(value, int(s[1:-1]))
+        self.assertEqual(jsonbackend.dumps({1: 2 ** 64}),
+                         '{"1": %d}' % 2 ** 64)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            jsonbackend.loads(b'{')
+
+    def test_message_roundtrip(self):
+        message = [[{'id': 1}, True], {}, {'callbacks': None}]
+        content_type, encoding, payload = kombu_dumps(
+            message, serializer=jsonbackend.SERIALIZER)
+        self.assertEqual(content_type, jsonbackend.CONTENT_TYPE)
+        self.assertEqual(kombu_loads(payload, content_type, encoding),
+                         message)
+
+    def test_message_kombu_types(self):
+        message = [[datetime(2020, 1, 1, 12, 0)], {}, {}]
+        content_type, encoding, payload = kombu_dumps(
+            message, serializer=jsonbackend.SERIALIZER)
+        self.assertEqual(kombu_loads(payload, content_type, encoding),
+                         message)
+
+    def test_message_long_integers(self):
+        # orjson can't encode these, and would decode them as floats.
+        message = [[{'id': 2 ** 70, 'other': -2 ** 64}], {}, {}]
+        content_type, encoding, payload = kombu_dumps(
+            message, serializer=jsonbackend.SERIALIZER)
+        loaded = kombu_loads(payload, content_type, encoding)
+        self.assertEqual(loaded, message)
+        self.assertIsInstance(loaded[0][0]['id'], int)
+
+    def test_json_field(self):
+        data = JSONWebhookData(headers={'X-Foo': 'bär'},
+                               body=b'{"id": 1}',
+                               content={'id': 1})
+        data.save()
+        data = JSONWebhookData.objects.get(pk=data.pk)
+        self.assertEqual(data.headers, {'X-Foo': 'bär'})
+        self.assertEqual(data.content, {'id': 1})
+
+
+@override_settings(WEBHOOK_RECEIVER_JSON_BACKEND='json')
+class StdlibBackendTest(JSONBackendTestMixin, TestCase):
+
+    def test_backend(self):
+        self.assertIsInstance(jsonbackend.get_backend(),
+                              jsonbackend.StdlibBackend)
+
+
+@skipUnless(jsonbackend.orjson, 'orjson is not installed')
+@override_settings(WEBHOOK_RECEIVER_JSON_BACKEND='orjson')
+class ORJSONBackendTest(JSONBackendTestMixin, TestCase):
+
+    def test_backend(self):
+        self.assertIsInstance(jsonbackend.get_backend(),
+                              jsonbackend.ORJSONBackend)
+
+
+@override_settings(WEBHOOK_RECEIVER_JSON_BACKEND='nonexistent')
+class UnavailableBackendTest(TestCase):
+
+    def setUp(self):
+        jsonbackend._unavailable.discard('nonexistent')
+
+    def test_fallback(self):
+        with self.assertLogs('webhook_receiver.jsonbackend') as logs:
+            self.assertIsInstance(jsonbackend.get_backend(),
+                                  jsonbackend.StdlibBackend)
+            jsonbackend.get_backend()
+        self.assertEqual(len(logs.output), 1)
+
+
+class BenchmarkCommandTest(TestCase):
+
+    def test_benchmark(self):
+        out = StringIO()
+        call_command('benchmark_json_backends',
+                     os.path.join(os.path.dirname(__file__), 'shopify.json'),
+                     iterations=1,
+                     stdout=out)
+        self.assertIn('shopify.json', out.getvalue())
+        self.assertIn('json: ', out.getvalue())
@@ -0,0 +1,164 @@
+from __future__ import unicode_literals
+
+import threading
+import time
+
+from unittest.mock import patch
+
+import requests_mock
+
+from django.conf import settings
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+
+from requests.exceptions import HTTPError
+
+from webhook_receiver import lmsclient
+from webhook_receiver.lmsclient import LMSClient
+from webhook_receiver.lmsclient import get_lms_client, reset_lms_client
+from webhook_receiver.utils import bulk_enroll
+from webhook_receiver_shopify.tasks import process as shopify_process
+from webhook_receiver_woocommerce.tasks import process as woocommerce_process
+
+from .test_sharedset import LOCMEM_CACHES
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class LMSClientTest(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        reset_lms_client()
+        self.token_uri = '%s/oauth2/access_token' % settings.WEBHOOK_RECEIVER_LMS_BASE_URL  # noqa: E501
+        self.enroll_uri = '%s/api/bulk_enroll/v1/bulk_enroll' % settings.WEBHOOK_RECEIVER_LMS_BASE_URL  # noqa: E501
+        self.tokens_issued = 0
+
+    def issue_token(self, request, context, expires_in=3600, delay=0):
+        time.sleep(delay)
+        self.tokens_issued += 1
+        return {'access_token': 'token%d' % self.tokens_issued,
+                'expires_in': expires_in}
+
+    def new_client(self):
+        return LMSClient(settings.WEBHOOK_RECEIVER_LMS_BASE_URL,
+                         settings.WEBHOOK_RECEIVER_EDX_OAUTH2_KEY,
+                         settings.WEBHOOK_RECEIVER_EDX_OAUTH2_SECRET)
+
+    def test_reuse_client(self):
+        client = get_lms_client()
+        self.assertIs(get_lms_client(), client)
+        with self.settings(WEBHOOK_RECEIVER_EDX_OAUTH2_KEY='other'):
+            self.assertIsNot(get_lms_client(), client)
+
+    def test_reuse_token(self):
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST', self.token_uri, json=self.issue_token)
+            m.register_uri('POST', self.enroll_uri, json={})
+            for i in range(5):
+                bulk_enroll(['course-v1:org+course+run1'],
+                            ['learner%d@example.com' % i])
+            enroll_requests = [r for r in m.request_history
+                               if r.url == self.enroll_uri]
+
+        self.assertEqual(self.tokens_issued, 1)
+        self.assertEqual(len(enroll_requests), 5)
+        for request in enroll_requests:
+            self.assertEqual(request.headers['Authorization'],
+                             'JWT token1')
+
+    def test_share_token(self):
+        # Another process finds the token in the cache.
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST', self.token_uri, json=self.issue_token)
+            self.assertEqual(self.new_client().get_access_token(),
+                             'token1')
+            self.assertEqual(self.new_client().get_access_token(),
+                             'token1')
+        self.assertEqual(self.tokens_issued, 1)
+
+    def test_expiry(self):
+        def issue_token(request, context):
+            # Each token expires before it is due for refresh.
+            return self.issue_token(request, context,
+                                    expires_in=lmsclient.TOKEN_EXPIRY_MARGIN)
+
+        client = self.new_client()
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST', self.token_uri, json=issue_token)
+            self.assertEqual(client.get_access_token(), 'token1')
+            self.assertEqual(client.get_access_token(), 'token2')
+        self.assertIsNone(cache.get(client.token_key))
+
+    def test_single_flight(self):
+        def issue_token(request, context):
+            return self.issue_token(request, context, delay=0.1)
+
+        client = self.new_client()
+        tokens = []
+
+        def get_token():
+            tokens.append(client.get_access_token())
+
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST', self.token_uri, json=issue_token)
+            threads = [threading.Thread(target=get_token)
+                       for i in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(self.tokens_issued, 1)
+        self.assertEqual(tokens, ['token1'] * 10)
+
+    def test_wait_for_refresh(self):
+        # Another process holds the lease on refreshing the token,
+        # and stores a new one in the cache shortly.
+        client = self.new_client()
+        cache.add(client.lease_key, 0)
+        timer = threading.Timer(
+            0.1,
+            lambda: cache.set(client.token_key,
+                              ('shared', time.time() + 3600)))
+        timer.start()
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST', self.token_uri, json=self.issue_token)
+            self.assertEqual(client.get_access_token(), 'shared')
+        timer.join()
+        self.assertEqual(self.tokens_issued, 0)
+
+    def test_wait_timeout(self):
+        # Another process holds the lease on refreshing the token,
+        # but never stores a new one.
+        client = self.new_client()
+        cache.add(client.lease_key, 0)
+        with patch.object(lmsclient, 'TOKEN_REFRESH_TIMEOUT', 0.1):
+            with requests_mock.Mocker() as m:
+                m.register_uri('POST', self.token_uri,
+                               json=self.issue_token)
+                self.assertEqual(client.get_access_token(), 'token1')
+
+    def test_wait_within_time_limit(self):
+        # A task that waits for another process's refresh must have
+        # time left to fetch a token itself, and to enroll.
+        for task in (shopify_process, woocommerce_process):
+            self.assertLess(lmsclient.TOKEN_REFRESH_TIMEOUT,
+                            task.soft_time_limit / 2)
+
+    def test_invalidate_on_401(self):
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST', self.token_uri, json=self.issue_token)
+            m.register_uri('POST', self.enroll_uri, [
+                {'status_code': 401},
+                {'json': {}},
+            ])
+            with self.assertRaises(HTTPError):
+                bulk_enroll(['course-v1:org+course+run1'],
+                            ['learner@example.com'])
+            bulk_enroll(['course-v1:org+course+run1'],
+                        ['learner@example.com'])
+            enroll_requests = [r for r in m.request_history
+                               if r.url == self.enroll_uri]
+
+        self.assertEqual(self.tokens_issued, 2)
+        self.assertEqual(enroll_requests[1].headers['Authorization'],
+                         'JWT token2')
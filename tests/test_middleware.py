@@ -0,0 +1,66 @@
+from __future__ import unicode_literals
+
+from io import StringIO
+
+from django.conf import settings
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.test import SimpleTestCase, RequestFactory
+
+from webhook_receiver import middleware
+
+
+def build_stack(get_response):
+    handler = get_response
+    for path in reversed(settings.MIDDLEWARE):
+        handler = getattr(middleware, path.rsplit('.', 1)[1])(handler)
+    return handler
+
+
+class WebhookBypassTest(SimpleTestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.seen = []
+
+    def view(self, request):
+        self.seen.append(request)
+        return HttpResponse(status=200)
+
+    async def aview(self, request):
+        return self.view(request)
+
+    def test_webhook(self):
+        handler = build_stack(self.view)
+        request = self.factory.post('/webhooks/shopify/order/create')
+        self.assertEqual(handler(request).status_code, 200)
+        self.assertFalse(hasattr(self.seen[0], 'session'))
+        self.assertFalse(hasattr(self.seen[0], 'user'))
+        self.assertFalse(hasattr(self.seen[0], '_messages'))
+
+    def test_admin(self):
+        handler = build_stack(self.view)
+        request = self.factory.get('/admin/')
+        self.assertEqual(handler(request).status_code, 200)
+        self.assertTrue(hasattr(self.seen[0], 'session'))
+        self.assertTrue(hasattr(self.seen[0], 'user'))
+        self.assertTrue(hasattr(self.seen[0], '_messages'))
+
+    async def test_async(self):
+        handler = build_stack(self.aview)
+        for path in ('/webhooks/shopify/order/create', '/admin/'):
+            response = await handler(self.factory.post(path))
+            self.assertEqual(response.status_code, 200)
+        self.assertFalse(hasattr(self.seen[0], 'session'))
+        self.assertTrue(hasattr(self.seen[1], 'session'))
+
+
+class BenchmarkCommandTest(SimpleTestCase):
+
+    def test_benchmark(self):
+        out = StringIO()
+        call_command('benchmark_middleware',
+                     iterations=1,
+                     stdout=out)
+        self.assertIn('webhook request, webhook_receiver middleware',
+                      out.getvalue())
@@ -0,0 +1,183 @@
+from __future__ import unicode_literals
+
+from unittest.mock import patch
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, Client, override_settings
+from django.test import AsyncRequestFactory
+
+from webhook_receiver.models import JSONWebhookData
+from webhook_receiver.ratelimit import RateLimiter, get_rate_limiter
+from webhook_receiver.ratelimit import reset_rate_limits
+from webhook_receiver_woocommerce.views import aorder_create_or_update
+
+from . import WooCommerceTestCase
+from .test_sharedset import LOCMEM_CACHES
+
+
+RATELIMIT_SETTINGS = {
+    'shopify': {
+        'shop_domain': 'example.com',
+        'api_key': 'secret',
+    },
+    'woocommerce': {
+        'source': 'https://example.com',
+        'secret': 'secret',
+        'shops': [
+            {'source': 'https://example.org'},
+        ],
+    },
+}
+
+
+def at(timestamp):
+    return patch('webhook_receiver.ratelimit.time.time',
+                 return_value=timestamp)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class RateLimiterTest(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        # 10 tokens, refilled in 10 seconds
+        self.limiter = RateLimiter(1.0, 10)
+
+    def test_burst(self):
+        with at(1000.0):
+            for i in range(10):
+                self.assertIsNone(self.limiter.take('a'))
+            wait = self.limiter.take('a')
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 20)
+        # Other sources have their own buckets.
+        with at(1000.0):
+            self.assertIsNone(self.limiter.take('b'))
+
+    def test_refill(self):
+        with at(1000.0):
+            for i in range(10):
+                self.limiter.take('a')
+        # Halfway through the next period, half of the previous
+        # period's tokens still count.
+        with at(1015.0):
+            for i in range(5):
+                self.assertIsNone(self.limiter.take('a'))
+            self.assertIsNotNone(self.limiter.take('a'))
+        with at(1030.0):
+            self.assertIsNone(self.limiter.take('a'))
+
+    def test_retry_after(self):
+        with at(1015.0):
+            for i in range(11):
+                wait = self.limiter.take('a')
+        # The source gets a token once it can.
+        with at(1015.0 + wait - 0.01):
+            self.assertIsNotNone(self.limiter.take('a'))
+        with at(1015.0 + wait):
+            self.assertIsNone(self.limiter.take('a'))
+
+    def test_shared(self):
+        with at(1000.0):
+            for i in range(10):
+                self.limiter.take('a')
+            # Another process shares the bucket.
+            self.assertIsNotNone(RateLimiter(1.0, 10).take('a'))
+
+    def test_throttled_locally(self):
+        with at(1000.0):
+            for i in range(11):
+                self.limiter.take('a')
+            # Once we know a source is throttled, we don't ask the
+            # cache.
+            with patch('webhook_receiver.ratelimit.cache') as mock_cache:
+                self.assertIsNotNone(self.limiter.take('a'))
+            self.assertFalse(mock_cache.method_calls)
+
+    def test_rejected_take_no_tokens(self):
+        with at(1000.0):
+            for i in range(20):
+                self.limiter.take('a')
+            self.assertEqual(cache.get(self.limiter.cache_key('a', 100)),
+                             10)
+
+    def test_cache_unavailable(self):
+        with patch('webhook_receiver.ratelimit.cache.incr',
+                   side_effect=OSError('Connection refused')):
+            with self.assertLogs('webhook_receiver.ratelimit', 'WARNING'):
+                self.assertIsNone(self.limiter.take('a'))
+
+    @override_settings(WEBHOOK_RECEIVER_RATE_LIMIT=0)
+    def test_disabled(self):
+        self.assertIsNone(get_rate_limiter())
+
+
+@override_settings(CACHES=LOCMEM_CACHES,
+                   WEBHOOK_RECEIVER_SETTINGS=RATELIMIT_SETTINGS,
+                   WEBHOOK_RECEIVER_RATE_LIMIT=0.1,
+                   WEBHOOK_RECEIVER_RATE_LIMIT_BURST=2)
+class RateLimitViewTest(WooCommerceTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        reset_rate_limits()
+        self.addCleanup(reset_rate_limits)
+        self.client = Client()
+
+    def post(self, source='https://example.com', ip='192.0.2.1',
+             **extra):
+        # The signature is invalid, which does not matter for rate
+        # limiting.
+        return self.client.post('/webhooks/woocommerce/order/create',
+                                self.raw_payload,
+                                content_type='application/json',
+                                HTTP_X_WC_WEBHOOK_SOURCE=source,
+                                HTTP_X_WC_WEBHOOK_SIGNATURE='foo',
+                                REMOTE_ADDR=ip,
+                                **extra)
+
+    def test_rate_limit(self):
+        with at(1000.0):
+            for i in range(2):
+                self.assertEqual(self.post().status_code, 403)
+            response = self.post()
+            self.assertEqual(response.status_code, 429)
+            self.assertGreater(int(response['Retry-After']), 0)
+            # We did not store the throttled webhook.
+            self.assertEqual(JSONWebhookData.objects.count(), 2)
+
+            # Other shops, and other clients, have their own limits.
+            self.assertEqual(self.post(source='https://example.org')
+                             .status_code, 403)
+            self.assertEqual(self.post(ip='192.0.2.2').status_code, 403)
+
+    def test_unknown_shops(self):
+        # Rotating unknown shops, or X-Forwarded-For headers, does not
+        # get a client a fresh bucket.
+        with at(1000.0):
+            for i in range(2):
+                self.assertEqual(self.post(source='https://%d.example'
+                                           % i).status_code, 403)
+            self.assertEqual(self.post(source='https://2.example')
+                             .status_code, 429)
+            self.assertEqual(self.post(source='https://3.example',
+                                       HTTP_X_FORWARDED_FOR='192.0.2.3')
+                             .status_code, 429)
+            # Known shops still have their own limits.
+            self.assertEqual(self.post().status_code, 403)
+
+    async def test_rate_limit_async(self):
+        factory = AsyncRequestFactory()
+        with at(1000.0):
+            for status in (403, 403, 429):
+                request = factory.post(
+                    '/webhooks/woocommerce/order/create',
+                    self.raw_payload,
+                    content_type='application/json',
+                    headers={
+                        'X-Wc-Webhook-Source': 'https://example.com',
+                        'X-Wc-Webhook-Signature': 'foo',
+                    })
+                response = await aorder_create_or_update(request)
+                self.assertEqual(response.status_code, status)
@@ -0,0 +1,57 @@
+from __future__ import unicode_literals
+
+from django.test import TestCase, RequestFactory, override_settings
+
+from webhook_receiver.rejections import rejection_counts, reject_webhook
+from webhook_receiver.rejections import reset_rejection_counts
+from webhook_receiver.rejections import MAX_HEADER_LENGTH
+from webhook_receiver.utils import InvalidWebhookException
+from webhook_receiver.utils import MalformedWebhookException
+
+
+@override_settings(WEBHOOK_RECEIVER_REJECTION_LOG_INTERVAL=3)
+class RejectWebhookTest(TestCase):
+
+    HEADERS = ('X-Shopify-Shop-Domain',)
+
+    def setUp(self):
+        reset_rejection_counts()
+        self.request = RequestFactory().post(
+            '/webhooks/shopify/order/create',
+            b'{}',
+            content_type='application/json',
+            headers={
+                'X-Shopify-Shop-Domain': 'x' * 1000,
+                'X-Shopify-Hmac-Sha256': 'forged',
+            })
+
+    def test_counts(self):
+        for i in range(2):
+            reject_webhook('shopify',
+                           self.request,
+                           InvalidWebhookException('Forged'),
+                           self.HEADERS)
+        reject_webhook('shopify',
+                       self.request,
+                       MalformedWebhookException('Broken'),
+                       self.HEADERS)
+        self.assertEqual(rejection_counts(), {
+            ('shopify', 'InvalidWebhookException'): 2,
+            ('shopify', 'MalformedWebhookException'): 1,
+        })
+
+    def test_sampling(self):
+        with self.assertLogs('webhook_receiver.rejections') as logs:
+            for i in range(7):
+                reject_webhook('shopify',
+                               self.request,
+                               InvalidWebhookException('Forged'),
+                               self.HEADERS)
+        # We log the 1st, 4th, and 7th rejection.
+        self.assertEqual(len(logs.output), 3)
+        self.assertIn('(7 such rejections so far)', logs.output[-1])
+
+        # We only log allowed headers, truncated.
+        self.assertNotIn('forged', logs.output[0])
+        self.assertIn("'%s'" % ('x' * MAX_HEADER_LENGTH), logs.output[0])
+        self.assertNotIn('x' * (MAX_HEADER_LENGTH + 1), logs.output[0])
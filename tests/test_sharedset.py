@@ -0,0 +1,70 @@
+from __future__ import unicode_literals
+
+from unittest.mock import patch
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+
+from webhook_receiver.sharedset import SharedSet, get_shared_set
+from webhook_receiver.sharedset import reset_shared_sets
+
+
+LOCMEM_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class SharedSetTest(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.shared_set = SharedSet('test', 60, 2)
+
+    def test_add(self):
+        self.assertNotIn('1', self.shared_set)
+        self.shared_set.add('1')
+        self.assertIn('1', self.shared_set)
+
+    def test_shared(self):
+        # Another process, with its own LRU, sees the same members.
+        self.shared_set.add('1')
+        other = SharedSet('test', 60, 2)
+        self.assertIn('1', other)
+        self.assertNotIn('1', SharedSet('other', 60, 2))
+
+    def test_lru(self):
+        for key in ('1', '2', '3'):
+            self.shared_set.add(key)
+        self.assertEqual(list(self.shared_set.local), ['2', '3'])
+        # Evicted from the LRU, but still in the cache
+        self.assertIn('1', self.shared_set)
+        self.assertEqual(list(self.shared_set.local), ['3', '1'])
+
+    def test_expiry(self):
+        self.shared_set.add('1')
+        with patch('time.monotonic', return_value=1e12):
+            self.assertFalse(self.shared_set._local_contains('1'))
+        self.assertNotIn('1', self.shared_set.local)
+
+    def test_cache_unavailable(self):
+        with patch.object(cache, 'set', side_effect=ConnectionError):
+            self.shared_set.add('1')
+        # Still in the LRU
+        self.assertIn('1', self.shared_set)
+        with patch.object(cache, 'get', side_effect=ConnectionError):
+            self.assertNotIn('2', self.shared_set)
+
+    async def test_async(self):
+        self.assertFalse(await self.shared_set.acontains('1'))
+        await self.shared_set.aadd('1')
+        self.assertTrue(await self.shared_set.acontains('1'))
+        self.assertTrue(await SharedSet('test', 60, 2).acontains('1'))
+
+    def test_get_shared_set(self):
+        reset_shared_sets()
+        shared_set = get_shared_set('test', 60, 2)
+        self.assertIs(get_shared_set('test', 60, 2), shared_set)
+        self.assertIsNot(get_shared_set('test', 60, 3), shared_set)
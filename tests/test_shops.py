@@ -0,0 +1,202 @@
+from __future__ import unicode_literals
+
+import base64
+import hashlib
+import hmac
+
+from unittest.mock import patch
+
+from django.db import DatabaseError
+from django.test import TestCase, Client, override_settings
+from django.test import AsyncRequestFactory
+
+from webhook_receiver.models import JSONWebhookData
+from webhook_receiver.models import Shop as ShopRecord
+from webhook_receiver import shops
+from webhook_receiver.shops import arefresh_shops, get_shop, reset_shops
+from webhook_receiver.shops import shop_conf, ShopsNotLoadedException
+from webhook_receiver_shopify.views import aorder_create
+from webhook_receiver_woocommerce.utils import order_is_payable
+
+from . import ShopifyTestCase
+
+
+SHOPIFY_SHOPS = {
+    'shopify': {
+        'shop_domain': 'example.com',
+        'api_key': 'secret',
+        'send_email': True,
+        'shops': [
+            {
+                'shop_domain': 'shop1.example.com',
+                'api_key': 'secret1',
+                'previous_api_keys': ['old-secret1'],
+                'send_email': False,
+            },
+            {
+                'shop_domain': 'shop2.example.com',
+                'api_key': 'secret2',
+            },
+        ],
+    },
+}
+
+
+@override_settings(WEBHOOK_RECEIVER_SETTINGS=SHOPIFY_SHOPS)
+class ConfiguredShopsTest(TestCase):
+
+    def test_get_shop(self):
+        shop = get_shop('shopify', 'shop1.example.com')
+        self.assertEqual(shop.identifier, 'shop1.example.com')
+        for secret in ('secret1', 'old-secret1'):
+            signature = base64.b64encode(hmac.new(secret.encode('utf-8'),
+                                                  b'{}',
+                                                  hashlib.sha256).digest())
+            self.assertTrue(shop.verifier.verify(b'{}',
+                                                 signature.decode()))
+        self.assertIsNotNone(get_shop('shopify', 'example.com'))
+        self.assertIsNone(get_shop('shopify', 'shop3.example.com'))
+
+    def test_options(self):
+        # A shop inherits the options it does not set.
+        self.assertFalse(shop_conf('shopify',
+                                   'shop1.example.com')['send_email'])
+        self.assertTrue(shop_conf('shopify',
+                                  'shop2.example.com')['send_email'])
+        self.assertNotIn('shops', shop_conf('shopify', 'example.com'))
+        # An unknown shop gets the platform's options.
+        self.assertTrue(shop_conf('shopify', None)['send_email'])
+
+    def test_settings_changed(self):
+        self.assertIsNotNone(get_shop('shopify', 'shop2.example.com'))
+        with self.settings(WEBHOOK_RECEIVER_SETTINGS={
+                'shopify': {
+                    'shop_domain': 'example.com',
+                    'api_key': 'secret',
+                },
+        }):
+            self.assertIsNone(get_shop('shopify', 'shop2.example.com'))
+
+
+@override_settings(WEBHOOK_RECEIVER_SHOP_TABLE=True,
+                   WEBHOOK_RECEIVER_SHOP_RELOAD_INTERVAL=60)
+class StoredShopsTest(TestCase):
+
+    def setUp(self):
+        reset_shops()
+        ShopRecord.objects.create(platform='woocommerce',
+                                  identifier='https://shop1.example.com',
+                                  secret='secret1',
+                                  options={'require_payment': False})
+
+    def test_get_shop(self):
+        shop = get_shop('woocommerce', 'https://shop1.example.com')
+        self.assertEqual(shop.conf['secret'], 'secret1')
+        self.assertFalse(shop.conf['require_payment'])
+        # Shops from the settings are still there.
+        self.assertTrue(get_shop('woocommerce',
+                                 'https://example.com').conf['require_payment'])  # noqa: E501
+        self.assertIsNone(get_shop('shopify',
+                                   'https://shop1.example.com'))
+
+    def test_cached(self):
+        get_shop('woocommerce', 'https://shop1.example.com')
+        with self.assertNumQueries(0):
+            get_shop('woocommerce', 'https://shop1.example.com')
+
+        with patch('time.monotonic', return_value=1e12):
+            with self.assertNumQueries(1):
+                get_shop('woocommerce', 'https://shop1.example.com')
+
+    def test_changed(self):
+        ShopRecord.objects.create(platform='woocommerce',
+                                  identifier='https://shop2.example.com',
+                                  secret='secret2')
+        self.assertIsNotNone(get_shop('woocommerce',
+                                      'https://shop2.example.com'))
+        ShopRecord.objects.filter(
+            identifier='https://shop2.example.com').update(active=False)
+        with patch('time.monotonic', return_value=1e12):
+            self.assertIsNone(get_shop('woocommerce',
+                                       'https://shop2.example.com'))
+
+    def test_database_error(self):
+        get_shop('woocommerce', 'https://shop1.example.com')
+        with patch('time.monotonic', return_value=1e12):
+            with patch.object(ShopRecord.objects, 'filter',
+                              side_effect=DatabaseError):
+                # We keep the shops we have.
+                self.assertIsNotNone(
+                    get_shop('woocommerce', 'https://shop1.example.com'))
+
+    async def test_async(self):
+        # From async code, we don't read the Shop table, but use the
+        # shops we have until the next arefresh_shops().
+        await arefresh_shops('woocommerce')
+        reset_shops()
+        self.assertIsNotNone(get_shop('woocommerce',
+                                      'https://shop1.example.com'))
+        with patch.dict(shops._indexes, clear=True):
+            with self.assertRaises(ShopsNotLoadedException):
+                get_shop('woocommerce', 'https://shop1.example.com')
+
+    def test_order_is_payable(self):
+        data = JSONWebhookData(
+            headers={'X-Wc-Webhook-Source': 'https://shop1.example.com'},
+            content={'id': 1, 'date_paid_gmt': None})
+        self.assertTrue(order_is_payable(data))
+        data.headers['X-Wc-Webhook-Source'] = 'https://example.com'
+        self.assertFalse(order_is_payable(data))
+
+
+@override_settings(WEBHOOK_RECEIVER_SETTINGS=SHOPIFY_SHOPS)
+class MultiShopViewTest(ShopifyTestCase):
+
+    def setUp(self):
+        self.setup_payload()
+        self.client = Client()
+
+    def post(self, shop_domain, secret):
+        signature = base64.b64encode(hmac.new(secret.encode('utf-8'),
+                                              self.raw_payload,
+                                              hashlib.sha256).digest())
+        return self.client.post('/webhooks/shopify/order/create',
+                                self.raw_payload,
+                                content_type='application/json',
+                                HTTP_X_SHOPIFY_HMAC_SHA256=signature.decode(),  # noqa: E501
+                                HTTP_X_SHOPIFY_SHOP_DOMAIN=shop_domain)
+
+    def test_shops(self):
+        with patch('webhook_receiver_shopify.views.schedule_order') as m:
+            response = self.post('shop2.example.com', 'secret2')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(m.call_count, 1)
+
+            # A shop's webhooks can't be signed with another shop's
+            # secret.
+            response = self.post('shop2.example.com', 'secret1')
+            self.assertEqual(response.status_code, 403)
+            response = self.post('shop3.example.com', 'secret1')
+            self.assertEqual(response.status_code, 403)
+            self.assertEqual(m.call_count, 1)
+
+    @override_settings(WEBHOOK_RECEIVER_SHOP_TABLE=True)
+    async def test_async_stored_shop(self):
+        await ShopRecord.objects.acreate(platform='shopify',
+                                         identifier='shop3.example.com',
+                                         secret='secret3')
+        signature = base64.b64encode(hmac.new(b'secret3',
+                                              self.raw_payload,
+                                              hashlib.sha256).digest())
+        request = AsyncRequestFactory().post(
+            '/webhooks/shopify/order/create',
+            self.raw_payload,
+            content_type='application/json',
+            headers={
+                'X-Shopify-Hmac-Sha256': signature.decode(),
+                'X-Shopify-Shop-Domain': 'shop3.example.com',
+            })
+        with patch('webhook_receiver_shopify.views.aschedule_order') as m:
+            response = await aorder_create(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(m.call_count, 1)
@@ -0,0 +1,62 @@
+from __future__ import unicode_literals
+
+from django.test import SimpleTestCase
+
+from webhook_receiver.signing import Verifier, decode_signature
+from webhook_receiver.signing import get_verifier
+from webhook_receiver.utils import get_hmac
+
+
+class VerifierTest(SimpleTestCase):
+
+    # The signature of b'world' with the secret 'hello'
+    SIGNATURE = '8ayXAutfryPKKRpNxG3t3u4qeMza8KQSvtdxTP/7HMQ='
+
+    def test_sign(self):
+        verifier = Verifier(['hello', 'bye'])
+        digest = verifier.sign(b'world')
+        self.assertEqual(digest, decode_signature(self.SIGNATURE))
+        # Signing does not consume the pre-keyed state.
+        self.assertEqual(verifier.sign(b'world'), digest)
+
+    def test_signer(self):
+        verifier = Verifier(['hello'])
+        signer = verifier.signer()
+        for chunk in (b'wo', b'r', b'ld'):
+            signer.update(chunk)
+        self.assertEqual(signer.digest(), verifier.sign(b'world'))
+
+    def test_verify(self):
+        verifier = Verifier(['hello'])
+        self.assertTrue(verifier.verify(b'world', self.SIGNATURE))
+        self.assertTrue(verifier.verify(b'world',
+                                        self.SIGNATURE,
+                                        verifier.sign(b'world')))
+        self.assertFalse(verifier.verify(b'world!', self.SIGNATURE))
+        self.assertFalse(Verifier(['bye']).verify(b'world',
+                                                  self.SIGNATURE))
+
+    def test_rotation(self):
+        # Both the current and the previous secrets are accepted.
+        verifier = Verifier(['bye', 'hello', 'foo'])
+        self.assertTrue(verifier.verify(b'world', self.SIGNATURE))
+        self.assertTrue(verifier.verify(b'world',
+                                        self.SIGNATURE,
+                                        verifier.sign(b'world')))
+        for secret in ('bye', 'foo'):
+            self.assertTrue(verifier.verify(b'world',
+                                            get_hmac(secret, b'world')))
+        self.assertFalse(verifier.verify(b'world',
+                                         get_hmac('bar', b'world')))
+
+    def test_malformed_signature(self):
+        verifier = Verifier(['hello'])
+        for signature in ('', 'world', '-%s' % self.SIGNATURE[1:],
+                          self.SIGNATURE[:-4], '%s=' % self.SIGNATURE):
+            self.assertIsNone(decode_signature(signature))
+            self.assertFalse(verifier.verify(b'world', signature))
+
+    def test_get_verifier(self):
+        verifier = get_verifier(['hello', 'bye'])
+        self.assertIs(get_verifier(('hello', 'bye')), verifier)
+        self.assertIsNot(get_verifier(['bye', 'hello']), verifier)
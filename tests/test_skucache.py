@@ -0,0 +1,174 @@
+from __future__ import unicode_literals
+
+import threading
+import time
+
+import requests_mock
+
+from django.conf import settings
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+
+from requests.exceptions import HTTPError
+
+from webhook_receiver.skucache import SKUCache
+from webhook_receiver.skucache import get_sku_cache, reset_sku_cache
+from webhook_receiver.utils import SKULookupException, lookup_course_id
+
+from .test_sharedset import LOCMEM_CACHES
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class SKUCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.sku_cache = SKUCache(timeout=60, negative_timeout=60,
+                                  max_size=10)
+        self.resolved = []
+
+    def resolve(self, course_id, delay=0):
+        def resolve():
+            time.sleep(delay)
+            self.resolved.append(course_id)
+            return course_id
+        return resolve
+
+    def test_lookup(self):
+        course_id = 'course-v1:org+course+run1'
+        for i in range(3):
+            self.assertEqual(self.sku_cache.lookup('sku1',
+                                                   self.resolve(course_id)),
+                             course_id)
+        self.assertEqual(self.resolved, [course_id])
+        self.assertEqual(self.sku_cache.stats(),
+                         {'local_hits': 2,
+                          'shared_hits': 0,
+                          'negative_hits': 0,
+                          'misses': 1})
+
+    def test_shared(self):
+        course_id = 'course-v1:org+course+run1'
+        self.sku_cache.lookup('sku1', self.resolve(course_id))
+
+        # Another process finds the SKU in the cache.
+        other = SKUCache(timeout=60, negative_timeout=60, max_size=10)
+        self.assertEqual(other.lookup('sku1', self.resolve(None)),
+                         course_id)
+        self.assertEqual(self.resolved, [course_id])
+        self.assertEqual(other.stats()['shared_hits'], 1)
+
+    def test_negative(self):
+        self.sku_cache.negative_timeout = 0.1
+        self.assertIsNone(self.sku_cache.lookup('sku1', self.resolve(None)))
+        self.assertIsNone(self.sku_cache.lookup('sku1', self.resolve(None)))
+        self.assertEqual(self.resolved, [None])
+        self.assertEqual(self.sku_cache.stats()['negative_hits'], 1)
+
+        # Negative entries expire sooner.
+        time.sleep(0.2)
+        cache.clear()
+        course_id = 'course-v1:org+course+run1'
+        self.assertEqual(self.sku_cache.lookup('sku1',
+                                               self.resolve(course_id)),
+                         course_id)
+
+    def test_error(self):
+        def resolve():
+            raise HTTPError('503 Server Error')
+
+        with self.assertRaises(HTTPError):
+            self.sku_cache.lookup('sku1', resolve)
+        course_id = 'course-v1:org+course+run1'
+        self.assertEqual(self.sku_cache.lookup('sku1',
+                                               self.resolve(course_id)),
+                         course_id)
+
+    def test_lru(self):
+        for i in range(20):
+            self.sku_cache.lookup('sku%d' % i,
+                                  self.resolve('course-v1:org+c%d+run' % i))
+        self.assertEqual(len(self.sku_cache.local), 10)
+
+    def test_single_flight(self):
+        course_id = 'course-v1:org+course+run1'
+        results = []
+
+        def lookup():
+            results.append(self.sku_cache.lookup(
+                'sku1', self.resolve(course_id, delay=0.1)))
+
+        threads = [threading.Thread(target=lookup) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.resolved, [course_id])
+        self.assertEqual(results, [course_id] * 10)
+
+    def test_wait_for_other_process(self):
+        # Another process holds the lease on resolving the SKU, and
+        # stores the course ID in the cache shortly.
+        course_id = 'course-v1:org+course+run1'
+        cache.add(self.sku_cache.lease_key('sku1'), 1)
+        timer = threading.Timer(
+            0.1,
+            lambda: cache.set(self.sku_cache.cache_key('sku1'), course_id))
+        timer.start()
+        self.assertEqual(self.sku_cache.lookup('sku1', self.resolve(None)),
+                         course_id)
+        timer.join()
+        self.assertEqual(self.resolved, [])
+
+
+@override_settings(CACHES=LOCMEM_CACHES,
+                   WEBHOOK_RECEIVER_SKU_CACHE=True)
+class LookupCourseIdCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        reset_sku_cache()
+
+    def tearDown(self):
+        reset_sku_cache()
+
+    def register_redirect(self, m, sku, course_id):
+        lookup_url = '%s/%s' % (settings.WEBHOOK_RECEIVER_LMS_BASE_URL,
+                                sku)
+        found_url = '%s/courses/%s/about' % (settings.WEBHOOK_RECEIVER_LMS_BASE_URL,  # noqa: E501
+                                             course_id)
+        m.register_uri('HEAD',
+                       lookup_url,
+                       status_code=301,
+                       headers={'Location': found_url})
+        m.register_uri('HEAD',
+                       found_url,
+                       status_code=200)
+
+    def test_lookup(self):
+        course_id = 'course-v1:org+course+run1'
+        with requests_mock.Mocker() as m:
+            self.register_redirect(m, 'course001', course_id)
+            for i in range(3):
+                self.assertEqual(lookup_course_id('course001'), course_id)
+            self.assertEqual(m.call_count, 2)
+
+        # A different SKU prefix is a different SKU.
+        with self.settings(WEBHOOK_RECEIVER_SKU_PREFIX='sku/'):
+            with requests_mock.Mocker() as m:
+                self.register_redirect(m, 'sku/course001', course_id)
+                self.assertEqual(lookup_course_id('course001'), course_id)
+                self.assertEqual(m.call_count, 2)
+
+    def test_negative(self):
+        with requests_mock.Mocker() as m:
+            self.register_redirect(m, 'course001', 'somebrokencourseid')
+            for i in range(3):
+                with self.assertRaises(SKULookupException):
+                    lookup_course_id('course001')
+            self.assertEqual(m.call_count, 2)
+        self.assertEqual(get_sku_cache().stats()['negative_hits'], 2)
+
+    def test_disabled(self):
+        with self.settings(WEBHOOK_RECEIVER_SKU_CACHE=False):
+            self.assertIsNone(get_sku_cache())
@@ -0,0 +1,134 @@
+from __future__ import unicode_literals
+
+import datetime
+
+from io import StringIO
+from unittest.mock import Mock
+
+import requests_mock
+
+from django.conf import settings
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from webhook_receiver.celery import setup_periodic_tasks
+from webhook_receiver.models import SKUMapping
+from webhook_receiver.skumappings import known_skus, sync_sku_mappings
+from webhook_receiver.tasks import sync_sku_mappings as sync_task
+from webhook_receiver.utils import lookup_course_id
+from webhook_receiver_shopify.models import ShopifyOrder, ShopifyOrderItem
+
+
+def register_sku(m, sku, course_id=None, status_code=200):
+    """Register the redirect of a SKU to a course (or to a page that
+    isn't a course's)."""
+    lookup_url = '%s/%s' % (settings.WEBHOOK_RECEIVER_LMS_BASE_URL, sku)
+    found_url = '%s/courses/%s/about' % (settings.WEBHOOK_RECEIVER_LMS_BASE_URL,  # noqa: E501
+                                         course_id or 'somebrokencourseid')
+    m.register_uri('HEAD',
+                   lookup_url,
+                   status_code=301,
+                   headers={'Location': found_url})
+    m.register_uri('HEAD',
+                   found_url,
+                   status_code=status_code)
+
+
+@override_settings(WEBHOOK_RECEIVER_SKU_MAPPING=True)
+class LookupCourseIdMappingTest(TestCase):
+
+    def test_mapped(self):
+        SKUMapping.objects.create(sku='course001',
+                                  course_id='course-v1:org+course+run1')
+        with requests_mock.Mocker() as m:
+            self.assertEqual(lookup_course_id('course001'),
+                             'course-v1:org+course+run1')
+            self.assertEqual(m.call_count, 0)
+
+    def test_unmapped(self):
+        with requests_mock.Mocker() as m:
+            register_sku(m, 'course001', 'course-v1:org+course+run1')
+            self.assertEqual(lookup_course_id('course001'),
+                             'course-v1:org+course+run1')
+            self.assertEqual(m.call_count, 2)
+        self.assertEqual(SKUMapping.objects.get(sku='course001').course_id,
+                         'course-v1:org+course+run1')
+
+    def test_disabled(self):
+        SKUMapping.objects.create(sku='course001',
+                                  course_id='course-v1:org+course+run1')
+        with self.settings(WEBHOOK_RECEIVER_SKU_MAPPING=False):
+            with requests_mock.Mocker() as m:
+                register_sku(m, 'course001', 'course-v1:org+course+run2')
+                self.assertEqual(lookup_course_id('course001'),
+                                 'course-v1:org+course+run2')
+
+
+class SyncSKUMappingsTest(TestCase):
+
+    def setUp(self):
+        order = ShopifyOrder.objects.create(order_id=1)
+        for sku in ('course001', 'course002', 'course-v1:org+course+run3'):
+            ShopifyOrderItem.objects.create(order=order,
+                                            sku=sku,
+                                            email='learner@example.com')
+        SKUMapping.objects.create(sku='course003',
+                                  course_id='course-v1:org+course+run3')
+
+    def test_known_skus(self):
+        self.assertEqual(known_skus(),
+                         {'course001', 'course002', 'course003'})
+
+    def test_sync(self):
+        with requests_mock.Mocker() as m:
+            register_sku(m, 'course001', 'course-v1:org+course+run1')
+            register_sku(m, 'course002')
+            register_sku(m, 'course004', 'course-v1:org+course+run4',
+                         status_code=500)
+            counts = sync_sku_mappings(skus=['course001',
+                                             'course002',
+                                             'course003',
+                                             'course004'],
+                                       parallelism=2)
+
+        # course003 has been resolved recently.
+        self.assertEqual(counts, {'updated': 1, 'unmapped': 1, 'failed': 1})
+        self.assertEqual(
+            dict(SKUMapping.objects.values_list('sku', 'course_id')),
+            {'course001': 'course-v1:org+course+run1',
+             'course003': 'course-v1:org+course+run3'})
+
+    def test_stale(self):
+        SKUMapping.objects.filter(sku='course003').update(
+            resolved=timezone.now() - datetime.timedelta(days=2))
+        with requests_mock.Mocker() as m:
+            register_sku(m, 'course001', 'course-v1:org+course+run1')
+            register_sku(m, 'course002', 'course-v1:org+course+run2')
+            register_sku(m, 'course003', 'course-v1:org+course+run33')
+            self.assertEqual(sync_task.delay().get(),
+                             {'updated': 3, 'unmapped': 0, 'failed': 0})
+        self.assertEqual(SKUMapping.objects.get(sku='course003').course_id,
+                         'course-v1:org+course+run33')
+
+    def test_command(self):
+        out = StringIO()
+        with requests_mock.Mocker() as m:
+            register_sku(m, 'course003', 'course-v1:org+course+run33')
+            call_command('sync_sku_mappings', 'course003', '--all',
+                         stdout=out)
+        self.assertIn('Updated 1, unmapped 0, failed to resolve 0 SKUs.',
+                      out.getvalue())
+        self.assertEqual(SKUMapping.objects.get(sku='course003').course_id,
+                         'course-v1:org+course+run33')
+
+    def test_periodic_task(self):
+        sender = Mock()
+        setup_periodic_tasks(sender)
+        sender.add_periodic_task.assert_not_called()
+
+        with self.settings(WEBHOOK_RECEIVER_SKU_SYNC_INTERVAL=3600):
+            setup_periodic_tasks(sender)
+        sender.signature.assert_called_once_with(
+            'webhook_receiver.tasks.sync_sku_mappings')
+        self.assertEqual(sender.add_periodic_task.call_args[0][0], 3600)
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import base64
+import fcntl
+import glob
+import hashlib
+import hmac
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from io import StringIO
+from unittest.mock import patch
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import OperationalError
+from django.test import Client, TestCase, override_settings
+
+from webhook_receiver.models import JSONWebhookData
+from webhook_receiver.spool import Spool, get_spool, drain
+from webhook_receiver.spool import closed_segments, read_segment
+from webhook_receiver_shopify.models import ShopifyOrder
+
+import requests_mock
+
+from . import ShopifyTestCase
+
+
+def record(body=b'{"id": 1}'):
+    return {
+        'task': 'webhook_receiver_shopify.tasks.dispatch',
+        'status': JSONWebhookData.PROCESSED,
+        'received': '2026-01-01T00:00:00',
+        'source': '127.0.0.1',
+        'headers': {},
+        'body': base64.b64encode(body).decode(),
+    }
+
+
+class SpoolTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def segments(self):
+        return glob.glob(os.path.join(self.directory, '*.spool'))
+
+    def test_append(self):
+        spool = Spool(self.directory)
+        spool.append(record())
+        spool.append(record())
+        spool.close()
+
+        segments = self.segments()
+        self.assertEqual(len(segments), 1)
+        records = read_segment(segments[0])
+        self.assertEqual(len(records), 2)
+        task, data = records[0]
+        self.assertEqual(task, 'webhook_receiver_shopify.tasks.dispatch')
+        self.assertEqual(data.content, {'id': 1})
+        self.assertEqual(data.status, JSONWebhookData.PROCESSED)
+
+    def test_group_fsync(self):
+        # Concurrent appends should share fsync() calls.
+        spool = Spool(self.directory, fsync_interval=0.05)
+        threads = [threading.Thread(target=spool.append, args=(record(),))
+                   for i in range(10)]
+        with patch('webhook_receiver.spool.os.fsync') as fsync:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertLess(fsync.call_count, 10)
+        self.assertEqual(spool.synced, 10)
+        spool.close()
+
+    def test_segment_age(self):
+        spool = Spool(self.directory, segment_age=0.1)
+        spool.append(record())
+        time.sleep(0.2)
+        spool.append(record())
+        # The first segment has been closed before we append to the
+        # second.
+        self.assertEqual(len(list(closed_segments(self.directory))), 1)
+        spool.close()
+        self.assertEqual(len(list(closed_segments(self.directory))), 2)
+
+    def test_segment_age_without_appends(self):
+        # A segment becomes drainable once it reaches its age, even if
+        # we don't spool anything else.
+        spool = Spool(self.directory, segment_age=0.1)
+        spool.append(record())
+        self.assertEqual(list(closed_segments(self.directory)), [])
+        time.sleep(0.3)
+        self.assertEqual(len(list(closed_segments(self.directory))), 1)
+        self.assertIsNone(spool.file)
+
+    def test_open_segment_skipped(self):
+        spool = Spool(self.directory)
+        spool.append(record())
+        self.assertEqual(len(self.segments()), 1)
+        self.assertEqual(list(closed_segments(self.directory)), [])
+        self.assertEqual(drain(self.directory), 0)
+        spool.close()
+
+    def test_removed_before_listing(self):
+        # Another drainer removes a segment while we list them.
+        spool = Spool(self.directory)
+        spool.append(record())
+        spool.close()
+
+        with patch('webhook_receiver.spool.os.path.getmtime',
+                   side_effect=FileNotFoundError):
+            with patch('webhook_receiver.spool.open',
+                       side_effect=FileNotFoundError, create=True):
+                self.assertEqual(list(closed_segments(self.directory)), [])
+
+    def test_removed_before_locking(self):
+        # Another drainer drains and removes a segment after we open
+        # it, but before we lock it.
+        spool = Spool(self.directory)
+        spool.append(record())
+        spool.close()
+        path = self.segments()[0]
+
+        def flock(fd, operation):
+            os.remove(path)
+            return fcntl_flock(fd, operation)
+
+        fcntl_flock = fcntl.flock
+        with patch('webhook_receiver.spool.fcntl.flock', flock):
+            self.assertEqual(list(closed_segments(self.directory)), [])
+
+    def test_incomplete_record(self):
+        spool = Spool(self.directory)
+        spool.append(record())
+        spool.close()
+        # Simulate a writer that crashed mid-append.
+        with open(self.segments()[0], 'ab') as f:
+            f.write(b'{"task": "webhook_rec')
+        self.assertEqual(len(read_segment(self.segments()[0])), 1)
+
+    @patch('webhook_receiver_shopify.tasks.dispatch.delay')
+    def test_drain(self, delay):
+        spool = Spool(self.directory)
+        spool.append(record())
+        spool.append(record(b'{"id": 2}'))
+        spool.close()
+
+        self.assertEqual(drain(self.directory), 2)
+        self.assertEqual(self.segments(), [])
+        webhooks = JSONWebhookData.objects.order_by('id')
+        self.assertEqual([w.content['id'] for w in webhooks], [1, 2])
+        self.assertEqual(delay.call_count, 2)
+        delay.assert_any_call(webhooks[0].id)
+
+    def test_drain_command_unconfigured(self):
+        with self.assertRaises(CommandError):
+            call_command('drain_webhook_spool')
+
+
+class ShopifySpoolTest(ShopifyTestCase):
+    """Test that we spool Shopify webhooks when the database is
+    unavailable, and process them once we drain the spool."""
+
+    def setUp(self):
+        self.setup_payload()
+        self.setup_requests()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.client = Client()
+
+        conf = settings.WEBHOOK_RECEIVER_SETTINGS['shopify']
+        correct_hash = hmac.new(conf['api_key'].encode('utf-8'),
+                                self.raw_payload,
+                                hashlib.sha256).digest()
+        self.correct_signature = base64.b64encode(correct_hash).decode()
+
+    def post(self):
+        return self.client.post('/webhooks/shopify/order/create',
+                                self.raw_payload,
+                                content_type='application/json',
+                                HTTP_X_SHOPIFY_HMAC_SHA256=self.correct_signature,  # noqa: E501
+                                HTTP_X_SHOPIFY_SHOP_DOMAIN='example.com')
+
+    def test_database_unavailable(self):
+        with override_settings(WEBHOOK_RECEIVER_SPOOL_DIR=self.directory):
+            with patch.object(JSONWebhookData, 'save',
+                              side_effect=OperationalError):
+                response = self.post()
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse(JSONWebhookData.objects.exists())
+            self.assertFalse(ShopifyOrder.objects.exists())
+
+            # Once we save a webhook to the database again, the spool
+            # segment becomes available for draining.
+            with requests_mock.Mocker() as m:
+                m.register_uri('POST',
+                               self.token_uri,
+                               json=self.token_response)
+                m.register_uri('POST',
+                               self.enroll_uri,
+                               json={})
+                response = self.post()
+                self.assertEqual(response.status_code, 200)
+                self.assertIsNone(get_spool().file)
+
+                out = StringIO()
+                call_command('drain_webhook_spool', stdout=out)
+            self.assertIn('Drained 1 webhooks.', out.getvalue())
+
+        self.assertEqual(JSONWebhookData.objects.count(), 2)
+        order = ShopifyOrder.objects.get()
+        self.assertEqual(order.status, ShopifyOrder.PROCESSED)
+
+    def test_database_unavailable_without_spool(self):
+        with patch.object(JSONWebhookData, 'save',
+                          side_effect=OperationalError):
+            response = self.post()
+        self.assertEqual(response.status_code, 400)
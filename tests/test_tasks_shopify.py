@@ -3,16 +3,26 @@ from __future__ import unicode_literals
 
 import json
 
+from urllib.parse import parse_qs
+
 from requests.exceptions import HTTPError
 
+from django.core.cache import cache
+from django.test import override_settings
+
 from webhook_receiver.models import JSONWebhookData
+from webhook_receiver.sharedset import reset_shared_sets
 
 from webhook_receiver_shopify.models import ShopifyOrder as Order
-from webhook_receiver_shopify.tasks import process
+from webhook_receiver_shopify.models import ShopifyOrderItem as OrderItem
+from webhook_receiver_shopify.tasks import process, schedule_order
+from webhook_receiver_shopify.tasks import aschedule_order
 from webhook_receiver_shopify.utils import record_order
 
 import requests_mock
 
+from .test_sharedset import LOCMEM_CACHES
+from .test_utils import bulk_enroll_response
 from . import ShopifyTestCase
 
 
@@ -159,3 +169,108 @@ class ProcessOrderTest(ShopifyTestCase):
         # because of the FSM-protected status field)
         order = Order.objects.get(pk=order.id)
         self.assertEqual(order.status, Order.PROCESSED)
+
+    def test_send_email(self):
+        # Whether the LMS emails the learners we enroll is up to the
+        # shop, however we enroll them.
+        for options in ({},
+                        {'WEBHOOK_RECEIVER_BATCH_ENROLLMENT': True},
+                        {'WEBHOOK_RECEIVER_LINE_ITEM_CONCURRENCY': 2}):
+            OrderItem.objects.all().delete()
+            Order.objects.all().delete()
+            record_order(self.webhook_data)
+            with self.settings(**options), requests_mock.Mocker() as m:
+                m.register_uri('POST',
+                               self.token_uri,
+                               json=self.token_response)
+                m.register_uri('POST',
+                               self.enroll_uri,
+                               json=bulk_enroll_response)
+                process.delay(self.json_payload, False).get(5)
+            enroll_requests = [r for r in m.request_history
+                               if r.url == self.enroll_uri]
+            self.assertTrue(enroll_requests)
+            for request in enroll_requests:
+                self.assertEqual(parse_qs(request.text)['email_students'],
+                                 ['False'])
+
+
+@override_settings(WEBHOOK_RECEIVER_PROCESSED_ORDER_CACHE=True,
+                   CACHES=LOCMEM_CACHES)
+class ScheduleOrderTest(ShopifyTestCase):
+
+    def setUp(self):
+        self.setup_payload()
+        self.setup_webhook_data()
+        self.setup_requests()
+        reset_shared_sets()
+        cache.clear()
+
+    def schedule(self):
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json={})
+            return schedule_order(self.webhook_data)
+
+    def test_processed_order(self):
+        order = self.schedule()
+        order = Order.objects.get(pk=order.id)
+        self.assertEqual(order.status, Order.PROCESSED)
+
+        # We know the order is processed, so we don't even look it
+        # up again, in this process or in any other.
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.schedule())
+        reset_shared_sets()
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.schedule())
+
+    def test_previously_processed_order(self):
+        with override_settings(WEBHOOK_RECEIVER_PROCESSED_ORDER_CACHE=False):
+            self.schedule()
+        # The first lookup finds the order processed, and remembers
+        # that.
+        self.assertIsNotNone(self.schedule())
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.schedule())
+
+    def test_other_shop(self):
+        self.schedule()
+        # Another shop's order with the same ID is a different order,
+        # which we process, too.
+        self.webhook_data.headers = {'X-Shopify-Shop-Domain': 'example.org'}
+        order = self.schedule()
+        self.assertIsNotNone(order)
+        order = Order.objects.get(pk=order.id)
+        self.assertEqual(order.shop, 'example.org')
+        self.assertEqual(order.status, Order.PROCESSED)
+        self.assertEqual(Order.objects.count(), 2)
+
+    def test_failed_order(self):
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           status_code=400)
+            order = schedule_order(self.webhook_data)
+        order = Order.objects.get(pk=order.id)
+        self.assertEqual(order.status, Order.ERROR)
+        # An order that failed is looked up every time.
+        self.assertIsNotNone(self.schedule())
+
+    async def test_async(self):
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json={})
+            self.assertIsNotNone(await aschedule_order(self.webhook_data))
+            self.assertIsNone(await aschedule_order(self.webhook_data))
@@ -1,13 +1,89 @@
 from __future__ import unicode_literals
 
+import threading
+
+from unittest.mock import patch
+
 from django.conf import settings
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
 
+from webhook_receiver.models import JSONWebhookData, SKUMapping
+from webhook_receiver.signing import Verifier
 from webhook_receiver.utils import hmac_is_valid, lookup_course_id
+from webhook_receiver.utils import receive_json_webhook
+from webhook_receiver.utils import fail_and_save, finish_and_save
+from webhook_receiver.utils import read_signed_body
+from webhook_receiver.utils import InvalidWebhookException
+from webhook_receiver.utils import OversizedWebhookException
 from webhook_receiver.utils import SKULookupException
+from webhook_receiver.utils import EnrollmentException
+from webhook_receiver.utils import enroll_order_items, enrollment_batches
+from webhook_receiver.utils import process_order_items
+from webhook_receiver.utils import delivery_key
+from webhook_receiver_shopify.models import ShopifyOrder, ShopifyOrderItem
 
 import requests_mock
-from requests.exceptions import HTTPError
+from requests.exceptions import HTTPError, TooManyRedirects
+
+from urllib.parse import parse_qs
+
+
+def count_writes(queries):
+    """Count the INSERT and UPDATE statements in captured queries."""
+    return len([q for q in queries
+                if q['sql'].startswith(('INSERT', 'UPDATE'))])
+
+
+class ReceiveJSONWebhookTest(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.verifier = Verifier(['hello'])
+
+    def post(self, body):
+        return self.factory.post('/webhooks/shopify/order/create',
+                                 body,
+                                 content_type='application/json')
+
+    def test_receive(self):
+        with CaptureQueriesContext(connection) as queries:
+            data = receive_json_webhook(self.post(b'{"id": 1}'))
+            finish_and_save(data)
+        self.assertEqual(count_writes(queries), 4)
+        data = JSONWebhookData.objects.get(pk=data.pk)
+        self.assertEqual(data.status, JSONWebhookData.PROCESSED)
+        self.assertEqual(data.content, {'id': 1})
+
+    @override_settings(WEBHOOK_RECEIVER_SINGLE_WRITE=True)
+    def test_receive_single_write(self):
+        with CaptureQueriesContext(connection) as queries:
+            data = receive_json_webhook(self.post(b'{"id": 1}'))
+            self.assertIsNone(data.pk)
+            finish_and_save(data)
+        self.assertEqual(count_writes(queries), 1)
+        data = JSONWebhookData.objects.get(pk=data.pk)
+        self.assertEqual(data.status, JSONWebhookData.PROCESSED)
+        self.assertEqual(data.source, '127.0.0.1')
+        self.assertEqual(data.content, {'id': 1})
+
+    @override_settings(WEBHOOK_RECEIVER_SINGLE_WRITE=True)
+    def test_receive_single_write_fail(self):
+        with CaptureQueriesContext(connection) as queries:
+            data = receive_json_webhook(self.post(b'{"id": 1}'))
+            fail_and_save(data)
+        self.assertEqual(count_writes(queries), 1)
+        data = JSONWebhookData.objects.get(pk=data.pk)
+        self.assertEqual(data.status, JSONWebhookData.ERROR)
+
+    @override_settings(WEBHOOK_RECEIVER_SINGLE_WRITE=True)
+    def test_receive_single_write_corrupt(self):
+        with self.assertRaises(ValueError):
+            receive_json_webhook(self.post(b'{'))
+        data = JSONWebhookData.objects.get()
+        self.assertEqual(data.status, JSONWebhookData.ERROR)
+        self.assertEqual(bytes(data.body), b'{')
 
 
 class SignatureVerificationTest(TestCase):
@@ -44,6 +120,64 @@ class SignatureVerificationTest(TestCase):
             self.assertFalse(hmac_is_valid(*triplet))
 
 
+@override_settings(WEBHOOK_RECEIVER_MAX_BODY_SIZE=1024)
+class ReadSignedBodyTest(TestCase):
+
+    SIGNATURE = '8ayXAutfryPKKRpNxG3t3u4qeMza8KQSvtdxTP/7HMQ='
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.verifier = Verifier(['hello'])
+
+    def post(self, body):
+        return self.factory.post('/webhooks/shopify/order/create',
+                                 body,
+                                 content_type='application/json')
+
+    def test_read(self):
+        body, digest = read_signed_body(self.post(b'world'),
+                                        self.verifier,
+                                        self.SIGNATURE)
+        self.assertEqual(body, b'world')
+        self.assertTrue(self.verifier.verify(body, self.SIGNATURE, digest))
+        self.assertFalse(self.verifier.verify(body,
+                                              'x%s' % self.SIGNATURE,
+                                              digest))
+
+    def test_read_chunked(self):
+        body = b'x' * 1000
+        with self.settings(WEBHOOK_RECEIVER_MAX_BODY_SIZE=len(body)):
+            with patch('webhook_receiver.utils.BODY_CHUNK_SIZE', 7):
+                read_body, digest = read_signed_body(self.post(body),
+                                                     self.verifier,
+                                                     self.SIGNATURE)
+        self.assertEqual(read_body, body)
+        self.assertEqual(digest, self.verifier.sign(body))
+
+    def test_malformed_signature(self):
+        for hmac_to_verify in ('', 'world', '-%s' % self.SIGNATURE[1:]):
+            request = self.post(b'world')
+            with self.assertRaises(InvalidWebhookException):
+                read_signed_body(request, self.verifier, hmac_to_verify)
+            # We must not even have started reading the body.
+            self.assertEqual(request.read(), b'world')
+
+    def test_oversized_content_length(self):
+        request = self.post(b'x' * 1025)
+        with self.assertRaises(OversizedWebhookException):
+            read_signed_body(request, self.verifier, self.SIGNATURE)
+        self.assertEqual(len(request.read()), 1025)
+
+    def test_oversized_body(self):
+        # A request that does not declare its body length is cut off
+        # once it has exceeded the maximum.
+        request = self.post(b'x' * 100000)
+        del request.META['CONTENT_LENGTH']
+        with self.assertRaises(OversizedWebhookException):
+            read_signed_body(request, self.verifier, self.SIGNATURE)
+        self.assertGreater(len(request.read()), 0)
+
+
 class SKULookupTest(TestCase):
 
     def test_sku_roundtrip(self):
@@ -116,3 +250,356 @@ class SKULookupTest(TestCase):
                            status_code=200)
             with self.assertRaises(SKULookupException):
                 lookup_course_id(sku)
+
+
+@override_settings(WEBHOOK_RECEIVER_SKU_SINGLE_HOP=True)
+class SingleHopSKULookupTest(TestCase):
+
+    def setUp(self):
+        self.lookup_url = '%s/%s' % (settings.WEBHOOK_RECEIVER_LMS_BASE_URL,
+                                     'course001')
+
+    def test_single_hop(self):
+        """Do we stop at the first redirect that points to a course,
+        without requesting the course page?"""
+        course_id = 'course-v1:org+course+run1'
+        found_url = '%s/courses/%s/about' % (settings.WEBHOOK_RECEIVER_LMS_BASE_URL,  # noqa: E501
+                                             course_id)
+        with requests_mock.Mocker() as m:
+            m.register_uri('HEAD',
+                           self.lookup_url,
+                           status_code=301,
+                           headers={'Location': found_url})
+            self.assertEqual(lookup_course_id('course001'), course_id)
+            self.assertEqual(m.call_count, 1)
+
+    def test_relative_redirects(self):
+        """Do we follow redirects that don't point to a course, and
+        resolve relative locations?"""
+        course_id = 'course-v1:org+course+run1'
+        with requests_mock.Mocker() as m:
+            m.register_uri('HEAD',
+                           self.lookup_url,
+                           status_code=302,
+                           headers={'Location': '/sku/course001'})
+            m.register_uri('HEAD',
+                           '%s/sku/course001' % settings.WEBHOOK_RECEIVER_LMS_BASE_URL,  # noqa: E501
+                           status_code=302,
+                           headers={'Location': '/courses/%s/' % course_id})
+            self.assertEqual(lookup_course_id('course001'), course_id)
+            self.assertEqual(m.call_count, 2)
+
+    def test_no_course(self):
+        """Do we throw a SKULookupException when the redirects end at a
+        page that isn't a course's?"""
+        found_url = '%s/dashboard' % settings.WEBHOOK_RECEIVER_LMS_BASE_URL
+        with requests_mock.Mocker() as m:
+            m.register_uri('HEAD',
+                           self.lookup_url,
+                           status_code=301,
+                           headers={'Location': found_url})
+            m.register_uri('HEAD',
+                           found_url,
+                           status_code=200)
+            with self.assertRaises(SKULookupException):
+                lookup_course_id('course001')
+
+    def test_not_found(self):
+        """Do we throw an HTTPError when the SKU does not redirect?"""
+        with requests_mock.Mocker() as m:
+            m.register_uri('HEAD',
+                           self.lookup_url,
+                           status_code=404)
+            with self.assertRaises(HTTPError):
+                lookup_course_id('course001')
+
+    def test_redirect_loop(self):
+        """Do we give up on a redirect loop?"""
+        with requests_mock.Mocker() as m:
+            m.register_uri('HEAD',
+                           self.lookup_url,
+                           status_code=302,
+                           headers={'Location': self.lookup_url})
+            with self.assertRaises(TooManyRedirects):
+                lookup_course_id('course001')
+
+
+def bulk_enroll_response(request, context, fail=()):
+    """Respond to a bulk enrollment request like the API does,
+    failing to enroll the given identifiers."""
+    params = parse_qs(request.text)
+    courses = {}
+    for course_id in params['courses'][0].split(','):
+        results = []
+        for identifier in params['identifiers'][0].split(','):
+            if identifier in fail:
+                results.append({'identifier': identifier, 'error': True})
+            else:
+                results.append({'identifier': identifier,
+                                'before': {'enrollment': False},
+                                'after': {'enrollment': True}})
+        courses[course_id] = {'action': 'enroll', 'results': results}
+    return {'action': 'enroll', 'courses': courses}
+
+
+class EnrollmentBatchesTest(TestCase):
+
+    def test_batches(self):
+        enrollments = [
+            ('course-v1:org+a+run', 'one@example.com'),
+            ('course-v1:org+a+run', 'two@example.com'),
+            ('course-v1:org+b+run', 'one@example.com'),
+            ('course-v1:org+b+run', 'two@example.com'),
+            ('course-v1:org+c+run', 'one@example.com'),
+        ]
+        self.assertCountEqual(enrollment_batches(enrollments), [
+            (['course-v1:org+a+run', 'course-v1:org+b+run'],
+             ['one@example.com', 'two@example.com']),
+            (['course-v1:org+c+run'], ['one@example.com']),
+        ])
+
+
+class DeliveryKeyTest(TestCase):
+
+    def test_delivery_key(self):
+        header = 'X-Wc-Webhook-Delivery-Id'
+        shop_header = 'X-Wc-Webhook-Source'
+        key1 = delivery_key({header: '1',
+                             shop_header: 'https://example.com'},
+                            header, shop_header)
+        key2 = delivery_key({header: '1',
+                             shop_header: 'https://example.org'},
+                            header, shop_header)
+        self.assertEqual(key1, ('https://example.com', '1'))
+        # The same delivery ID from another shop is another delivery.
+        self.assertNotEqual(key1, key2)
+        self.assertIsNone(delivery_key({shop_header: 'https://example.com'},
+                                       header, shop_header))
+
+
+class EnrollOrderItemsTest(TestCase):
+
+    def setUp(self):
+        self.token_uri = '%s/oauth2/access_token' % settings.WEBHOOK_RECEIVER_LMS_BASE_URL  # noqa: E501
+        self.enroll_uri = '%s/api/bulk_enroll/v1/bulk_enroll' % settings.WEBHOOK_RECEIVER_LMS_BASE_URL  # noqa: E501
+        self.order = ShopifyOrder.objects.create(order_id=50)
+        self.order_items = []
+        for i in range(40):
+            self.add_item('course-v1:org+course+run1',
+                          'learner%d@example.com' % i)
+
+    def add_item(self, sku, email):
+        order_item = ShopifyOrderItem.objects.create(order=self.order,
+                                                     sku=sku,
+                                                     email=email)
+        order_item.start_processing()
+        order_item.save()
+        self.order_items.append(order_item)
+        return order_item
+
+    def enroll(self, fail=()):
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json={'access_token': 'foobar',
+                                 'expires_in': 3600})
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json=lambda request, context: bulk_enroll_response(
+                               request, context, fail))
+            try:
+                enroll_order_items(self.order_items)
+            finally:
+                self.enroll_requests = [r for r in m.request_history
+                                        if r.url == self.enroll_uri]
+
+    def statuses(self):
+        return [ShopifyOrderItem.objects.get(pk=order_item.pk).status
+                for order_item in self.order_items]
+
+    def test_single_request(self):
+        self.enroll()
+        self.assertEqual(len(self.enroll_requests), 1)
+        self.assertEqual(set(self.statuses()), {ShopifyOrderItem.PROCESSED})
+
+    def test_distinct_emails(self):
+        self.add_item('course-v1:org+course+run2', 'learner0@example.com')
+        self.enroll()
+        self.assertEqual(len(self.enroll_requests), 2)
+        self.assertEqual(set(self.statuses()), {ShopifyOrderItem.PROCESSED})
+
+    def test_failed_identifier(self):
+        with self.assertRaises(EnrollmentException):
+            self.enroll(fail=('learner1@example.com',))
+        statuses = self.statuses()
+        self.assertEqual(statuses[1], ShopifyOrderItem.ERROR)
+        self.assertEqual(statuses.count(ShopifyOrderItem.PROCESSED), 39)
+
+    def test_invalid_email(self):
+        order_item = self.add_item('course-v1:org+course+run1',
+                                   'akjzcdfbgakugbfvkljzgh')
+        with self.assertRaises(EnrollmentException):
+            self.enroll()
+        self.assertEqual(len(self.enroll_requests), 1)
+        self.assertNotIn(order_item.email, self.enroll_requests[0].text)
+        self.assertEqual(self.statuses()[-1], ShopifyOrderItem.ERROR)
+
+    def test_http_error(self):
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json={'access_token': 'foobar',
+                                 'expires_in': 3600})
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           status_code=500)
+            with self.assertRaises(HTTPError):
+                enroll_order_items(self.order_items)
+        # We retry the items that are still processing.
+        self.assertEqual(set(self.statuses()),
+                         {ShopifyOrderItem.PROCESSING})
+
+
+@override_settings(WEBHOOK_RECEIVER_ENROLLMENT_WINDOW=0.001)
+class CoalescedEnrollOrderItemsTest(EnrollOrderItemsTest):
+    """Run all enrollment tests through the enrollment coalescer."""
+
+
+@override_settings(WEBHOOK_RECEIVER_LINE_ITEM_CONCURRENCY=4)
+class ProcessOrderItemsTest(TestCase):
+
+    def setUp(self):
+        self.token_uri = '%s/oauth2/access_token' % settings.WEBHOOK_RECEIVER_LMS_BASE_URL  # noqa: E501
+        self.enroll_uri = '%s/api/bulk_enroll/v1/bulk_enroll' % settings.WEBHOOK_RECEIVER_LMS_BASE_URL  # noqa: E501
+        self.order = ShopifyOrder.objects.create(order_id=60)
+        self.order_items = []
+        for i in range(4):
+            order_item = ShopifyOrderItem.objects.create(
+                order=self.order,
+                sku='course-v1:org+course+run%d' % i,
+                email='learner@example.com')
+            order_item.start_processing()
+            order_item.save()
+            self.order_items.append(order_item)
+
+    def process(self, enroll):
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json={'access_token': 'foobar',
+                                 'expires_in': 3600})
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json=enroll)
+            process_order_items(self.order_items)
+
+    def statuses(self):
+        return [order_item.status
+                for order_item in ShopifyOrderItem.objects.order_by('id')]
+
+    def test_concurrent(self):
+        # Each enrollment only completes once all of them are being
+        # sent.
+        # (requests_mock handles one request at a time, so we stand
+        # in for enroll_in_course() itself.)
+        barrier = threading.Barrier(4, timeout=5)
+
+        def enroll_in_course(course_id, email, send_email):
+            barrier.wait()
+
+        with patch('webhook_receiver.utils.enroll_in_course',
+                   enroll_in_course):
+            process_order_items(self.order_items)
+        self.assertEqual(self.statuses(), [ShopifyOrderItem.PROCESSED] * 4)
+
+    def use_skus(self, skus):
+        for i, (order_item, sku) in enumerate(zip(self.order_items, skus)):
+            order_item.sku = sku
+            order_item.email = 'learner%d@example.com' % i
+            order_item.save()
+
+    @override_settings(WEBHOOK_RECEIVER_SKU_MAPPING=True)
+    def test_resolve_concurrent(self):
+        # Each distinct SKU is resolved once, and each resolution only
+        # completes once both of them are being resolved. The SKU
+        # mappings are recorded in the calling thread.
+        self.use_skus(['course001', 'course002', 'course001', 'course002'])
+        barrier = threading.Barrier(2, timeout=5)
+        resolved = []
+        enrolled = []
+
+        def resolve_sku(sku):
+            resolved.append(sku)
+            barrier.wait()
+            return 'course-v1:org+course+%s' % sku
+
+        def enroll_in_course(course_id, email, send_email):
+            enrolled.append(course_id)
+
+        with patch('webhook_receiver.utils.resolve_sku', resolve_sku):
+            with patch('webhook_receiver.utils.enroll_in_course',
+                       enroll_in_course):
+                process_order_items(self.order_items)
+        self.assertCountEqual(resolved, ['course001', 'course002'])
+        self.assertCountEqual(enrolled,
+                              ['course-v1:org+course+course001',
+                               'course-v1:org+course+course002'] * 2)
+        self.assertEqual(
+            dict(SKUMapping.objects.values_list('sku', 'course_id')),
+            {'course001': 'course-v1:org+course+course001',
+             'course002': 'course-v1:org+course+course002'})
+        self.assertEqual(self.statuses(), [ShopifyOrderItem.PROCESSED] * 4)
+
+    def test_unresolved_sku(self):
+        # The order items whose SKU we can't resolve are not enrolled.
+        self.use_skus(['course001', 'course002', 'course001'])
+        enrolled = []
+
+        def resolve_sku(sku):
+            if sku == 'course001':
+                return None
+            return 'course-v1:org+course+%s' % sku
+
+        def enroll_in_course(course_id, email, send_email):
+            enrolled.append(course_id)
+
+        with patch('webhook_receiver.utils.resolve_sku', resolve_sku):
+            with patch('webhook_receiver.utils.enroll_in_course',
+                       enroll_in_course):
+                with self.assertRaises(SKULookupException):
+                    process_order_items(self.order_items)
+        self.assertCountEqual(enrolled,
+                              ['course-v1:org+course+course002',
+                               'course-v1:org+course+run3'])
+        self.assertEqual(self.statuses(),
+                         [ShopifyOrderItem.PROCESSING,
+                          ShopifyOrderItem.PROCESSED,
+                          ShopifyOrderItem.PROCESSING,
+                          ShopifyOrderItem.PROCESSED])
+
+    def test_retryable_error_first(self):
+        # run1 fails with an error that we don't retry on, and
+        # run3 with one that we do.
+        def enroll(request, context):
+            if 'run1' in request.text:
+                raise ConnectionError('Connection refused')
+            if 'run3' in request.text:
+                context.status_code = 503
+            return {}
+
+        with self.assertRaises(HTTPError):
+            self.process(enroll)
+        self.assertEqual(self.statuses(),
+                         [ShopifyOrderItem.PROCESSED,
+                          ShopifyOrderItem.PROCESSING,
+                          ShopifyOrderItem.PROCESSED,
+                          ShopifyOrderItem.PROCESSING])
+
+    def test_first_error(self):
+        def enroll(request, context):
+            if 'run1' in request.text or 'run2' in request.text:
+                raise ConnectionError(request.text)
+            return {}
+
+        with self.assertRaisesRegex(ConnectionError, 'run1'):
+            self.process(enroll)
@@ -2,13 +2,17 @@ from __future__ import unicode_literals
 
 import json
 
+from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.test import override_settings
 
 from requests.exceptions import HTTPError
 
 from webhook_receiver.models import JSONWebhookData
+from webhook_receiver.utils import EnrollmentException
+from webhook_receiver.utils import InvalidWebhookException, get_hmac
 
-from webhook_receiver_shopify.utils import record_order
+from webhook_receiver_shopify.utils import record_order, verify_webhook
 from webhook_receiver_shopify.utils import process_order, process_line_item
 from webhook_receiver_shopify.models import ShopifyOrder as Order
 from webhook_receiver_shopify.models import ShopifyOrderItem as OrderItem
@@ -16,6 +20,7 @@ from webhook_receiver_shopify.models import ShopifyOrderItem as OrderItem
 import requests_mock
 
 from . import ShopifyTestCase
+from .test_utils import bulk_enroll_response
 
 
 class RecordOrderTest(ShopifyTestCase):
@@ -29,13 +34,29 @@ class RecordOrderTest(ShopifyTestCase):
         # that in the payload
         order1, created1 = record_order(self.webhook_data)
         self.assertTrue(created1)
-        self.assertEqual(order1.id, self.json_payload['id'])
+        self.assertEqual(order1.order_id, self.json_payload['id'])
         # Try to create the order again, make sure we get a reference
         # instead
         order2, created2 = record_order(self.webhook_data)
         self.assertFalse(created2)
         self.assertEqual(order1, order2)
 
+    def test_record_order_per_shop(self):
+        # Different shops may send orders with the same ID, which are
+        # different orders.
+        orders = []
+        for shop in ('example.com', 'example.org'):
+            self.webhook_data.headers = {'X-Shopify-Shop-Domain': shop}
+            order, created = record_order(self.webhook_data)
+            self.assertTrue(created)
+            self.assertEqual(order.shop, shop)
+            self.assertEqual(order.order_id, self.json_payload['id'])
+            orders.append(order)
+        self.assertNotEqual(orders[0], orders[1])
+        # We log orders as the shops know them.
+        self.assertEqual(str(orders[1]),
+                         '%s from example.org' % self.json_payload['id'])
+
 
 class ProcessOrderTest(ShopifyTestCase):
 
@@ -120,6 +141,92 @@ class ProcessOrderTest(ShopifyTestCase):
         self.test_valid_order()
 
 
+@override_settings(WEBHOOK_RECEIVER_BATCH_ENROLLMENT=True)
+class BatchProcessOrderTest(ProcessOrderTest):
+    """Run all order processing tests with batched enrollments."""
+
+    def test_valid_order(self):
+        # A single request enrolls the learner in all courses, so the
+        # response has results for all of them.
+        order, created = record_order(self.webhook_data)
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json=bulk_enroll_response)
+            process_order(order, self.json_payload)
+
+        self.assertEqual(order.status, Order.PROCESSED)
+
+    def test_single_request(self):
+        order, created = record_order(self.webhook_data)
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json=bulk_enroll_response)
+            process_order(order, self.json_payload)
+            enroll_requests = [r for r in m.request_history
+                               if r.url == self.enroll_uri]
+        self.assertEqual(len(enroll_requests), 1)
+        self.assertEqual(order.status, Order.PROCESSED)
+        self.assertEqual(set(OrderItem.objects.values_list('status',
+                                                           flat=True)),
+                         {OrderItem.PROCESSED})
+
+    def test_missing_results(self):
+        # Without results for a course, we can't tell whether its
+        # learners were enrolled.
+        order, created = record_order(self.webhook_data)
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json={'action': 'enroll', 'courses': {}})
+            with self.assertRaises(EnrollmentException):
+                process_order(order, self.json_payload)
+        self.assertEqual(set(OrderItem.objects.values_list('status',
+                                                           flat=True)),
+                         {OrderItem.ERROR})
+
+
+@override_settings(WEBHOOK_RECEIVER_LINE_ITEM_CONCURRENCY=4)
+class ConcurrentProcessOrderTest(ProcessOrderTest):
+    """Run all order processing tests with concurrent line items."""
+
+    def test_partial_failure(self):
+        order, created = record_order(self.webhook_data)
+
+        def enroll(request, context):
+            if 'run2' in request.text:
+                context.status_code = 503
+            return {}
+
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json=enroll)
+            with self.assertRaises(HTTPError):
+                process_order(order, self.json_payload)
+
+        # The order item that failed is left in PROCESSING, so that we
+        # process it again when we retry.
+        self.assertEqual(order.status, Order.PROCESSING)
+        self.assertEqual(
+            dict(OrderItem.objects.values_list('sku', 'status')),
+            {'course-v1:org+course+run1': OrderItem.PROCESSED,
+             'course-v1:org+course+run2': OrderItem.PROCESSING})
+
+
 class ProcessLineItemTest(ShopifyTestCase):
 
     def setUp(self):
@@ -127,7 +234,7 @@ class ProcessLineItemTest(ShopifyTestCase):
 
     def test_valid_single_line_item(self):
         order = Order()
-        order.id = 40
+        order.order_id = 40
         order.save()
         line_item = {
             "properties": [{"name": "email",
@@ -185,7 +292,7 @@ class ProcessLineItemTest(ShopifyTestCase):
 
     def test_invalid_line_item(self):
         order = Order()
-        order.id = 41
+        order.order_id = 41
         order.save()
         line_items = [{"sku": "course-v1:org+nosuchcourse+run1"},
                       {"properties": [{"name": "email",
@@ -196,7 +303,7 @@ class ProcessLineItemTest(ShopifyTestCase):
 
     def test_invalid_sku(self):
         order = Order()
-        order.id = 42
+        order.order_id = 42
         order.save()
         line_items = [{"properties": [{"name": "email",
                                        "value": "learner@example.com"}],
@@ -217,7 +324,7 @@ class ProcessLineItemTest(ShopifyTestCase):
 
     def test_invalid_email(self):
         order = Order()
-        order.id = 43
+        order.order_id = 43
         order.save()
         line_items = [{"properties": [{"name": "email",
                                        "value": "akjzcdfbgakugbfvkljzgh"}],
@@ -225,3 +332,36 @@ class ProcessLineItemTest(ShopifyTestCase):
         for line_item in line_items:
             with self.assertRaises(ValidationError):
                 process_line_item(order, line_item)
+
+
+class VerifyWebhookTest(ShopifyTestCase):
+
+    def setUp(self):
+        self.setup_payload()
+
+    def webhook(self, secret):
+        signature = get_hmac(secret, self.raw_payload)
+        return JSONWebhookData(
+            headers={
+                'X-Shopify-Shop-Domain': 'example.com',
+                'X-Shopify-Hmac-Sha256': signature,
+            },
+            body=self.raw_payload,
+            content=self.json_payload)
+
+    def test_verify(self):
+        conf = settings.WEBHOOK_RECEIVER_SETTINGS['shopify']
+        verify_webhook(self.webhook(conf['api_key']))
+        with self.assertRaises(InvalidWebhookException):
+            verify_webhook(self.webhook('old-secret'))
+
+    def test_rotation(self):
+        conf = dict(settings.WEBHOOK_RECEIVER_SETTINGS['shopify'])
+        conf['previous_api_keys'] = ['old-secret']
+        with override_settings(WEBHOOK_RECEIVER_SETTINGS={
+                'shopify': conf,
+        }):
+            verify_webhook(self.webhook(conf['api_key']))
+            verify_webhook(self.webhook('old-secret'))
+            with self.assertRaises(InvalidWebhookException):
+                verify_webhook(self.webhook('older-secret'))
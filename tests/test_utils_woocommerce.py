@@ -2,14 +2,18 @@ from __future__ import unicode_literals
 
 import json
 
+from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.db.utils import IntegrityError
+from django.test import override_settings
 
 from requests.exceptions import HTTPError
 
 from webhook_receiver.models import JSONWebhookData
+from webhook_receiver.utils import EnrollmentException
+from webhook_receiver.utils import InvalidWebhookException, get_hmac
 
-from webhook_receiver_woocommerce.utils import record_order
+from webhook_receiver_woocommerce.utils import record_order, verify_webhook
 from webhook_receiver_woocommerce.utils import process_order, process_line_item
 from webhook_receiver_woocommerce.models import WooCommerceOrder as Order
 from webhook_receiver_woocommerce.models import WooCommerceOrderItem as OrderItem  # noqa: E501
@@ -17,6 +21,7 @@ from webhook_receiver_woocommerce.models import WooCommerceOrderItem as OrderIte
 import requests_mock
 
 from . import WooCommerceTestCase
+from .test_utils import bulk_enroll_response
 
 
 class RecordOrderTest(WooCommerceTestCase):
@@ -30,13 +35,30 @@ class RecordOrderTest(WooCommerceTestCase):
         # that in the payload
         order1, created1 = record_order(self.webhook_data)
         self.assertTrue(created1)
-        self.assertEqual(order1.id, self.json_payload['id'])
+        self.assertEqual(order1.order_id, self.json_payload['id'])
         # Try to create the order again, make sure we get a reference
         # instead
         order2, created2 = record_order(self.webhook_data)
         self.assertFalse(created2)
         self.assertEqual(order1, order2)
 
+    def test_record_order_per_shop(self):
+        # Different shops may send orders with the same ID, which are
+        # different orders.
+        orders = []
+        for shop in ('https://example.com', 'https://example.org'):
+            self.webhook_data.headers = {'X-Wc-Webhook-Source': shop}
+            order, created = record_order(self.webhook_data)
+            self.assertTrue(created)
+            self.assertEqual(order.shop, shop)
+            self.assertEqual(order.order_id, self.json_payload['id'])
+            orders.append(order)
+        self.assertNotEqual(orders[0], orders[1])
+        # We log orders as the shops know them.
+        self.assertEqual(str(orders[1]),
+                         '%s from https://example.org' % (
+                             self.json_payload['id']))
+
 
 class ProcessOrderTest(WooCommerceTestCase):
 
@@ -121,6 +143,51 @@ class ProcessOrderTest(WooCommerceTestCase):
         self.test_valid_order()
 
 
+@override_settings(WEBHOOK_RECEIVER_BATCH_ENROLLMENT=True)
+class BatchProcessOrderTest(ProcessOrderTest):
+    """Run all order processing tests with batched enrollments."""
+
+    def test_single_request(self):
+        order, created = record_order(self.webhook_data)
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json=bulk_enroll_response)
+            process_order(order, self.json_payload)
+            enroll_requests = [r for r in m.request_history
+                               if r.url == self.enroll_uri]
+        self.assertEqual(len(enroll_requests), 1)
+        self.assertEqual(order.status, Order.PROCESSED)
+        self.assertEqual(set(OrderItem.objects.values_list('status',
+                                                           flat=True)),
+                         {OrderItem.PROCESSED})
+
+    def test_missing_results(self):
+        # Without results for a course, we can't tell whether its
+        # learners were enrolled.
+        order, created = record_order(self.webhook_data)
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json={'action': 'enroll', 'courses': {}})
+            with self.assertRaises(EnrollmentException):
+                process_order(order, self.json_payload)
+        self.assertEqual(set(OrderItem.objects.values_list('status',
+                                                           flat=True)),
+                         {OrderItem.ERROR})
+
+
+@override_settings(WEBHOOK_RECEIVER_LINE_ITEM_CONCURRENCY=4)
+class ConcurrentProcessOrderTest(ProcessOrderTest):
+    """Run all order processing tests with concurrent line items."""
+
+
 class ProcessLineItemTest(WooCommerceTestCase):
 
     def setUp(self):
@@ -128,7 +195,7 @@ class ProcessLineItemTest(WooCommerceTestCase):
 
     def test_valid_single_line_item(self):
         order = Order()
-        order.id = 40
+        order.order_id = 40
         order.save()
         line_item = {
             "sku": "course-v1:org+course+run1",
@@ -195,7 +262,7 @@ class ProcessLineItemTest(WooCommerceTestCase):
 
     def test_invalid_line_items(self):
         order = Order()
-        order.id = 41
+        order.order_id = 41
         order.save()
         # These line items are an SKU without an email, and an email
         # without a SKU
@@ -218,7 +285,7 @@ class ProcessLineItemTest(WooCommerceTestCase):
 
     def test_invalid_sku(self):
         order = Order()
-        order.id = 42
+        order.order_id = 42
         order.save()
         line_items = [{"sku": "course-v1:org+nosuchcourse+run1",
                        "meta_data": [
@@ -249,7 +316,7 @@ class ProcessLineItemTest(WooCommerceTestCase):
 
     def test_invalid_email_address(self):
         order = Order()
-        order.id = 43
+        order.order_id = 43
         order.save()
         line_items = [{"sku": "course-v1:org+course+run1",
                        "meta_data": [
@@ -269,7 +336,7 @@ class ProcessLineItemTest(WooCommerceTestCase):
 
     def test_invalid_meta_data(self):
         order = Order()
-        order.id = 44
+        order.order_id = 44
         order.save()
         line_item = {
             "sku": "course-v1:org+course+run1",
@@ -290,3 +357,36 @@ class ProcessLineItemTest(WooCommerceTestCase):
         # a violation of the NOT NULL constraint.
         with self.assertRaises(IntegrityError):
             process_line_item(order, line_item)
+
+
+class VerifyWebhookTest(WooCommerceTestCase):
+
+    def setUp(self):
+        self.setup_payload()
+
+    def webhook(self, secret):
+        signature = get_hmac(secret, self.raw_payload)
+        return JSONWebhookData(
+            headers={
+                'X-Wc-Webhook-Source': 'https://example.com',
+                'X-Wc-Webhook-Signature': signature,
+            },
+            body=self.raw_payload,
+            content=self.json_payload)
+
+    def test_verify(self):
+        conf = settings.WEBHOOK_RECEIVER_SETTINGS['woocommerce']
+        verify_webhook(self.webhook(conf['secret']))
+        with self.assertRaises(InvalidWebhookException):
+            verify_webhook(self.webhook('old-secret'))
+
+    def test_rotation(self):
+        conf = dict(settings.WEBHOOK_RECEIVER_SETTINGS['woocommerce'])
+        conf['previous_secrets'] = ['old-secret']
+        with override_settings(WEBHOOK_RECEIVER_SETTINGS={
+                'woocommerce': conf,
+        }):
+            verify_webhook(self.webhook(conf['secret']))
+            verify_webhook(self.webhook('old-secret'))
+            with self.assertRaises(InvalidWebhookException):
+                verify_webhook(self.webhook('older-secret'))
@@ -6,10 +6,21 @@ import base64
 import hmac
 
 from django.conf import settings
-from django.test import Client
+from django.core.cache import cache
+from django.test import Client, AsyncRequestFactory, override_settings
+
+from webhook_receiver.models import JSONWebhookData, WebhookBody
+from webhook_receiver.rejections import rejection_counts
+from webhook_receiver.rejections import reset_rejection_counts
+from webhook_receiver.sharedset import reset_shared_sets
+from webhook_receiver_shopify.models import ShopifyOrder
+from webhook_receiver_woocommerce.models import WooCommerceOrder
+from webhook_receiver_shopify.views import aorder_create
+from webhook_receiver_woocommerce.views import aorder_create_or_update
 
 import requests_mock
 
+from .test_sharedset import LOCMEM_CACHES
 from . import ShopifyTestCase, WooCommerceTestCase, WooCommerceUnpaidTestCase
 
 
@@ -152,6 +163,302 @@ class ShopifyTestOrderCreation(ShopifyTestCase):
         self.test_valid_order()
 
 
+@override_settings(WEBHOOK_RECEIVER_SINGLE_WRITE=True)
+class ShopifySingleWriteTestOrderCreation(ShopifyTestOrderCreation):
+    """Run all Shopify view tests with single-write ingestion."""
+
+    def test_incorrect_signature(self):
+        super().test_incorrect_signature()
+        # Even though we never wrote the webhook before verifying it,
+        # we must still have a record of the forged request.
+        data = JSONWebhookData.objects.get()
+        self.assertEqual(data.status, JSONWebhookData.ERROR)
+
+    def test_corrupt_data(self):
+        super().test_corrupt_data()
+        data = JSONWebhookData.objects.get()
+        self.assertEqual(data.status, JSONWebhookData.ERROR)
+
+    def test_valid_order(self):
+        super().test_valid_order()
+        data = JSONWebhookData.objects.last()
+        self.assertEqual(data.status, JSONWebhookData.PROCESSED)
+        self.assertEqual(data.source, '127.0.0.1')
+
+
+@override_settings(WEBHOOK_RECEIVER_STREAMING_INTAKE=True)
+class ShopifyStreamingTestOrderCreation(ShopifySingleWriteTestOrderCreation):
+    """Run all Shopify view tests with streaming intake."""
+
+    def test_corrupt_signature(self):
+        super().test_corrupt_signature()
+        # A signature that cannot possibly match is rejected before
+        # we even read the body.
+        self.assertFalse(JSONWebhookData.objects.exists())
+
+    @override_settings(WEBHOOK_RECEIVER_MAX_BODY_SIZE=64)
+    def test_oversized_body(self):
+        response = self.client.post('/webhooks/shopify/order/create',
+                                    self.raw_payload,
+                                    content_type='application/json',
+                                    HTTP_X_SHOPIFY_HMAC_SHA256=self.correct_signature,  # noqa: E501
+                                    HTTP_X_SHOPIFY_SHOP_DOMAIN='example.com')
+        self.assertEqual(response.status_code, 413)
+        self.assertFalse(JSONWebhookData.objects.exists())
+
+
+@override_settings(WEBHOOK_RECEIVER_EARLY_REJECT=True)
+class ShopifyEarlyRejectTestOrderCreation(ShopifyTestOrderCreation):
+    """Run all Shopify view tests with early rejection.
+
+    In this mode, we must not store any webhook that we reject for
+    its headers or signature.
+    """
+
+    def setUp(self):
+        super().setUp()
+        reset_rejection_counts()
+
+    def test_missing_hmac_header(self):
+        super().test_missing_hmac_header()
+        self.assertFalse(JSONWebhookData.objects.exists())
+
+    def test_missing_shop_domain_header(self):
+        super().test_missing_shop_domain_header()
+        self.assertFalse(JSONWebhookData.objects.exists())
+
+    def test_incorrect_signature(self):
+        super().test_incorrect_signature()
+        self.assertFalse(JSONWebhookData.objects.exists())
+        self.assertEqual(rejection_counts(), {
+            ('shopify', 'InvalidWebhookException'): 1,
+        })
+
+    def test_corrupt_signature(self):
+        super().test_corrupt_signature()
+        self.assertFalse(JSONWebhookData.objects.exists())
+
+    def test_corrupt_data(self):
+        # The corrupt payload does not match the signature, which we
+        # now check before even trying to parse the payload.
+        response = self.client.post('/webhooks/shopify/order/create',
+                                    b'{',
+                                    content_type='application/json',
+                                    HTTP_X_SHOPIFY_HMAC_SHA256=self.correct_signature,  # noqa: E501
+                                    HTTP_X_SHOPIFY_SHOP_DOMAIN='example.com')
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(JSONWebhookData.objects.exists())
+
+    def test_invalid_domain(self):
+        super().test_invalid_domain()
+        self.assertFalse(JSONWebhookData.objects.exists())
+        self.assertEqual(rejection_counts(), {
+            ('shopify', 'UnknownSourceException'): 1,
+        })
+
+    @override_settings(WEBHOOK_RECEIVER_FAST_ACK=True)
+    def test_incorrect_signature_fast_ack(self):
+        # Even in fast-ack mode, we reject forged webhooks right
+        # away.
+        self.test_incorrect_signature()
+
+    @override_settings(WEBHOOK_RECEIVER_STREAMING_INTAKE=True)
+    def test_incorrect_signature_streaming(self):
+        self.test_incorrect_signature()
+
+
+@override_settings(WEBHOOK_RECEIVER_COMPACT_STORAGE=True)
+class ShopifyCompactTestOrderCreation(ShopifySingleWriteTestOrderCreation):
+    """Run all Shopify view tests with compact storage."""
+
+    def test_valid_order(self):
+        super().test_valid_order()
+        data = JSONWebhookData.objects.last()
+        self.assertNotIn('Cookie', data.headers)
+        self.assertEqual(data.headers['X-Shopify-Shop-Domain'],
+                         'example.com')
+        self.assertEqual(data.content, self.json_payload)
+
+    @override_settings(WEBHOOK_RECEIVER_FAST_ACK=True)
+    def test_valid_order_fast_ack(self):
+        super().test_valid_order()
+        data = JSONWebhookData.objects.get()
+        self.assertEqual(data.status, JSONWebhookData.PROCESSED)
+        self.assertEqual(data.content, self.json_payload)
+
+
+@override_settings(WEBHOOK_RECEIVER_BODY_STORE=True)
+class ShopifyBodyStoreTestOrderCreation(ShopifyTestOrderCreation):
+    """Run all Shopify view tests with the body store."""
+
+    def test_valid_order_again(self):
+        super().test_valid_order_again()
+        self.assertEqual(JSONWebhookData.objects.count(), 2)
+        self.assertEqual(WebhookBody.objects.count(), 1)
+
+
+@override_settings(WEBHOOK_RECEIVER_DEDUPLICATE_DELIVERIES=True,
+                   CACHES=LOCMEM_CACHES)
+class ShopifyDeduplicateTestOrderCreation(ShopifyTestOrderCreation):
+    """Run all Shopify view tests with delivery deduplication."""
+
+    def setUp(self):
+        super().setUp()
+        reset_shared_sets()
+        cache.clear()
+
+    def post(self, signature, delivery_id):
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json={})
+            return self.client.post('/webhooks/shopify/order/create',
+                                    self.raw_payload,
+                                    content_type='application/json',
+                                    HTTP_X_SHOPIFY_HMAC_SHA256=signature,
+                                    HTTP_X_SHOPIFY_SHOP_DOMAIN='example.com',
+                                    HTTP_X_SHOPIFY_WEBHOOK_ID=delivery_id)
+
+    def test_redelivery(self):
+        response = self.post(self.correct_signature, 'delivery-1')
+        self.assertEqual(response.status_code, 200)
+        response = self.post(self.correct_signature, 'delivery-1')
+        self.assertEqual(response.status_code, 200)
+        # We did not even store the redelivered webhook.
+        self.assertEqual(JSONWebhookData.objects.count(), 1)
+
+        # Another process still recognizes the redelivery.
+        reset_shared_sets()
+        response = self.post(self.correct_signature, 'delivery-1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(JSONWebhookData.objects.count(), 1)
+
+        response = self.post(self.correct_signature, 'delivery-2')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(JSONWebhookData.objects.count(), 2)
+
+    def test_rejected_delivery(self):
+        # A rejected webhook is not recorded, so that a retry with a
+        # correct signature still gets processed.
+        response = self.post(self.incorrect_signature, 'delivery-1')
+        self.assertEqual(response.status_code, 403)
+        response = self.post(self.correct_signature, 'delivery-1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(JSONWebhookData.objects.count(), 2)
+
+    @override_settings(WEBHOOK_RECEIVER_DEDUPLICATE_DELIVERIES=False)
+    def test_disabled(self):
+        for i in range(2):
+            response = self.post(self.correct_signature, 'delivery-1')
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(JSONWebhookData.objects.count(), 2)
+
+
+@override_settings(WEBHOOK_RECEIVER_GROUP_COMMIT_WINDOW=0.001)
+class ShopifyGroupCommitTestOrderCreation(
+        ShopifySingleWriteTestOrderCreation):
+    """Run all Shopify view tests with single-write ingestion and
+    group commit."""
+
+
+@override_settings(WEBHOOK_RECEIVER_FAST_ACK=True)
+class ShopifyFastAckTestOrderCreation(ShopifyTestOrderCreation):
+    """Run Shopify view tests in fast-ack mode.
+
+    In this mode, we acknowledge any JSON payload as soon as we have
+    stored it, and reject invalid webhooks only in the subsequent
+    ingestion task.
+    """
+
+    def assertRejected(self, response):
+        self.assertEqual(response.status_code, 200)
+        data = JSONWebhookData.objects.get()
+        self.assertEqual(data.status, JSONWebhookData.ERROR)
+        self.assertFalse(ShopifyOrder.objects.exists())
+
+    def test_missing_hmac_header(self):
+        response = self.client.post('/webhooks/shopify/order/create',
+                                    self.raw_payload,
+                                    HTTP_X_SHOPIFY_SHOP_DOMAIN='example.com',
+                                    content_type='application/json')
+        self.assertRejected(response)
+
+    def test_missing_shop_domain_header(self):
+        response = self.client.post('/webhooks/shopify/order/create',
+                                    self.raw_payload,
+                                    HTTP_X_SHOPIFY_HMAC_SHA256=self.corrupt_signature,  # noqa: E501
+                                    content_type='application/json')
+        self.assertRejected(response)
+
+    def test_incorrect_signature(self):
+        response = self.client.post('/webhooks/shopify/order/create',
+                                    self.raw_payload,
+                                    content_type='application/json',
+                                    HTTP_X_SHOPIFY_HMAC_SHA256=self.incorrect_signature,  # noqa: E501
+                                    HTTP_X_SHOPIFY_SHOP_DOMAIN='example.com')
+        self.assertRejected(response)
+
+    def test_corrupt_signature(self):
+        response = self.client.post('/webhooks/shopify/order/create',
+                                    self.raw_payload,
+                                    content_type='application/json',
+                                    HTTP_X_SHOPIFY_HMAC_SHA256=self.corrupt_signature,  # noqa: E501
+                                    HTTP_X_SHOPIFY_SHOP_DOMAIN='example.com')
+        self.assertRejected(response)
+
+    def test_corrupt_data(self):
+        response = self.client.post('/webhooks/shopify/order/create',
+                                    "{".encode('utf-8'),
+                                    content_type='application/json',
+                                    HTTP_X_SHOPIFY_HMAC_SHA256=self.correct_signature,  # noqa: E501
+                                    HTTP_X_SHOPIFY_SHOP_DOMAIN='example.com')
+        self.assertRejected(response)
+
+    def test_invalid_domain(self):
+        response = self.client.post('/webhooks/shopify/order/create',
+                                    self.raw_payload,
+                                    content_type='application/json',
+                                    HTTP_X_SHOPIFY_HMAC_SHA256=self.correct_signature,  # noqa: E501
+                                    HTTP_X_SHOPIFY_SHOP_DOMAIN='nonexistant-domain.com')  # noqa: E501
+        self.assertRejected(response)
+
+    def test_valid_order(self):
+        super().test_valid_order()
+        data = JSONWebhookData.objects.last()
+        self.assertEqual(data.status, JSONWebhookData.PROCESSED)
+        # Only allowlisted headers are stored
+        self.assertIn('X-Shopify-Hmac-Sha256', data.headers)
+        self.assertNotIn('Cookie', data.headers)
+        order = ShopifyOrder.objects.get()
+        self.assertEqual(order.status, ShopifyOrder.PROCESSED)
+
+
+@override_settings(WEBHOOK_RECEIVER_FAST_ACK=True)
+class ShopifyFastAckDeduplicateTestOrderCreation(
+        ShopifyDeduplicateTestOrderCreation,
+        ShopifyFastAckTestOrderCreation):
+    """Run all Shopify view tests with delivery deduplication, in
+    fast-ack mode."""
+
+    def test_rejected_delivery(self):
+        # We acknowledge the forged webhook, but only record the
+        # delivery ID once the ingest task has verified a webhook.
+        response = self.post(self.incorrect_signature, 'delivery-1')
+        self.assertEqual(response.status_code, 200)
+        response = self.post(self.correct_signature, 'delivery-1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(JSONWebhookData.objects.count(), 2)
+        self.assertEqual(ShopifyOrder.objects.get().status,
+                         ShopifyOrder.PROCESSED)
+
+        response = self.post(self.correct_signature, 'delivery-1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(JSONWebhookData.objects.count(), 2)
+
+
 class WooCommerceTestOrderCreation(WooCommerceTestCase):
 
     TEST_VALID_ORDER_EXPECTED_STATUS_CODE = 200
@@ -314,3 +621,322 @@ class WooCommerceTestOrderUpdate(WooCommerceUnpaidTestCase,
                                  WooCommerceTestOrderCreation):
 
     TEST_VALID_ORDER_EXPECTED_STATUS_CODE = 402
+
+
+@override_settings(WEBHOOK_RECEIVER_SINGLE_WRITE=True)
+class WooCommerceSingleWriteTestOrderCreation(WooCommerceTestOrderCreation):
+    """Run all WooCommerce view tests with single-write ingestion."""
+
+    def test_incorrect_signature(self):
+        super().test_incorrect_signature()
+        data = JSONWebhookData.objects.get()
+        self.assertEqual(data.status, JSONWebhookData.ERROR)
+
+
+@override_settings(WEBHOOK_RECEIVER_EARLY_REJECT=True)
+class WooCommerceEarlyRejectTestOrderCreation(WooCommerceTestOrderCreation):
+    """Run all WooCommerce view tests with early rejection."""
+
+    def test_corrupt_data(self):
+        # The corrupt payload does not match the signature, which we
+        # now check before even trying to parse the payload.
+        response = self.client.post('/webhooks/woocommerce/order/create',
+                                    b'{',
+                                    content_type='application/json',
+                                    HTTP_X_WC_WEBHOOK_SIGNATURE=self.correct_signature,  # noqa: E501
+                                    HTTP_X_WC_WEBHOOK_SOURCE='https://example.com')  # noqa: E501
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(JSONWebhookData.objects.exists())
+
+    def test_incorrect_signature(self):
+        super().test_incorrect_signature()
+        self.assertFalse(JSONWebhookData.objects.exists())
+
+    def test_invalid_domain(self):
+        super().test_invalid_domain()
+        self.assertFalse(JSONWebhookData.objects.exists())
+
+    @override_settings(WEBHOOK_RECEIVER_FAST_ACK=True)
+    def test_incorrect_signature_fast_ack(self):
+        self.test_incorrect_signature()
+
+
+@override_settings(WEBHOOK_RECEIVER_STREAMING_INTAKE=True)
+class WooCommerceStreamingTestOrderCreation(
+        WooCommerceSingleWriteTestOrderCreation):
+    """Run all WooCommerce view tests with streaming intake."""
+
+    @override_settings(WEBHOOK_RECEIVER_MAX_BODY_SIZE=64)
+    def test_oversized_body(self):
+        response = self.client.post('/webhooks/woocommerce/order/create',
+                                    self.raw_payload,
+                                    content_type='application/json',
+                                    HTTP_X_WC_WEBHOOK_SIGNATURE=self.correct_signature,  # noqa: E501
+                                    HTTP_X_WC_WEBHOOK_SOURCE='https://example.com')  # noqa: E501
+        self.assertEqual(response.status_code, 413)
+        self.assertFalse(JSONWebhookData.objects.exists())
+
+
+@override_settings(WEBHOOK_RECEIVER_FAST_ACK=True)
+class WooCommerceFastAckTestOrderCreation(WooCommerceTestCase):
+    """Test the WooCommerce view in fast-ack mode."""
+
+    def setUp(self):
+        self.setup_payload()
+        self.setup_requests()
+        self.client = Client(enforce_csrf_checks=True)
+        conf = settings.WEBHOOK_RECEIVER_SETTINGS['woocommerce']
+        correct_hash = hmac.new(conf['secret'].encode('utf-8'),
+                                self.raw_payload,
+                                hashlib.sha256).digest()
+        incorrect_hash = hmac.new(conf['secret'][::-1].encode('utf-8'),
+                                  self.raw_payload,
+                                  hashlib.sha256).digest()
+        self.correct_signature = base64.b64encode(correct_hash).decode()
+        self.incorrect_signature = base64.b64encode(incorrect_hash).decode()
+
+    def test_valid_x_www_form_urlencoded(self):
+        response = self.client.post('/webhooks/woocommerce/order/create',
+                                    'webhook_id=1',
+                                    content_type='application/x-www-form-urlencoded')  # noqa: E501
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(JSONWebhookData.objects.exists())
+
+    def test_incorrect_signature(self):
+        response = self.client.post('/webhooks/woocommerce/order/create',
+                                    self.raw_payload,
+                                    content_type='application/json',
+                                    HTTP_X_WC_WEBHOOK_SIGNATURE=self.incorrect_signature,  # noqa: E501
+                                    HTTP_X_WC_WEBHOOK_SOURCE='https://example.com')  # noqa: E501
+        self.assertEqual(response.status_code, 200)
+        data = JSONWebhookData.objects.get()
+        self.assertEqual(data.status, JSONWebhookData.ERROR)
+        self.assertFalse(WooCommerceOrder.objects.exists())
+
+    def test_valid_order(self):
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json={})
+            response = self.client.post('/webhooks/woocommerce/order/create',
+                                        self.raw_payload,
+                                        content_type='application/json',
+                                        HTTP_X_WC_WEBHOOK_SIGNATURE=self.correct_signature,  # noqa: E501
+                                        HTTP_X_WC_WEBHOOK_SOURCE='https://example.com')  # noqa: E501
+        self.assertEqual(response.status_code, 200)
+        data = JSONWebhookData.objects.get()
+        self.assertEqual(data.status, JSONWebhookData.PROCESSED)
+        order = WooCommerceOrder.objects.get()
+        self.assertEqual(order.status, WooCommerceOrder.PROCESSED)
+
+
+class WooCommerceFastAckTestOrderUpdate(WooCommerceUnpaidTestCase,
+                                        WooCommerceFastAckTestOrderCreation):
+
+    def test_valid_order(self):
+        response = self.client.post('/webhooks/woocommerce/order/update',
+                                    self.raw_payload,
+                                    content_type='application/json',
+                                    HTTP_X_WC_WEBHOOK_SIGNATURE=self.correct_signature,  # noqa: E501
+                                    HTTP_X_WC_WEBHOOK_SOURCE='https://example.com')  # noqa: E501
+        # We acknowledge the webhook, but we don't record an unpaid
+        # order.
+        self.assertEqual(response.status_code, 200)
+        data = JSONWebhookData.objects.get()
+        self.assertEqual(data.status, JSONWebhookData.PROCESSED)
+        self.assertFalse(WooCommerceOrder.objects.exists())
+
+
+class ShopifyAsyncTestOrderCreation(ShopifyTestCase):
+    """Test the async Shopify view."""
+
+    def setUp(self):
+        self.setup_payload()
+        self.setup_requests()
+        self.factory = AsyncRequestFactory()
+
+        conf = settings.WEBHOOK_RECEIVER_SETTINGS['shopify']
+        correct_hash = hmac.new(conf['api_key'].encode('utf-8'),
+                                self.raw_payload,
+                                hashlib.sha256).digest()
+        self.correct_signature = base64.b64encode(correct_hash).decode()
+
+    def post(self, payload, headers):
+        return self.factory.post('/webhooks/shopify/order/create',
+                                 payload,
+                                 content_type='application/json',
+                                 headers=headers)
+
+    async def test_invalid_method_get(self):
+        request = self.factory.get('/webhooks/shopify/order/create')
+        response = await aorder_create(request)
+        self.assertEqual(response.status_code, 405)
+
+    async def test_corrupt_data(self):
+        request = self.post(b'{',
+                            headers={
+                                'X-Shopify-Hmac-Sha256': self.correct_signature,  # noqa: E501
+                                'X-Shopify-Shop-Domain': 'example.com',
+                            })
+        response = await aorder_create(request)
+        self.assertEqual(response.status_code, 400)
+        data = await JSONWebhookData.objects.aget()
+        self.assertEqual(data.status, JSONWebhookData.ERROR)
+
+    async def test_invalid_domain(self):
+        request = self.post(self.raw_payload,
+                            headers={
+                                'X-Shopify-Hmac-Sha256': self.correct_signature,  # noqa: E501
+                                'X-Shopify-Shop-Domain': 'nonexistant-domain.com',  # noqa: E501
+                            })
+        response = await aorder_create(request)
+        self.assertEqual(response.status_code, 403)
+        data = await JSONWebhookData.objects.aget()
+        self.assertEqual(data.status, JSONWebhookData.ERROR)
+
+    async def test_valid_order(self):
+        request = self.post(self.raw_payload,
+                            headers={
+                                'X-Shopify-Hmac-Sha256': self.correct_signature,  # noqa: E501
+                                'X-Shopify-Shop-Domain': 'example.com',
+                            })
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json={})
+            response = await aorder_create(request)
+        self.assertEqual(response.status_code, 200)
+        data = await JSONWebhookData.objects.aget()
+        self.assertEqual(data.status, JSONWebhookData.PROCESSED)
+        order = await ShopifyOrder.objects.aget()
+        self.assertEqual(order.status, ShopifyOrder.PROCESSED)
+
+    @override_settings(WEBHOOK_RECEIVER_FAST_ACK=True)
+    async def test_valid_order_fast_ack(self):
+        await self.test_valid_order()
+
+    @override_settings(WEBHOOK_RECEIVER_STREAMING_INTAKE=True)
+    async def test_valid_order_streaming(self):
+        await self.test_valid_order()
+
+    @override_settings(WEBHOOK_RECEIVER_DEDUPLICATE_DELIVERIES=True,
+                       CACHES=LOCMEM_CACHES)
+    async def test_redelivery(self):
+        reset_shared_sets()
+        await cache.aclear()
+        for i in range(2):
+            request = self.post(self.raw_payload,
+                                headers={
+                                    'X-Shopify-Hmac-Sha256': self.correct_signature,  # noqa: E501
+                                    'X-Shopify-Shop-Domain': 'example.com',
+                                    'X-Shopify-Webhook-Id': '1',
+                                })
+            with requests_mock.Mocker() as m:
+                m.register_uri('POST',
+                               self.token_uri,
+                               json=self.token_response)
+                m.register_uri('POST',
+                               self.enroll_uri,
+                               json={})
+                response = await aorder_create(request)
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(await JSONWebhookData.objects.acount(), 1)
+
+
+class WooCommerceAsyncTestOrderCreation(WooCommerceTestCase):
+    """Test the async WooCommerce view."""
+
+    EXPECTED_STATUS_CODE = 200
+
+    def setUp(self):
+        self.setup_payload()
+        self.setup_requests()
+        self.factory = AsyncRequestFactory()
+
+        conf = settings.WEBHOOK_RECEIVER_SETTINGS['woocommerce']
+        correct_hash = hmac.new(conf['secret'].encode('utf-8'),
+                                self.raw_payload,
+                                hashlib.sha256).digest()
+        self.correct_signature = base64.b64encode(correct_hash).decode()
+
+    async def test_valid_x_www_form_urlencoded(self):
+        request = self.factory.post('/webhooks/woocommerce/order/create',
+                                    'webhook_id=1',
+                                    content_type='application/x-www-form-urlencoded')  # noqa: E501
+        response = await aorder_create_or_update(request)
+        self.assertEqual(response.status_code, 200)
+
+    async def test_missing_source_header(self):
+        request = self.factory.post('/webhooks/woocommerce/order/create',
+                                    self.raw_payload,
+                                    content_type='application/json',
+                                    headers={
+                                        'X-WC-Webhook-Signature': self.correct_signature,  # noqa: E501
+                                    })
+        response = await aorder_create_or_update(request)
+        self.assertEqual(response.status_code, 400)
+
+    async def test_valid_order(self):
+        request = self.factory.post('/webhooks/woocommerce/order/create',
+                                    self.raw_payload,
+                                    content_type='application/json',
+                                    headers={
+                                        'X-WC-Webhook-Signature': self.correct_signature,  # noqa: E501
+                                        'X-WC-Webhook-Source': 'https://example.com',  # noqa: E501
+                                    })
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json={})
+            response = await aorder_create_or_update(request)
+        self.assertEqual(response.status_code, self.EXPECTED_STATUS_CODE)
+        data = await JSONWebhookData.objects.aget()
+        self.assertEqual(data.status, JSONWebhookData.PROCESSED)
+
+    @override_settings(WEBHOOK_RECEIVER_STREAMING_INTAKE=True)
+    async def test_valid_order_streaming(self):
+        await self.test_valid_order()
+
+    @override_settings(WEBHOOK_RECEIVER_DEDUPLICATE_DELIVERIES=True,
+                       CACHES=LOCMEM_CACHES)
+    async def test_redelivery(self):
+        reset_shared_sets()
+        await cache.aclear()
+        for i in range(2):
+            request = self.factory.post('/webhooks/woocommerce/order/create',
+                                        self.raw_payload,
+                                        content_type='application/json',
+                                        headers={
+                                            'X-WC-Webhook-Signature': self.correct_signature,  # noqa: E501
+                                            'X-WC-Webhook-Source': 'https://example.com',  # noqa: E501
+                                            'X-WC-Webhook-Delivery-ID': '1',
+                                        })
+            with requests_mock.Mocker() as m:
+                m.register_uri('POST',
+                               self.token_uri,
+                               json=self.token_response)
+                m.register_uri('POST',
+                               self.enroll_uri,
+                               json={})
+                response = await aorder_create_or_update(request)
+            self.assertEqual(response.status_code, self.EXPECTED_STATUS_CODE)
+        # We only acknowledge redeliveries of webhooks that we
+        # accepted, and process any others again.
+        expected_count = 1 if self.EXPECTED_STATUS_CODE == 200 else 2
+        self.assertEqual(await JSONWebhookData.objects.acount(),
+                         expected_count)
+
+
+class WooCommerceAsyncTestOrderUpdate(WooCommerceUnpaidTestCase,
+                                      WooCommerceAsyncTestOrderCreation):
+
+    EXPECTED_STATUS_CODE = 402
@@ -0,0 +1,6 @@
+from django.contrib import admin
+
+from .models import Shop, SKUMapping
+
+admin.site.register(Shop)
+admin.site.register(SKUMapping)
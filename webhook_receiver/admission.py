@@ -0,0 +1,237 @@
+"""Admission control for the webhook endpoints.
+
+When the Celery workers fall behind, or ingesting webhooks slows
+down, we shed load rather than let the broker backlog grow without
+bound: we respond to webhooks with a Retry-After header, and leave it
+to the shops to deliver them again later. We consider ourselves
+overloaded if
+
+* the broker queue that our tasks go to holds more than
+  WEBHOOK_RECEIVER_MAX_QUEUE_DEPTH messages (which we check at most
+  every WEBHOOK_RECEIVER_QUEUE_DEPTH_INTERVAL seconds, in a background
+  thread, so that no webhook waits for the broker), or
+
+* the webhooks that we admitted in the last
+  WEBHOOK_RECEIVER_INGEST_LATENCY_WINDOW seconds took more than
+  WEBHOOK_RECEIVER_MAX_INGEST_LATENCY seconds on average to ingest.
+
+If WEBHOOK_RECEIVER_SHED_MODE is "reject", we then respond with HTTP
+503 before we even read a webhook. If it is "defer", we store and
+verify a webhook as usual, but rather than process its order, we
+respond with HTTP 429, so that the order gets processed once the
+shop delivers the webhook again.
+
+Since we stop measuring ingest latency while we reject webhooks,
+latency-based load shedding ends at most one latency window after it
+started, at which point we admit webhooks again, and measure anew.
+"""
+
+import logging
+import threading
+import time
+
+from collections import deque
+
+from celery import current_app
+
+from django.conf import settings
+from django.http import HttpResponse
+
+
+# The number of seconds we give the broker to tell us the queue depth.
+# If it doesn't, we admit webhooks until the next sample.
+QUEUE_DEPTH_TIMEOUT = 1
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyWindow(object):
+    """The ingest latencies that we measured in a sliding window of
+    time."""
+
+    def __init__(self):
+        # (monotonic time, latency) pairs, oldest first
+        self.samples = deque()
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+    def _expire(self, now, window):
+        while self.samples and self.samples[0][0] < now - window:
+            self.total -= self.samples.popleft()[1]
+
+    def add(self, latency, window):
+        now = time.monotonic()
+        with self.lock:
+            self._expire(now, window)
+            self.samples.append((now, latency))
+            self.total += latency
+
+    def mean(self, window):
+        """Return the mean latency in the window, or None if we
+        haven't measured any."""
+        with self.lock:
+            self._expire(time.monotonic(), window)
+            if not self.samples:
+                return None
+            return self.total / len(self.samples)
+
+
+class QueueDepth(object):
+    """The most recently sampled depth of the broker queue."""
+
+    def __init__(self):
+        self.depth = None
+        self.sampled = None
+        # Held while a sample is being taken
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def due(self):
+        if self.sampled is None:
+            return True
+        age = time.monotonic() - self.sampled
+        return age >= settings.WEBHOOK_RECEIVER_QUEUE_DEPTH_INTERVAL
+
+    def refresh(self):
+        """Take a new sample in a background thread, if one is due and
+        we aren't taking one already. Until it's done, we go on using
+        the previous sample."""
+        if not self.due() or not self.lock.acquire(blocking=False):
+            return
+        try:
+            if not self.due():
+                self.lock.release()
+                return
+            self.thread = threading.Thread(target=self.sample,
+                                           name='queue-depth',
+                                           daemon=True)
+            self.thread.start()
+        except Exception:
+            self.lock.release()
+            raise
+
+    def sample(self):
+        # Called with self.lock held, which we release once done.
+        try:
+            try:
+                self.depth = read_queue_depth()
+            except Exception as e:
+                # If we can't tell, we admit webhooks.
+                logger.warning('Unable to read broker '
+                               'queue depth: %s' % e)
+                self.depth = None
+            self.sampled = time.monotonic()
+        finally:
+            self.lock.release()
+
+
+_latencies = LatencyWindow()
+_queue_depth = QueueDepth()
+_overloaded = False
+
+
+def read_queue_depth():
+    """Return the number of messages in the broker queue that our
+    tasks go to, or None if we have no broker."""
+    app = current_app
+    if app.conf.task_always_eager:
+        return None
+    queue = settings.WEBHOOK_RECEIVER_ADMISSION_QUEUE
+    if not queue:
+        queue = app.conf.task_default_queue
+    with app.connection_for_read(
+            connect_timeout=QUEUE_DEPTH_TIMEOUT) as connection:
+        # Don't keep retrying while the broker is down.
+        connection.ensure_connection(max_retries=1,
+                                     interval_start=0,
+                                     timeout=QUEUE_DEPTH_TIMEOUT)
+        result = connection.default_channel.queue_declare(queue=queue,
+                                                          passive=True)
+    return result.message_count
+
+
+def admission_control_enabled():
+    return any((settings.WEBHOOK_RECEIVER_MAX_QUEUE_DEPTH,
+                settings.WEBHOOK_RECEIVER_MAX_INGEST_LATENCY))
+
+
+def overload_reason():
+    """Return why we are overloaded, or None if we aren't."""
+    max_depth = settings.WEBHOOK_RECEIVER_MAX_QUEUE_DEPTH
+    depth = _queue_depth.depth
+    if max_depth and depth is not None and depth > max_depth:
+        return 'broker queue holds %d messages' % depth
+
+    max_latency = settings.WEBHOOK_RECEIVER_MAX_INGEST_LATENCY
+    if max_latency:
+        latency = _latencies.mean(
+            settings.WEBHOOK_RECEIVER_INGEST_LATENCY_WINDOW)
+        if latency is not None and latency > max_latency:
+            return 'mean ingest latency is %.3f seconds' % latency
+
+    return None
+
+
+def log_transition(reason):
+    """Log when we start or stop shedding load (but not for every
+    webhook that we shed)."""
+    global _overloaded
+    overloaded = reason is not None
+    if overloaded == _overloaded:
+        return
+    _overloaded = overloaded
+    if overloaded:
+        logger.warning('Shedding load: %s' % reason)
+    else:
+        logger.info('No longer shedding load')
+
+
+def check_admission():
+    """Return why we should shed load, or None if we shouldn't."""
+    if settings.WEBHOOK_RECEIVER_MAX_QUEUE_DEPTH:
+        _queue_depth.refresh()
+    reason = overload_reason()
+    log_transition(reason)
+    return reason
+
+
+async def acheck_admission():
+    """Async counterpart of check_admission()."""
+    if settings.WEBHOOK_RECEIVER_MAX_QUEUE_DEPTH:
+        _queue_depth.refresh()
+    reason = overload_reason()
+    log_transition(reason)
+    return reason
+
+
+def record_latency(latency):
+    """Record the time it took to ingest a webhook we admitted."""
+    if settings.WEBHOOK_RECEIVER_MAX_INGEST_LATENCY:
+        _latencies.add(latency,
+                       settings.WEBHOOK_RECEIVER_INGEST_LATENCY_WINDOW)
+
+
+def retry_response(status):
+    response = HttpResponse(status=status)
+    response['Retry-After'] = str(settings.WEBHOOK_RECEIVER_RETRY_AFTER)
+    return response
+
+
+def processing_deferred(request):
+    """Check whether we admitted a webhook request on the condition
+    that we don't process its order (see deferred_response())."""
+    return getattr(request, 'defer_processing', False)
+
+
+def deferred_response():
+    """Return the response to a webhook that we have stored, but
+    whose order we leave to a later delivery of the webhook."""
+    return retry_response(429)
+
+
+def reset_admission():
+    """Forget all measurements."""
+    global _latencies, _queue_depth, _overloaded
+    _latencies = LatencyWindow()
+    _queue_depth = QueueDepth()
+    _overloaded = False
@@ -0,0 +1,147 @@
+"""Allowlists of the networks that webhooks may come from.
+
+Each platform's entry in WEBHOOK_RECEIVER_SETTINGS can list the
+networks (in CIDR notation) that we accept its webhooks from, under
+the "allowed_networks" key: Shopify's published egress ranges, for
+example, or the hosts that run our WooCommerce sites. We check the
+client IP address of a webhook request against that list before we
+read the request body, so that requests from anywhere else cost next
+to nothing. A platform without allowed networks accepts webhooks from
+anywhere.
+
+Rather than compare a client IP address with each network in turn, we
+compile the list into one set of network addresses per prefix length,
+and look up the address, masked with each prefix length, in these
+sets. A lookup thus takes as many set lookups as there are distinct
+prefix lengths in the list, no matter how many networks it holds. We
+compile each platform's list once per process, and again whenever the
+settings change.
+
+The client IP address is that which the request came from, unless
+that is one of the reverse proxies listed (in CIDR notation, too) in
+WEBHOOK_RECEIVER_TRUSTED_PROXIES. Only then do we look at the
+X-Forwarded-For header, from right to left, for the first address
+that isn't a trusted proxy's. Anybody can send an X-Forwarded-For
+header, so trusting it from anywhere else would let any client pick
+its own address.
+"""
+
+import ipaddress
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+
+class Allowlist(object):
+
+    def __init__(self, networks):
+        parsed = {4: [], 6: []}
+        for network in networks:
+            try:
+                network = ipaddress.ip_network(network.strip(),
+                                               strict=False)
+            except ValueError as e:
+                raise ImproperlyConfigured('Invalid allowed network: '
+                                           '%s' % e)
+            parsed[network.version].append(network)
+
+        # Maps IP versions to a tuple of (netmask, network addresses)
+        # pairs, with addresses and masks as integers
+        self.masks = {}
+        for version, version_networks in parsed.items():
+            by_mask = {}
+            for network in ipaddress.collapse_addresses(version_networks):
+                by_mask.setdefault(int(network.netmask),
+                                   set()).add(int(network.network_address))
+            self.masks[version] = tuple(by_mask.items())
+
+    def __contains__(self, ip):
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+        # An IPv4 client of a dual-stack server may show up as an
+        # IPv4-mapped IPv6 address.
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        value = int(address)
+        for mask, addresses in self.masks[address.version]:
+            if value & mask in addresses:
+                return True
+        return False
+
+
+# Maps platforms to their allowlist, or to None if they accept
+# webhooks from anywhere.
+_allowlists = {}
+_allowlists_lock = threading.Lock()
+
+# The allowlist of trusted proxies, or None if we have not compiled it
+# yet, or False if we trust none.
+_trusted_proxies = None
+
+
+def get_allowlist(platform):
+    """Return a platform's allowlist, or None if it accepts webhooks
+    from anywhere."""
+    try:
+        return _allowlists[platform]
+    except KeyError:
+        pass
+    with _allowlists_lock:
+        if platform not in _allowlists:
+            conf = settings.WEBHOOK_RECEIVER_SETTINGS[platform]
+            networks = conf.get('allowed_networks')
+            _allowlists[platform] = Allowlist(networks) if networks else None
+        return _allowlists[platform]
+
+
+def get_trusted_proxies():
+    """Return the allowlist of trusted reverse proxies, or None if we
+    trust none."""
+    global _trusted_proxies
+    proxies = _trusted_proxies
+    if proxies is None:
+        with _allowlists_lock:
+            if _trusted_proxies is None:
+                networks = settings.WEBHOOK_RECEIVER_TRUSTED_PROXIES
+                _trusted_proxies = (Allowlist(networks) if networks
+                                    else False)
+            proxies = _trusted_proxies
+    return proxies or None
+
+
+def client_ip(request):
+    """Return the client IP address of a request, or None if we can't
+    tell it."""
+    ip = request.META.get('REMOTE_ADDR') or None
+    proxies = get_trusted_proxies()
+    if ip is None or proxies is None or ip not in proxies:
+        return ip
+
+    forwarded = request.META.get('HTTP_X_FORWARDED_FOR', '')
+    for hop in reversed(forwarded.split(',')):
+        hop = hop.strip()
+        if not hop:
+            continue
+        ip = hop
+        if hop not in proxies:
+            break
+    return ip
+
+
+def reset_allowlists():
+    global _trusted_proxies
+    with _allowlists_lock:
+        _allowlists.clear()
+        _trusted_proxies = None
+
+
+@receiver(setting_changed)
+def allowlist_settings_changed(setting, **kwargs):
+    if setting in ('WEBHOOK_RECEIVER_SETTINGS',
+                   'WEBHOOK_RECEIVER_TRUSTED_PROXIES'):
+        reset_allowlists()
@@ -0,0 +1,12 @@
+import os
+from os.path import abspath, dirname
+from sys import path
+
+SITE_ROOT = dirname(dirname(abspath(__file__)))
+path.append(SITE_ROOT)
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "webhooks.settings.local")
+
+from django.core.asgi import get_asgi_application  # noqa: E402
+
+application = get_asgi_application()
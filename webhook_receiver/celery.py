@@ -1,7 +1,21 @@
 from celery import Celery
 from django.conf import settings
 
+from .jsonbackend import register_serializer
+
+register_serializer()
+
 app = Celery('webhook_receiver')
 
 app.config_from_object('django.conf:settings')
 app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
+
+
+@app.on_after_configure.connect
+def setup_periodic_tasks(sender, **kwargs):
+    interval = settings.WEBHOOK_RECEIVER_SKU_SYNC_INTERVAL
+    if interval:
+        sender.add_periodic_task(
+            interval,
+            sender.signature('webhook_receiver.tasks.sync_sku_mappings'),
+            name='sync SKU mappings')
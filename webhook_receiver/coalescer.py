@@ -0,0 +1,138 @@
+"""Coalescing enrollments across orders.
+
+Batched enrollment (see webhook_receiver.utils.enroll_order_items())
+sends all enrollments of one order with as few bulk enrollment
+requests as possible. During a flash sale for a single course,
+however, we process hundreds of orders that each enroll a single
+learner. With enrollment coalescing enabled, order processing tasks
+that run concurrently in the same worker process hand their
+enrollments to a shared buffer, which collects them for a short time
+window (or until a maximum number of enrollments is pending), and
+then sends all of them together, again with as few requests as
+possible. Each task blocks until its own enrollments have been sent,
+and gets the outcome of each of them.
+
+Celery's default prefork pool runs only one task per worker process
+at a time, so to benefit from coalescing, run your workers with a
+pool that runs tasks concurrently in threads or greenlets (such as
+"--pool threads").
+"""
+
+import threading
+import time
+
+from django.conf import settings
+
+
+class PendingEnrollment(object):
+
+    def __init__(self, enrollment):
+        self.enrollment = enrollment
+        self.lead = False
+        self.done = False
+        self.error = None
+
+
+class EnrollmentCoalescer(object):
+    """Collect concurrent enrollments, and send them in batches.
+
+    Like GroupCommit, the thread whose enrollments start a batch
+    becomes its leader: it waits for up to window seconds, or until
+    max_enrollments enrollments are pending, and then sends all
+    pending enrollments by calling send with a list of them. send
+    must return a list with an error for each enrollment: None if it
+    succeeded, or else the exception it failed with.
+    """
+
+    def __init__(self, send, window=0.05, max_enrollments=100):
+        self.send_batch = send
+        self.window = window
+        self.max_enrollments = max_enrollments
+
+        self.cond = threading.Condition()
+        self.pending = []
+        self.collecting = False
+
+    def enroll(self, enrollments):
+        """Send enrollments together with concurrent ones, and return
+        the list of their errors, once all have been sent."""
+        entries = [PendingEnrollment(enrollment)
+                   for enrollment in enrollments]
+        if not entries:
+            return []
+
+        with self.cond:
+            self.pending.extend(entries)
+            if not self.collecting:
+                self.collecting = True
+                entries[0].lead = True
+            elif len(self.pending) >= self.max_enrollments:
+                self.cond.notify_all()
+
+        while True:
+            with self.cond:
+                while not any(entry.lead for entry in entries):
+                    if all(entry.done for entry in entries):
+                        return [entry.error for entry in entries]
+                    self.cond.wait()
+                leader = next(entry for entry in entries if entry.lead)
+                batch = self._collect(leader)
+            self._send(batch)
+
+    def _collect(self, leader):
+        # Called with self.cond held.
+        deadline = time.monotonic() + self.window
+        while len(self.pending) < self.max_enrollments:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self.cond.wait(remaining)
+
+        batch = self.pending[:self.max_enrollments]
+        del self.pending[:self.max_enrollments]
+        leader.lead = False
+
+        # Hand over leadership, so the next batch is collected while
+        # we send this one.
+        if self.pending:
+            self.pending[0].lead = True
+            self.cond.notify_all()
+        else:
+            self.collecting = False
+
+        return batch
+
+    def _send(self, batch):
+        try:
+            errors = self.send_batch([entry.enrollment for entry in batch])
+        except Exception as e:
+            errors = [e] * len(batch)
+
+        with self.cond:
+            for entry, error in zip(batch, errors):
+                entry.done = True
+                entry.error = error
+            self.cond.notify_all()
+
+
+_coalescer = None
+_coalescer_lock = threading.Lock()
+
+
+def get_enrollment_coalescer(send):
+    """Return the enrollment coalescer, which sends enrollments with
+    send, or None if enrollment coalescing is disabled."""
+    global _coalescer
+
+    window = settings.WEBHOOK_RECEIVER_ENROLLMENT_WINDOW
+    if not window:
+        return None
+
+    max_enrollments = settings.WEBHOOK_RECEIVER_ENROLLMENT_MAX_BATCH
+    with _coalescer_lock:
+        if _coalescer is None or (_coalescer.send_batch,
+                                  _coalescer.window,
+                                  _coalescer.max_enrollments) != (
+                                      send, window, max_enrollments):
+            _coalescer = EnrollmentCoalescer(send, window, max_enrollments)
+        return _coalescer
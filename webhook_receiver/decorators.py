@@ -0,0 +1,250 @@
+import asyncio
+import logging
+import time
+
+from functools import wraps
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotAllowed
+from django.utils.log import log_response
+
+from .admission import acheck_admission, admission_control_enabled
+from .admission import check_admission, record_latency, retry_response
+from .allowlist import client_ip, get_allowlist
+from .ratelimit import get_rate_limiter, throttled_response, webhook_source
+from .rejections import reject_webhook
+from .utils import DisallowedNetworkException
+from .utils import delivery_key, get_deliveries
+
+
+logger = logging.getLogger(__name__)
+
+
+# Django only learned to apply csrf_exempt and require_POST to
+# coroutine views in Django 5.0. Until we no longer support earlier
+# Django releases, our async views use these decorators instead.
+
+
+def async_csrf_exempt(view_func):
+    """Mark a coroutine view as being exempt from CSRF protection."""
+    @wraps(view_func)
+    async def wrapper_view(*args, **kwargs):
+        return await view_func(*args, **kwargs)
+
+    wrapper_view.csrf_exempt = True
+    return wrapper_view
+
+
+def async_require_POST(view_func):
+    """Make a coroutine view accept only POST requests."""
+    @wraps(view_func)
+    async def inner(request, *args, **kwargs):
+        if request.method != 'POST':
+            response = HttpResponseNotAllowed(['POST'])
+            log_response(
+                'Method Not Allowed (%s): %s',
+                request.method,
+                request.path,
+                response=response,
+                request=request,
+            )
+            return response
+        return await view_func(request, *args, **kwargs)
+
+    return inner
+
+
+def deduplicate_deliveries(platform, header, shop_header):
+    """Acknowledge redelivered webhooks right away.
+
+    Record the delivery ID (from the given request header) of every
+    webhook that the decorated view accepts with HTTP 200, along with
+    the shop that sent it (from shop_header), and respond to any
+    later request from the same shop with the same delivery ID with
+    HTTP 200, without calling the view. Works with both regular and
+    coroutine views.
+
+    In fast-ack mode, the view accepts webhooks before verifying
+    their signatures, so the decorator only checks delivery IDs, and
+    the ingest task records them (see record_delivery()) once it has
+    verified the webhook.
+    """
+    def decorator(view_func):
+        if asyncio.iscoroutinefunction(view_func):
+            @wraps(view_func)
+            async def inner(request, *args, **kwargs):
+                deliveries = get_deliveries(platform)
+                key = delivery_key(request.headers, header, shop_header)
+                if deliveries is None or key is None:
+                    return await view_func(request, *args, **kwargs)
+
+                if await deliveries.acontains(key):
+                    logger.info('Acknowledging redelivered '
+                                'webhook %s' % key[1])
+                    return HttpResponse(status=200)
+
+                response = await view_func(request, *args, **kwargs)
+                if all((response.status_code == 200,
+                        not settings.WEBHOOK_RECEIVER_FAST_ACK)):
+                    await deliveries.aadd(key)
+                return response
+        else:
+            @wraps(view_func)
+            def inner(request, *args, **kwargs):
+                deliveries = get_deliveries(platform)
+                key = delivery_key(request.headers, header, shop_header)
+                if deliveries is None or key is None:
+                    return view_func(request, *args, **kwargs)
+
+                if key in deliveries:
+                    logger.info('Acknowledging redelivered '
+                                'webhook %s' % key[1])
+                    return HttpResponse(status=200)
+
+                response = view_func(request, *args, **kwargs)
+                if all((response.status_code == 200,
+                        not settings.WEBHOOK_RECEIVER_FAST_ACK)):
+                    deliveries.add(key)
+                return response
+
+        return inner
+
+    return decorator
+
+
+def check_network(platform, request, allowed_headers):
+    """Return the response to a webhook request from outside the
+    platform's allowed networks, or None if we accept the request."""
+    allowlist = get_allowlist(platform)
+    if allowlist is None:
+        return None
+    ip = client_ip(request)
+    if ip is not None and ip in allowlist:
+        return None
+    e = DisallowedNetworkException('Client IP %s is not in an allowed '
+                                   'network' % ip)
+    reject_webhook(platform, request, e, allowed_headers)
+    return HttpResponse(status=e.status)
+
+
+def restrict_networks(platform, allowed_headers):
+    """Reject webhooks from outside the platform's allowed networks.
+
+    Respond to requests whose client IP address is not in one of the
+    networks listed in the platform's "allowed_networks" setting (see
+    webhook_receiver.allowlist) with HTTP 403, without calling the
+    decorated view, and count and sample them like other early
+    rejections, logging only the allowed headers. Works with both
+    regular and coroutine views.
+    """
+    def decorator(view_func):
+        if asyncio.iscoroutinefunction(view_func):
+            @wraps(view_func)
+            async def inner(request, *args, **kwargs):
+                response = check_network(platform, request,
+                                         allowed_headers)
+                if response is not None:
+                    return response
+                return await view_func(request, *args, **kwargs)
+        else:
+            @wraps(view_func)
+            def inner(request, *args, **kwargs):
+                response = check_network(platform, request,
+                                         allowed_headers)
+                if response is not None:
+                    return response
+                return view_func(request, *args, **kwargs)
+
+        return inner
+
+    return decorator
+
+
+def rate_limit(platform, header):
+    """Limit the rate of webhooks from each source.
+
+    Identify the source of a webhook by its platform, the shop named
+    in the given request header, and the client IP address, and
+    respond with HTTP 429 and a Retry-After header, without calling
+    the decorated view, if the source exceeds its rate limit (see
+    webhook_receiver.ratelimit). Works with both regular and coroutine
+    views.
+    """
+    def decorator(view_func):
+        if asyncio.iscoroutinefunction(view_func):
+            @wraps(view_func)
+            async def inner(request, *args, **kwargs):
+                limiter = get_rate_limiter()
+                if limiter is not None:
+                    source = webhook_source(platform, request, header)
+                    wait = await limiter.atake(source)
+                    if wait is not None:
+                        return throttled_response(wait)
+                return await view_func(request, *args, **kwargs)
+        else:
+            @wraps(view_func)
+            def inner(request, *args, **kwargs):
+                limiter = get_rate_limiter()
+                if limiter is not None:
+                    source = webhook_source(platform, request, header)
+                    wait = limiter.take(source)
+                    if wait is not None:
+                        return throttled_response(wait)
+                return view_func(request, *args, **kwargs)
+
+        return inner
+
+    return decorator
+
+
+def admission_control(view_func):
+    """Shed load while we are overloaded.
+
+    In "reject" shed mode, respond with HTTP 503 and a Retry-After
+    header without calling the decorated view. In "defer" mode, call
+    the view, but mark the request so that the view stores the
+    webhook without processing it (see
+    webhook_receiver.admission.processing_deferred()). Also record
+    how long the view takes. Works with both regular and coroutine
+    views.
+    """
+    def shed(request):
+        if settings.WEBHOOK_RECEIVER_SHED_MODE == 'defer':
+            request.defer_processing = True
+            return None
+        return retry_response(503)
+
+    if asyncio.iscoroutinefunction(view_func):
+        @wraps(view_func)
+        async def inner(request, *args, **kwargs):
+            if not admission_control_enabled():
+                return await view_func(request, *args, **kwargs)
+
+            reason = await acheck_admission()
+            if reason is not None:
+                response = shed(request)
+                if response is not None:
+                    return response
+
+            start = time.monotonic()
+            response = await view_func(request, *args, **kwargs)
+            record_latency(time.monotonic() - start)
+            return response
+    else:
+        @wraps(view_func)
+        def inner(request, *args, **kwargs):
+            if not admission_control_enabled():
+                return view_func(request, *args, **kwargs)
+
+            reason = check_admission()
+            if reason is not None:
+                response = shed(request)
+                if response is not None:
+                    return response
+
+            start = time.monotonic()
+            response = view_func(request, *args, **kwargs)
+            record_latency(time.monotonic() - start)
+            return response
+
+    return inner
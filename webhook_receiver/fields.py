@@ -0,0 +1,168 @@
+"""Model fields for compact webhook storage.
+
+In compact storage mode, we store webhook bodies gzip-compressed, and
+we do not store the parsed webhook content at all, but parse it from
+the body when it is first accessed. Compressed bodies are marked with
+a prefix of our own, so rows stored before enabling compact storage,
+or after disabling it, remain readable. A raw body can carry that
+prefix, too, so we always store such a body compressed, even outside
+compact storage mode; that way, we only ever decompress what we
+compressed ourselves. We also refuse to decompress a body beyond
+WEBHOOK_RECEIVER_MAX_BODY_SIZE bytes.
+
+In body store mode, a webhook's body is not stored with the webhook
+at all, but in a separate table of bodies keyed by their digest (see
+WebhookBody), which the webhook references.
+"""
+
+import logging
+import zlib
+
+from django.conf import settings
+from django.db.models import BinaryField
+from django.db.models.query_utils import DeferredAttribute
+try:
+    # Django 3.1 and later has a built-in JSONField
+    from django.db.models import JSONField
+except ImportError:
+    # For earlier Django versions we must use JSONField from
+    # django-jsonfield-backport
+    from django_jsonfield_backport.models import JSONField
+
+from . import jsonbackend
+
+
+# The prefix of a compressed body, followed by a gzip stream
+COMPRESSED_PREFIX = b'\x00webhook-receiver-gzip\x00'
+# zlib window size setting for gzip-framed streams
+GZIP_WBITS = 31
+
+logger = logging.getLogger(__name__)
+
+
+class CompressedBody(bytes):
+    """A body that compress_body() has compressed, and that we thus
+    store as it is."""
+
+
+class OversizedBodyException(ValueError):
+    """A compressed body that decompresses to more than
+    WEBHOOK_RECEIVER_MAX_BODY_SIZE bytes."""
+
+
+def is_compressed(value):
+    return bytes(value[:len(COMPRESSED_PREFIX)]) == COMPRESSED_PREFIX
+
+
+def compress_body(body):
+    """Return a webhook body gzip-compressed, and marked as such."""
+    compressed = zlib.compress(bytes(body), wbits=GZIP_WBITS)
+    return CompressedBody(COMPRESSED_PREFIX + compressed)
+
+
+def decompress_body(value):
+    """Return a webhook body as stored by CompressedBinaryField,
+    decompressed if it was stored compressed."""
+    if not is_compressed(value):
+        return value
+
+    max_size = settings.WEBHOOK_RECEIVER_MAX_BODY_SIZE
+    compressed = bytes(value[len(COMPRESSED_PREFIX):])
+    decompressor = zlib.decompressobj(wbits=GZIP_WBITS)
+    try:
+        body = decompressor.decompress(compressed, max_size + 1)
+    except zlib.error:
+        # We only ever store prefixed bodies compressed, so this is a
+        # corrupted row.
+        logger.warning('Unable to decompress stored body')
+        return compressed
+    if len(body) > max_size or decompressor.unconsumed_tail:
+        raise OversizedBodyException('Stored body exceeds %d bytes '
+                                     'when decompressed' % max_size)
+    return body
+
+
+class StoredBodyDescriptor(DeferredAttribute):
+
+    def __get__(self, instance, cls=None):
+        value = super().__get__(instance, cls)
+        if instance is None or value:
+            return value
+
+        # The body of a webhook that references the body store is
+        # stored there, rather than with the webhook itself.
+        if getattr(instance, 'stored_body_id', None) is None:
+            return value
+        value = instance.stored_body.body
+        instance.__dict__[self.field.attname] = value
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
+
+class CompressedBinaryField(BinaryField):
+    """A binary field that in compact storage mode is stored
+    compressed, and that is always decompressed when loaded.
+
+    If the model instance references a body in the body store (via
+    its stored_body foreign key), we store an empty value instead,
+    and read the value from the body store on access.
+    """
+    descriptor_class = StoredBodyDescriptor
+
+    def pre_save(self, model_instance, add):
+        if getattr(model_instance, 'stored_body_id', None) is not None:
+            return b''
+        return super().pre_save(model_instance, add)
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        # A raw body that looks compressed must be stored compressed,
+        # so that we read it back as it was.
+        if isinstance(value, CompressedBody):
+            pass
+        elif value and any((settings.WEBHOOK_RECEIVER_COMPACT_STORAGE,
+                            is_compressed(value))):
+            value = compress_body(value)
+        return super().get_db_prep_value(value, connection, prepared)
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return decompress_body(value)
+
+
+class BodyContentDescriptor(DeferredAttribute):
+
+    def __get__(self, instance, cls=None):
+        value = super().__get__(instance, cls)
+        if instance is None or value is not None or not instance.body:
+            return value
+
+        try:
+            value = jsonbackend.loads(bytes(instance.body))
+        except ValueError:
+            # The body is not valid JSON, so it has no content.
+            return None
+
+        instance.__dict__[self.field.attname] = value
+        return value
+
+    def __set__(self, instance, value):
+        # Defining __set__ makes this a data descriptor, so that
+        # __get__ is called even once the instance has a value.
+        instance.__dict__[self.field.attname] = value
+
+
+class BodyContentField(JSONField):
+    """A JSON field for the parsed body of a webhook.
+
+    If the field has no value, we parse it from the webhook body on
+    access. In compact storage mode, the field is never stored.
+    """
+    descriptor_class = BodyContentDescriptor
+
+    def pre_save(self, model_instance, add):
+        if settings.WEBHOOK_RECEIVER_COMPACT_STORAGE:
+            return None
+        return super().pre_save(model_instance, add)
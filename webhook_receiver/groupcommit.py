@@ -0,0 +1,149 @@
+"""Group commit for webhook inserts.
+
+Under burst load, having every receiver thread commit its own webhook
+row makes the database spend most of its time on commits. With group
+commit enabled, concurrent inserts are collected for a short time
+window (or until a maximum number of rows is pending), and then
+written with a single bulk insert, in a single transaction. Each
+request still blocks until its own row has been committed.
+"""
+
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from .models import JSONWebhookData
+
+
+def insert_webhooks(webhooks):
+    """Insert webhooks into the database, preferably with a single
+    statement, and return them with their primary keys set."""
+    # bulk_create() bypasses JSONWebhookData.save(), so we must store
+    # bodies in the body store ourselves.
+    for data in webhooks:
+        data.store_body()
+
+    if connection.features.can_return_rows_from_bulk_insert:
+        return JSONWebhookData.objects.bulk_create(webhooks)
+
+    # Without bulk-insert support for returning primary keys, we
+    # must insert webhooks one by one.
+    for data in webhooks:
+        data.save()
+    return webhooks
+
+
+class PendingInsert(object):
+
+    def __init__(self, instance):
+        self.instance = instance
+        self.lead = False
+        self.done = False
+        self.error = None
+
+
+class GroupCommit(object):
+    """Collect concurrent inserts, and write them in batches.
+
+    The first thread to insert a row while no batch is being collected
+    becomes the leader: it waits for up to window seconds, or until
+    max_rows rows are pending, and then writes all pending rows by
+    calling insert with a list of them, inside a transaction. As soon
+    as the leader has taken its batch, the oldest remaining pending
+    row's thread becomes the leader for the next batch.
+    """
+
+    def __init__(self, insert, window=0.003, max_rows=50):
+        self.insert_batch = insert
+        self.window = window
+        self.max_rows = max_rows
+
+        self.cond = threading.Condition()
+        self.pending = []
+        self.collecting = False
+
+    def insert(self, instance):
+        """Insert instance together with concurrently inserted ones, and
+        return once it has been committed."""
+        entry = PendingInsert(instance)
+        with self.cond:
+            self.pending.append(entry)
+            if not self.collecting:
+                self.collecting = True
+                entry.lead = True
+            elif len(self.pending) >= self.max_rows:
+                self.cond.notify_all()
+
+        while True:
+            with self.cond:
+                while not (entry.done or entry.lead):
+                    self.cond.wait()
+                if entry.done:
+                    break
+                batch = self._collect(entry)
+            self._write(batch)
+
+        if entry.error is not None:
+            raise entry.error
+        return instance
+
+    def _collect(self, leader):
+        # Called with self.cond held.
+        deadline = time.monotonic() + self.window
+        while len(self.pending) < self.max_rows:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self.cond.wait(remaining)
+
+        batch = self.pending[:self.max_rows]
+        del self.pending[:self.max_rows]
+        leader.lead = False
+
+        # Hand over leadership, so the next batch is collected while
+        # we write this one.
+        if self.pending:
+            self.pending[0].lead = True
+            self.cond.notify_all()
+        else:
+            self.collecting = False
+
+        return batch
+
+    def _write(self, batch):
+        error = None
+        try:
+            with transaction.atomic():
+                self.insert_batch([entry.instance for entry in batch])
+        except Exception as e:
+            error = e
+
+        with self.cond:
+            for entry in batch:
+                entry.done = True
+                entry.error = error
+            self.cond.notify_all()
+
+
+_group_commit = None
+_group_commit_lock = threading.Lock()
+
+
+def get_group_commit():
+    """Return the group commit buffer for webhook inserts, or None if
+    group commit is disabled."""
+    global _group_commit
+
+    window = settings.WEBHOOK_RECEIVER_GROUP_COMMIT_WINDOW
+    if not window:
+        return None
+
+    max_rows = settings.WEBHOOK_RECEIVER_GROUP_COMMIT_MAX_ROWS
+    with _group_commit_lock:
+        if _group_commit is None or (_group_commit.window,
+                                     _group_commit.max_rows) != (window,
+                                                                 max_rows):
+            _group_commit = GroupCommit(insert_webhooks, window, max_rows)
+        return _group_commit
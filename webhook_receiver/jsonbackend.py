@@ -0,0 +1,178 @@
+"""Pluggable JSON backends.
+
+We parse every webhook payload as JSON, encode the parsed payload
+into a JSON database field, and then encode it once more into the
+Celery task message that processes the order. By default, we use the
+standard library's json module for all of that. With
+WEBHOOK_RECEIVER_JSON_BACKEND set to "orjson", we use orjson instead,
+which is considerably faster.
+
+orjson is stricter than the standard library: it rejects NaN,
+integers beyond 64 bits, and dictionaries with non-string keys, for
+example. For anything that orjson rejects, we fall back to the
+standard library. orjson also decodes integers beyond 64 bits as
+floats, rather than rejecting them, so we decode documents that may
+contain such integers with the standard library, too. We also fall
+back to the standard library if orjson is not installed.
+"""
+
+import json
+import logging
+import re
+
+from django.conf import settings
+
+from kombu.serialization import register
+from kombu.utils import json as kombu_json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# The name and content type of our Celery serializer.
+SERIALIZER = 'webhook-json'
+CONTENT_TYPE = 'application/x-webhook-json'
+
+# Any integer beyond 64 bits has at least 19 digits.
+LONG_NUMBER = re.compile(r'\d{19}')
+LONG_NUMBER_BYTES = re.compile(rb'\d{19}')
+
+logger = logging.getLogger(__name__)
+
+
+def has_long_number(s):
+    """Check whether a JSON document may contain an integer that
+    orjson would decode inexactly."""
+    if isinstance(s, str):
+        return LONG_NUMBER.search(s) is not None
+    return LONG_NUMBER_BYTES.search(s) is not None
+
+
+class StdlibBackend(object):
+    """The standard library's json module.
+
+    Task messages are encoded and decoded by kombu, so that they
+    retain kombu's type markers for dates, decimals and the like.
+    """
+    name = 'json'
+
+    def loads(self, s):
+        return json.loads(s)
+
+    def dumps(self, obj):
+        return json.dumps(obj)
+
+    def dumps_message(self, obj):
+        return kombu_json.dumps(obj)
+
+    def loads_message(self, data):
+        return kombu_json.loads(data)
+
+
+class ORJSONBackend(StdlibBackend):
+    """orjson, falling back to the standard library for anything
+    that orjson rejects."""
+    name = 'orjson'
+
+    def loads(self, s):
+        if has_long_number(s):
+            return super().loads(s)
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            return super().loads(s)
+
+    def dumps(self, obj):
+        try:
+            return orjson.dumps(obj).decode('utf-8')
+        except orjson.JSONEncodeError:
+            return super().dumps(obj)
+
+    def dumps_message(self, obj):
+        # Let kombu encode whatever orjson can't, so that kombu's
+        # type markers survive.
+        try:
+            return orjson.dumps(obj,
+                                default=kombu_json.JSONEncoder().default,
+                                option=orjson.OPT_PASSTHROUGH_DATETIME)
+        except orjson.JSONEncodeError:
+            return super().dumps_message(obj)
+
+    def loads_message(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        # Messages with kombu's type markers, or integers that orjson
+        # could not encode, are for kombu to decode.
+        if b'"__type__"' in data or has_long_number(data):
+            return super().loads_message(data)
+        return orjson.loads(data)
+
+
+BACKENDS = {
+    StdlibBackend.name: StdlibBackend(),
+}
+if orjson is not None:
+    BACKENDS[ORJSONBackend.name] = ORJSONBackend()
+
+_unavailable = set()
+
+
+def get_backend():
+    """Return the configured JSON backend."""
+    name = settings.WEBHOOK_RECEIVER_JSON_BACKEND
+    backend = BACKENDS.get(name)
+    if backend is None:
+        # Warn only once per process.
+        if name not in _unavailable:
+            _unavailable.add(name)
+            logger.warning('JSON backend %s is not available, '
+                           'using json instead' % name)
+        backend = BACKENDS[StdlibBackend.name]
+    return backend
+
+
+def loads(s):
+    """Parse a JSON document with the configured backend."""
+    return get_backend().loads(s)
+
+
+def dumps(obj):
+    """Encode obj as a JSON string with the configured backend."""
+    return get_backend().dumps(obj)
+
+
+class JSONEncoder(json.JSONEncoder):
+    """An encoder for JSONField, using the configured backend."""
+
+    def encode(self, o):
+        return dumps(o)
+
+
+class JSONDecoder(json.JSONDecoder):
+    """A decoder for JSONField, using the configured backend."""
+
+    def decode(self, s):
+        return loads(s)
+
+
+def dumps_message(obj):
+    return get_backend().dumps_message(obj)
+
+
+def loads_message(data):
+    # A worker must be able to decode whatever a producer sends, so
+    # we decode with the fastest backend available, regardless of
+    # configuration.
+    backend = BACKENDS.get(ORJSONBackend.name, BACKENDS[StdlibBackend.name])
+    return backend.loads_message(data)
+
+
+def register_serializer():
+    """Register our Celery serializer with kombu."""
+    register(SERIALIZER,
+             dumps_message,
+             loads_message,
+             content_type=CONTENT_TYPE,
+             content_encoding='utf-8')
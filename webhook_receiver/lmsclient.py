@@ -0,0 +1,203 @@
+"""A shared client for the Open edX LMS APIs.
+
+Rather than create a new API client for every enrollment, which then
+has to fetch an OAuth2 access token, and open a new connection to the
+LMS, each process uses a single client. Being a requests session, the
+client keeps its connections to the LMS alive between requests.
+
+The client keeps its access token in memory, and shares it with all
+other processes through the Django cache, until shortly before it
+expires. When the token is about to expire, only one thread in each
+process, and (as long as the cache is available) only one process
+overall, fetches a new one: it holds a lease on refreshing the token
+in the cache, while the others wait for it to store the new token
+there.
+"""
+
+import datetime
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from edx_rest_api_client.client import OAuthAPIClient
+from edx_rest_api_client.client import get_oauth_access_token
+
+
+# We stop using an access token this many seconds before it expires.
+TOKEN_EXPIRY_MARGIN = 60
+
+# The number of seconds that a process may take to refresh the access
+# token, before another one tries. A process that waits this long for
+# another's refresh still has to fetch a token itself, and then enroll
+# learners, all within the 5-second soft time limit of the order
+# processing tasks, so keep this well below that.
+TOKEN_REFRESH_TIMEOUT = 2
+
+# The number of seconds between checks for a token that another
+# process is refreshing.
+TOKEN_POLL_INTERVAL = 0.05
+
+logger = logging.getLogger(__name__)
+
+
+class LMSClient(OAuthAPIClient):
+    """An OAuthAPIClient that shares its access token across threads
+    and processes."""
+
+    def __init__(self, base_url, client_id, client_secret, **kwargs):
+        super().__init__(base_url, client_id, client_secret, **kwargs)
+        key = '%s %s' % (self._base_url, client_id)
+        key = hashlib.sha256(key.encode('utf-8'))
+        self.token_key = 'webhook_receiver:lms_token:%s' % key.hexdigest()
+        self.lease_key = '%s:lease' % self.token_key
+
+        # The access token, and the wall clock time at which it
+        # expires
+        self.token = None
+        self.token_lock = threading.Lock()
+
+    def _ensure_authentication(self):
+        self.auth.token = self.get_access_token()
+
+    def get_access_token(self):
+        """Return an access token that does not expire within
+        TOKEN_EXPIRY_MARGIN seconds."""
+        token = usable(self.token)
+        if token is not None:
+            return token
+
+        # Only one thread refreshes the token, and the others wait
+        # for it.
+        with self.token_lock:
+            token = usable(self.token)
+            if token is not None:
+                return token
+
+            token = self.refresh_token()
+            return token
+
+    def refresh_token(self):
+        # Called with self.token_lock held.
+        shared = self.shared_token()
+        if usable(shared) is None:
+            try:
+                leased = cache.add(self.lease_key,
+                                   os.getpid(),
+                                   TOKEN_REFRESH_TIMEOUT)
+            except Exception as e:
+                logger.warning('Unable to lease access token '
+                               'refresh: %s' % e)
+                leased = True
+
+            if leased:
+                try:
+                    shared = self.fetch_token()
+                finally:
+                    try:
+                        cache.delete(self.lease_key)
+                    except Exception:
+                        pass
+            else:
+                shared = self.wait_for_token()
+
+        self.token = shared
+        return shared[0]
+
+    def shared_token(self):
+        try:
+            return cache.get(self.token_key)
+        except Exception as e:
+            logger.warning('Unable to get access token '
+                           'from cache: %s' % e)
+            return None
+
+    def wait_for_token(self):
+        """Wait for another process to store a new access token in
+        the cache, and return it. If that takes too long, fetch one
+        ourselves."""
+        deadline = time.monotonic() + TOKEN_REFRESH_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(TOKEN_POLL_INTERVAL)
+            shared = self.shared_token()
+            if usable(shared) is not None:
+                return shared
+        logger.warning('Timed out waiting for access token refresh')
+        return self.fetch_token()
+
+    def fetch_token(self):
+        """Fetch a new access token, store it in the cache, and return
+        it with its expiry time."""
+        logger.debug('Fetching access token from %s' % self._base_url)
+        access_token, expires_at = get_oauth_access_token(
+            self._base_url,
+            self._client_id,
+            self._client_secret,
+            grant_type='client_credentials',
+            timeout=self._timeout,
+        )
+        # get_oauth_access_token() returns a naive UTC datetime.
+        expires = expires_at.replace(
+            tzinfo=datetime.timezone.utc).timestamp()
+        token = (access_token, expires)
+
+        timeout = int(expires - time.time() - TOKEN_EXPIRY_MARGIN)
+        if timeout > 0:
+            try:
+                cache.set(self.token_key, token, timeout)
+            except Exception as e:
+                logger.warning('Unable to store access token '
+                               'in cache: %s' % e)
+        return token
+
+    def invalidate_token(self):
+        """Forget the access token, for example because the LMS has
+        rejected it."""
+        self.token = None
+        try:
+            cache.delete(self.token_key)
+        except Exception as e:
+            logger.warning('Unable to delete access token '
+                           'from cache: %s' % e)
+
+
+def usable(token):
+    """Return the access token of a (token, expiry time) tuple, or None
+    if there is no token, or it is about to expire."""
+    if token is None:
+        return None
+    access_token, expires = token
+    if expires - TOKEN_EXPIRY_MARGIN <= time.time():
+        return None
+    return access_token
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_lms_client():
+    """Return this process's LMS API client."""
+    global _client
+
+    conf = (os.getpid(),
+            settings.WEBHOOK_RECEIVER_LMS_BASE_URL,
+            settings.WEBHOOK_RECEIVER_EDX_OAUTH2_KEY,
+            settings.WEBHOOK_RECEIVER_EDX_OAUTH2_SECRET)
+    with _client_lock:
+        # A forked worker process must not share its parent's
+        # connections.
+        if _client is None or _client[0] != conf:
+            _client = (conf, LMSClient(*conf[1:]))
+        return _client[1]
+
+
+def reset_lms_client():
+    """Forget this process's LMS API client, and its access token."""
+    global _client
+    with _client_lock:
+        _client = None
@@ -0,0 +1,78 @@
+import glob
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from webhook_receiver.jsonbackend import BACKENDS, StdlibBackend
+
+
+def process_webhook(backend, body):
+    """Run a webhook body through all JSON processing steps that a
+    webhook goes through on its way to the order processing task."""
+    # Parse the payload
+    content = backend.loads(body)
+    # Encode the content into its JSONField
+    backend.dumps(content)
+    # Encode the order processing task message (args, kwargs, and
+    # embedded options, as in Celery task protocol 2), and decode it
+    # again on the worker.
+    message = backend.dumps_message([[content, True], {}, {
+        'callbacks': None,
+        'errbacks': None,
+        'chain': None,
+        'chord': None,
+    }])
+    backend.loads_message(message)
+
+
+class Command(BaseCommand):
+    help = ('Measure the CPU time that each available JSON backend '
+            'spends on processing webhook payloads.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'payloads',
+            nargs='*',
+            help='JSON payload files to process (default: the payloads '
+                 'in the tests directory).'
+        )
+        parser.add_argument(
+            '--iterations',
+            type=int,
+            default=2000,
+            help='The number of times to process each payload.'
+        )
+
+    def handle(self, *args, **options):
+        payloads = options['payloads'] or sorted(
+            glob.glob(os.path.join(settings.BASE_DIR, 'tests', '*.json')))
+        if not payloads:
+            raise CommandError('No payloads to process.')
+        iterations = options['iterations']
+
+        for path in payloads:
+            with open(path, 'rb') as f:
+                body = f.read()
+
+            baseline = None
+            for name, backend in sorted(BACKENDS.items()):
+                start = time.process_time()
+                for i in range(iterations):
+                    process_webhook(backend, body)
+                elapsed = (time.process_time() - start) / iterations
+                if name == StdlibBackend.name:
+                    baseline = elapsed
+                line = '%s (%d bytes), %s: %.1f µs per webhook' % (
+                    os.path.basename(path),
+                    len(body),
+                    name,
+                    elapsed * 1e6)
+                if name != StdlibBackend.name:
+                    line += ', %.0f%% less than json' % (
+                        100 * (1 - elapsed / baseline))
+                self.stdout.write(line)
+
+        if len(BACKENDS) == 1:
+            self.stdout.write('Install orjson to compare it with json.')
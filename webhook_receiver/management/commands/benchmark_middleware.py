@@ -0,0 +1,83 @@
+import gc
+import time
+
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.messages.middleware import MessageMiddleware
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.management.base import BaseCommand
+from django.http import HttpResponse
+from django.test import RequestFactory
+
+from webhook_receiver import middleware
+
+
+STACKS = (
+    ('django', (SessionMiddleware,
+                MessageMiddleware,
+                AuthenticationMiddleware)),
+    ('webhook_receiver', (middleware.SessionMiddleware,
+                          middleware.MessageMiddleware,
+                          middleware.AuthenticationMiddleware)),
+)
+
+
+def view(request):
+    return HttpResponse(status=200)
+
+
+def build_handler(classes):
+    """Wrap a view that does nothing in a stack of middleware, the
+    first of which is the outermost, like Django does."""
+    handler = view
+    for middleware_class in reversed(classes):
+        handler = middleware_class(handler)
+    return handler
+
+
+class Command(BaseCommand):
+    help = ('Measure the time that the middleware stack adds to each '
+            'webhook request.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--iterations',
+            type=int,
+            default=20000,
+            help='The number of requests to run through each stack.'
+        )
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        factory = RequestFactory()
+
+        paths = (
+            ('webhook', '/webhooks/shopify/order/create'),
+            ('admin', '/admin/'),
+        )
+        for kind, path in paths:
+            baseline = None
+            for name, classes in STACKS:
+                handler = build_handler(classes)
+                requests = [factory.post(path,
+                                         b'{}',
+                                         content_type='application/json')
+                            for i in range(iterations)]
+                # Like timeit, keep the garbage collector from skewing
+                # the results.
+                gc.collect()
+                gc.disable()
+                try:
+                    start = time.perf_counter()
+                    for request in requests:
+                        handler(request)
+                    elapsed = (time.perf_counter() - start) / iterations
+                finally:
+                    gc.enable()
+                if baseline is None:
+                    baseline = elapsed
+                self.stdout.write('%s request, %s middleware: %.1f µs per '
+                                  'request (%.2fx django)' % (
+                                      kind,
+                                      name,
+                                      elapsed * 1e6,
+                                      elapsed / baseline))
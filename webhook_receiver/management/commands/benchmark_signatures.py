@@ -0,0 +1,78 @@
+import base64
+import hashlib
+import hmac
+import os
+import time
+
+from django.core.management.base import BaseCommand
+
+from webhook_receiver.signing import Verifier
+
+
+SECRET = 'benchmark-secret'
+
+
+def legacy_hmac_is_valid(key, body, hmac_to_verify):
+    """Verify a signature the way we did before we had verifiers:
+    key a new HMAC for every webhook, and compare base64 strings."""
+    digest = hmac.new(key.encode('utf-8'),
+                      body,
+                      hashlib.sha256).digest()
+    return base64.b64encode(digest).decode() == hmac_to_verify
+
+
+class Command(BaseCommand):
+    help = ('Measure the time it takes to verify the signature of '
+            'webhook bodies of various sizes.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'sizes',
+            nargs='*',
+            type=int,
+            help='Body sizes in bytes (default: 1 KiB, 64 KiB, 1 MiB, '
+                 'and 2.5 MiB).'
+        )
+        parser.add_argument(
+            '--iterations',
+            type=int,
+            default=200,
+            help='The number of times to verify each body.'
+        )
+
+    def handle(self, *args, **options):
+        sizes = options['sizes'] or [1024, 64 * 1024, 1024 * 1024,
+                                     2621440]
+        iterations = options['iterations']
+
+        verifier = Verifier([SECRET])
+        rotating_verifier = Verifier(['new-secret', SECRET])
+        candidates = [
+            ('legacy', lambda body, signature: legacy_hmac_is_valid(
+                SECRET, body, signature)),
+            ('verifier', verifier.verify),
+            # A webhook signed with the previous secret, while that is
+            # being rotated, which is the worst case
+            ('verifier, previous secret', rotating_verifier.verify),
+        ]
+
+        for size in sizes:
+            body = os.urandom(size)
+            signature = base64.b64encode(hmac.new(SECRET.encode('utf-8'),
+                                                  body,
+                                                  hashlib.sha256).digest())
+            signature = signature.decode()
+
+            baseline = None
+            for name, verify in candidates:
+                start = time.perf_counter()
+                for i in range(iterations):
+                    assert verify(body, signature)
+                elapsed = (time.perf_counter() - start) / iterations
+                if baseline is None:
+                    baseline = elapsed
+                self.stdout.write('%d bytes, %s: %.1f µs per webhook '
+                                  '(%.2fx legacy)' % (size,
+                                                      name,
+                                                      elapsed * 1e6,
+                                                      elapsed / baseline))
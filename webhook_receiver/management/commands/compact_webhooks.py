@@ -0,0 +1,91 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from webhook_receiver.fields import compress_body
+from webhook_receiver.models import JSONWebhookData, WebhookBody
+from webhook_receiver_shopify.utils import WEBHOOK_HEADERS as SHOPIFY_HEADERS
+from webhook_receiver_woocommerce.utils import WEBHOOK_HEADERS as WC_HEADERS
+
+
+# The headers we keep, in lower case, for case-insensitive matching.
+ALLOWED_HEADERS = {name.lower() for name in SHOPIFY_HEADERS + WC_HEADERS}
+
+
+def compact_webhook(data):
+    """Compact the stored record of a webhook.
+
+    Compress its body (unless that is in the body store), drop all
+    headers that we don't need for verification and auditing, and
+    remove its separately stored content, which we parse from the
+    body on access.
+    """
+    values = {
+        'headers': {name: value
+                    for name, value in data.headers.items()
+                    if name.lower() in ALLOWED_HEADERS},
+        'content': None,
+    }
+    if data.stored_body_id is None:
+        values['body'] = compress_body(data.body)
+
+    # Use update() rather than save(), so that we neither touch the
+    # webhook status nor trigger lazy parsing of the content.
+    JSONWebhookData.objects.filter(pk=data.pk).update(**values)
+
+
+def compact_body(stored_body):
+    """Compress a body in the body store."""
+    WebhookBody.objects.filter(pk=stored_body.pk).update(
+        body=compress_body(stored_body.body))
+
+
+def chunks(queryset, chunk_size):
+    """Yield the objects in queryset in chunks of chunk_size.
+
+    Walk the table in primary key order, so that each chunk is a
+    cheap index range scan.
+    """
+    queryset = queryset.order_by('pk')
+    chunk = list(queryset[:chunk_size])
+    while chunk:
+        yield chunk
+        chunk = list(queryset.filter(pk__gt=chunk[-1].pk)[:chunk_size])
+
+
+class Command(BaseCommand):
+    help = ('Convert stored webhooks to compact storage: compress '
+            'their bodies, drop unneeded headers, and remove their '
+            'separately stored content.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=500,
+            help='The number of webhooks to convert per transaction.'
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+
+        # Compacting a webhook twice is harmless, so if we are
+        # interrupted, we can simply start over.
+        count = 0
+        for chunk in chunks(JSONWebhookData.objects.only('pk',
+                                                         'body',
+                                                         'headers',
+                                                         'stored_body'),
+                            chunk_size):
+            with transaction.atomic():
+                for data in chunk:
+                    compact_webhook(data)
+            count += len(chunk)
+            self.stdout.write('Compacted %d webhooks.' % count)
+
+        count = 0
+        for chunk in chunks(WebhookBody.objects.all(), chunk_size):
+            with transaction.atomic():
+                for stored_body in chunk:
+                    compact_body(stored_body)
+            count += len(chunk)
+            self.stdout.write('Compacted %d stored bodies.' % count)
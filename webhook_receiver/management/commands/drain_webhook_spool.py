@@ -0,0 +1,44 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError
+
+from webhook_receiver.spool import drain
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ('Insert webhooks spooled while the database was unavailable '
+            'into the database, and dispatch them for processing.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=0,
+            help='Keep draining the spool, at this interval in seconds, '
+                 'rather than draining it once.'
+        )
+
+    def handle(self, *args, **options):
+        directory = settings.WEBHOOK_RECEIVER_SPOOL_DIR
+        if not directory:
+            raise CommandError('WEBHOOK_RECEIVER_SPOOL_DIR is not set.')
+
+        interval = options['interval']
+        while True:
+            try:
+                count = drain(directory)
+                self.stdout.write('Drained %d webhooks.' % count)
+            except DatabaseError as e:
+                if not interval:
+                    raise CommandError('Unable to drain spool: %s' % e)
+                logger.error('Unable to drain spool, retrying: %s' % e)
+
+            if not interval:
+                break
+            time.sleep(interval)
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from webhook_receiver.skumappings import sync_sku_mappings
+
+
+class Command(BaseCommand):
+    help = ('Resolve SKUs on the LMS, and update the course IDs that '
+            'they map to.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'skus',
+            nargs='*',
+            help='The SKUs to resolve. By default, resolve all SKUs that '
+                 'are mapped, or that orders have been placed for.'
+        )
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Resolve all SKUs, rather than only those that have not '
+                 'been resolved for WEBHOOK_RECEIVER_SKU_SYNC_MAX_AGE '
+                 'seconds.'
+        )
+        parser.add_argument(
+            '--parallelism',
+            type=int,
+            default=None,
+            help='The number of SKUs to resolve concurrently (default: '
+                 'WEBHOOK_RECEIVER_SKU_SYNC_PARALLELISM).'
+        )
+
+    def handle(self, *args, **options):
+        counts = sync_sku_mappings(skus=options['skus'] or None,
+                                   max_age=0 if options['all'] else None,
+                                   parallelism=options['parallelism'])
+        self.stdout.write('Updated %(updated)d, unmapped %(unmapped)d, '
+                          'failed to resolve %(failed)d SKUs.' % counts)
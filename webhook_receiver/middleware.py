@@ -0,0 +1,54 @@
+"""Middleware that leaves webhook requests alone.
+
+Webhooks are machine-to-machine requests: they never carry a session
+cookie, leave messages for a user, or authenticate a user. Yet the
+session, message, and authentication middleware that the Django
+admin needs would set up a session store, a message storage, and a
+lazy user for every webhook request, and inspect them again on the
+way out. The middleware classes in this module are drop-in
+replacements for Django's, which pass requests for URLs under
+WEBHOOK_PATH_PREFIX straight on to the next middleware (or the view),
+and handle all other requests exactly like Django's.
+
+Since they subclass Django's middleware classes, the Django admin's
+system checks still find them in MIDDLEWARE.
+"""
+
+from django.contrib.auth import middleware as auth_middleware
+from django.contrib.messages import middleware as messages_middleware
+from django.contrib.sessions import middleware as sessions_middleware
+
+
+# The URL path prefix that all webhook endpoints share
+WEBHOOK_PATH_PREFIX = '/webhooks/'
+
+
+def is_webhook_request(request):
+    return request.path_info.startswith(WEBHOOK_PATH_PREFIX)
+
+
+class WebhookBypassMixin(object):
+    """Skip a middleware for webhook requests."""
+
+    def __call__(self, request):
+        # In async mode, get_response() returns a coroutine, which we
+        # hand back to our caller to await, just like
+        # MiddlewareMixin.__call__() does.
+        if is_webhook_request(request):
+            return self.get_response(request)
+        return super().__call__(request)
+
+
+class SessionMiddleware(WebhookBypassMixin,
+                        sessions_middleware.SessionMiddleware):
+    pass
+
+
+class MessageMiddleware(WebhookBypassMixin,
+                        messages_middleware.MessageMiddleware):
+    pass
+
+
+class AuthenticationMiddleware(WebhookBypassMixin,
+                               auth_middleware.AuthenticationMiddleware):
+    pass
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:24
+
+from django.db import migrations, models
+import webhook_receiver.jsonbackend
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webhook_receiver', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='jsonwebhookdata',
+            name='content',
+            field=models.JSONField(decoder=webhook_receiver.jsonbackend.JSONDecoder, encoder=webhook_receiver.jsonbackend.JSONEncoder, null=True),
+        ),
+        migrations.AlterField(
+            model_name='jsonwebhookdata',
+            name='headers',
+            field=models.JSONField(decoder=webhook_receiver.jsonbackend.JSONDecoder, encoder=webhook_receiver.jsonbackend.JSONEncoder),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:26
+
+from django.db import migrations
+import webhook_receiver.fields
+import webhook_receiver.jsonbackend
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webhook_receiver', '0002_json_backend'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='jsonwebhookdata',
+            name='body',
+            field=webhook_receiver.fields.CompressedBinaryField(),
+        ),
+        migrations.AlterField(
+            model_name='jsonwebhookdata',
+            name='content',
+            field=webhook_receiver.fields.BodyContentField(decoder=webhook_receiver.jsonbackend.JSONDecoder, encoder=webhook_receiver.jsonbackend.JSONEncoder, null=True),
+        ),
+    ]
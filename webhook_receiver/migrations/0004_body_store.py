@@ -0,0 +1,27 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:29
+
+from django.db import migrations, models
+import django.db.models.deletion
+import webhook_receiver.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webhook_receiver', '0003_compact_storage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookBody',
+            fields=[
+                ('digest', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('body', webhook_receiver.fields.CompressedBinaryField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='jsonwebhookdata',
+            name='stored_body',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='webhooks', to='webhook_receiver.webhookbody'),
+        ),
+    ]
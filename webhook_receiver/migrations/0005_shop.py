@@ -0,0 +1,29 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webhook_receiver', '0004_body_store'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Shop',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('platform', models.CharField(choices=[('shopify', 'Shopify'), ('woocommerce', 'WooCommerce')], max_length=32)),
+                ('identifier', models.CharField(max_length=254)),
+                ('secret', models.CharField(max_length=254)),
+                ('previous_secrets', models.JSONField(blank=True, default=list)),
+                ('options', models.JSONField(blank=True, default=dict)),
+                ('active', models.BooleanField(default=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='shop',
+            constraint=models.UniqueConstraint(fields=('platform', 'identifier'), name='unique_shop_platform_identifier'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:58
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webhook_receiver', '0005_shop'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SKUMapping',
+            fields=[
+                ('sku', models.CharField(max_length=254, primary_key=True, serialize=False)),
+                ('course_id', models.CharField(max_length=254)),
+                ('resolved', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
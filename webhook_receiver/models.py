@@ -1,6 +1,9 @@
-from django.db.models import Model
-from django.db.models import GenericIPAddressField, BinaryField, DateTimeField
-from django.db.models import CharField, BigIntegerField, EmailField
+from django.conf import settings
+from django.db.models import Model, ForeignKey, PROTECT
+from django.db.models import GenericIPAddressField, DateTimeField
+from django.db.models import BigAutoField, BigIntegerField
+from django.db.models import CharField, EmailField
+from django.db.models import BooleanField, UniqueConstraint
 try:
     # Django 3.1 and later has a built-in JSONField
     from django.db.models import JSONField
@@ -13,7 +16,10 @@ from django_fsm import FSMIntegerField, ConcurrentTransitionMixin, transition
 from django.utils import timezone
 
 from . import STATE
+from .fields import BodyContentField, CompressedBinaryField
+from .jsonbackend import JSONDecoder, JSONEncoder
 
+import hashlib
 import logging
 
 
@@ -42,11 +48,11 @@ class WebhookData(ConcurrentTransitionMixin, Model):
                              protected=True)
     source = GenericIPAddressField(null=True)
     received = DateTimeField(default=timezone.now)
-    headers = JSONField()
+    headers = JSONField(encoder=JSONEncoder, decoder=JSONDecoder)
     # This is for storing the webhook payload exactly as received
     # (i.e. from request.body), which comes in handy for signature
-    # verification.
-    body = BinaryField()
+    # verification. In compact storage mode, it is stored compressed.
+    body = CompressedBinaryField()
 
     @transition(field=status,
                 source=NEW,
@@ -69,15 +75,68 @@ class WebhookData(ConcurrentTransitionMixin, Model):
         logger.debug('Failed to process webhook %s' % self.id)
 
 
+class WebhookBody(Model):
+    """A webhook body, stored once no matter how often we receive
+    it, and keyed by its SHA-256 digest."""
+
+    class Meta:
+        app_label = APP_LABEL
+
+    digest = CharField(max_length=64, primary_key=True)
+    body = CompressedBinaryField()
+
+    @staticmethod
+    def digest_of(body):
+        return hashlib.sha256(bytes(body)).hexdigest()
+
+    @classmethod
+    def seen(cls, body):
+        """Check whether we have already stored the exact same body."""
+        return cls.objects.filter(digest=cls.digest_of(body)).exists()
+
+
 class JSONWebhookData(WebhookData):
 
     class Meta:
         app_label = APP_LABEL
         abstract = False
 
+    # In body store mode, the body is stored in the body store, and
+    # the body field is left empty.
+    stored_body = ForeignKey(WebhookBody,
+                             null=True,
+                             on_delete=PROTECT,
+                             related_name='webhooks')
+
     # In addition to the webhook source and timestamp, we also want
-    # the webhook content, which in this case is always JSON data.
-    content = JSONField(null=True)
+    # the webhook content, which in this case is always JSON data. In
+    # compact storage mode, we don't store it, but parse it from the
+    # body on access.
+    content = BodyContentField(null=True,
+                               encoder=JSONEncoder,
+                               decoder=JSONDecoder)
+
+    def store_body(self):
+        """In body store mode, store the body in the body store
+        (unless it's already there), and reference it."""
+        if not settings.WEBHOOK_RECEIVER_BODY_STORE:
+            return
+        if self.stored_body_id is not None or not self.body:
+            return
+
+        body = bytes(self.body)
+        stored_body, created = WebhookBody.objects.get_or_create(
+            digest=WebhookBody.digest_of(body),
+            defaults={'body': body},
+        )
+        if not created:
+            logger.info('Webhook body %s has been received '
+                        'before' % stored_body.digest)
+        self.stored_body = stored_body
+
+    def save(self, *args, **kwargs):
+        self.store_body()
+        super().save(*args, **kwargs)
 
 
 class Order(ConcurrentTransitionMixin, Model):
@@ -92,7 +151,12 @@ class Order(ConcurrentTransitionMixin, Model):
 
     CHOICES = STATE.CHOICES
 
-    id = BigIntegerField(primary_key=True, editable=False)
+    id = BigAutoField(primary_key=True, editable=False)
+    # Different shops may use the same order IDs, so we identify an
+    # order by the shop it comes from (the value of the header that
+    # identifies the shop), and its ID in that shop.
+    shop = CharField(max_length=254, blank=True, default='')
+    order_id = BigIntegerField()
     email = EmailField()
     first_name = CharField(max_length=254)
     last_name = CharField(max_length=254)
@@ -101,25 +165,31 @@ class Order(ConcurrentTransitionMixin, Model):
                              default=NEW,
                              protected=True)
 
+    def __str__(self):
+        # The order as the shop knows it
+        if self.shop:
+            return '%s from %s' % (self.order_id, self.shop)
+        return str(self.order_id)
+
     @transition(field=status,
                 source=NEW,
                 target=PROCESSING,
                 on_error=ERROR)
     def start_processing(self):
-        logger.debug('Processing order %s' % self.id)
+        logger.debug('Processing order %s' % self)
 
     @transition(field=status,
                 source=PROCESSING,
                 target=PROCESSED,
                 on_error=ERROR)
     def finish_processing(self):
-        logger.debug('Finishing order %s' % self.id)
+        logger.debug('Finishing order %s' % self)
 
     @transition(field=status,
                 source=PROCESSING,
                 target=ERROR)
     def fail(self):
-        logger.debug('Failed to process order %s' % self.id)
+        logger.debug('Failed to process order %s' % self)
 
 
 class OrderItem(ConcurrentTransitionMixin, Model):
@@ -146,7 +216,7 @@ class OrderItem(ConcurrentTransitionMixin, Model):
                 on_error=ERROR)
     def start_processing(self):
         logger.debug('Processing item %s for order %s' % (self.id,
-                                                          self.order.id))
+                                                          self.order))
 
     @transition(field=status,
                 source=PROCESSING,
@@ -154,7 +224,7 @@ class OrderItem(ConcurrentTransitionMixin, Model):
                 on_error=ERROR)
     def finish_processing(self):
         logger.debug('Finishing item %s for order %s' % (self.id,
-                                                         self.order.id))
+                                                         self.order))
 
     @transition(field=status,
                 source=PROCESSING,
@@ -162,4 +232,58 @@ class OrderItem(ConcurrentTransitionMixin, Model):
     def fail(self):
         logger.debug('Failed to process item %s '
                      'for order %s' % (self.id,
-                                       self.order.id))
+                                       self.order))
+
+
+class Shop(Model):
+    """A shop that sends us webhooks, in addition to any configured
+    in WEBHOOK_RECEIVER_SETTINGS.
+
+    We only consider these if WEBHOOK_RECEIVER_SHOP_TABLE is set.
+    """
+
+    class Meta:
+        app_label = APP_LABEL
+        constraints = [
+            UniqueConstraint(fields=['platform', 'identifier'],
+                             name='unique_shop_platform_identifier')
+        ]
+
+    PLATFORMS = (
+        ('shopify', 'Shopify'),
+        ('woocommerce', 'WooCommerce'),
+    )
+
+    platform = CharField(max_length=32, choices=PLATFORMS)
+    # The Shopify shop domain, or the WooCommerce source URL
+    identifier = CharField(max_length=254)
+    secret = CharField(max_length=254)
+    # Secrets that we still accept while the secret is being rotated
+    previous_secrets = JSONField(default=list, blank=True)
+    # Shop-specific options, such as send_email and require_payment
+    options = JSONField(default=dict, blank=True)
+    active = BooleanField(default=True)
+
+    def __str__(self):
+        return '%s shop %s' % (self.get_platform_display(),
+                               self.identifier)
+
+
+class SKUMapping(Model):
+    """The course ID that a SKU resolves to.
+
+    We consult these before resolving a SKU on the LMS, if
+    WEBHOOK_RECEIVER_SKU_MAPPING is set. The sync_sku_mappings
+    management command and periodic task keep them up to date.
+    """
+
+    class Meta:
+        app_label = APP_LABEL
+
+    sku = CharField(max_length=254, primary_key=True)
+    course_id = CharField(max_length=254)
+    # When we last resolved the SKU on the LMS
+    resolved = DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return '%s -> %s' % (self.sku, self.course_id)
@@ -0,0 +1,250 @@
+"""Per-source rate limiting for the webhook endpoints.
+
+We give each webhook source (the combination of a platform, the shop
+that a webhook claims to come from, and the client IP address) a
+token bucket that holds up to WEBHOOK_RECEIVER_RATE_LIMIT_BURST
+tokens, and refills at WEBHOOK_RECEIVER_RATE_LIMIT tokens per second.
+Every webhook takes a token, and a webhook that finds the bucket
+empty gets an HTTP 429 response, with a Retry-After header that says
+when the bucket will hold a token again.
+
+Both the shop header and the client IP address are up to the sender
+(within the limits of webhook_receiver.allowlist.client_ip()), so
+that a flood of webhooks could rotate them to get a fresh bucket for
+each. We thus only count a shop as part of the source if it is one of
+ours, and otherwise give all webhooks from a client IP address the
+same bucket.
+
+So that limits hold across all receiver processes, on all nodes, the
+buckets live in the Django cache. Since most cache backends offer
+atomic increments, but no atomic read-modify-write, we approximate
+each bucket with two counters: the number of tokens taken in the
+current refill period (the time it takes to refill an empty bucket),
+which we increment, and the number taken in the previous one, which
+we weigh by the part of the previous period that still falls into a
+sliding window of one period. Once a period is over, its counter
+hardly changes any more, so each process keeps the previous period's
+counters in memory. And once a source is throttled, each process remembers
+that until the source gets a token again, so that a source that
+hammers an endpoint costs no cache round trips at all.
+
+Like shared sets, rate limits are an optimization: if the cache is
+unavailable, we log a warning, and admit every webhook.
+"""
+
+import hashlib
+import logging
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+
+from .allowlist import client_ip
+from .shops import ShopsNotLoadedException, get_shop
+
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter(object):
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        # The time it takes to refill an empty bucket
+        self.period = burst / rate
+
+        # The number of the previous period, and a dictionary that
+        # maps sources to the tokens they took in it
+        self.previous_period = None
+        self.previous = {}
+        # Maps sources to the wall clock time until which they are
+        # throttled
+        self.throttled = {}
+        self.lock = threading.Lock()
+
+    def cache_key(self, source, period):
+        # Sources contain arbitrary header values, but some cache
+        # backends (such as memcached) restrict the characters and
+        # length of cache keys.
+        digest = hashlib.sha256(source.encode('utf-8')).hexdigest()
+        return 'webhook_receiver:ratelimit:%s:%d' % (digest, period)
+
+    def _local_wait(self, source, now):
+        """Return the seconds that a source still has to wait, if we
+        know that it is throttled, and None otherwise."""
+        with self.lock:
+            until = self.throttled.get(source)
+            if until is None:
+                return None
+            if until <= now:
+                del self.throttled[source]
+                return None
+            return until - now
+
+    def _local_previous(self, source, period):
+        with self.lock:
+            if period != self.previous_period:
+                return None
+            return self.previous.get(source)
+
+    def _remember_previous(self, source, period, count):
+        with self.lock:
+            if period != self.previous_period:
+                self.previous_period = period
+                self.previous = {}
+            self.previous[source] = count
+
+    def _wait(self, now, period, count, previous):
+        """Return the seconds until a source that took count tokens
+        in the current period, and previous tokens in the one before,
+        gets another token, or 0 if it gets one right away."""
+        elapsed = now / self.period - period
+        if count < self.burst:
+            if previous * (1 - elapsed) + count < self.burst:
+                return 0
+            # Wait until the weight of the previous period has dropped
+            # enough.
+            ready = 1 - (self.burst - count - 1) / previous
+        else:
+            # Wait until enough of the current period has left the
+            # window.
+            ready = 2 - (self.burst - 1) / count
+        return max((ready - elapsed) * self.period, 0)
+
+    def _throttle(self, source, now, wait):
+        with self.lock:
+            # Don't let sources that are no longer throttled pile up.
+            for stale in [key for key, until in self.throttled.items()
+                          if until <= now]:
+                del self.throttled[stale]
+            self.throttled[source] = now + wait
+
+    def take(self, source):
+        """Take a token from a source's bucket. Return None if we got
+        one, or else the seconds to wait until the bucket holds a
+        token again."""
+        now = time.time()
+        wait = self._local_wait(source, now)
+        if wait is not None:
+            return wait
+
+        period = int(now // self.period)
+        key = self.cache_key(source, period)
+        try:
+            try:
+                count = cache.incr(key)
+            except ValueError:
+                # This is the first token in this period, unless some
+                # other process beat us to it.
+                if cache.add(key, 1, math.ceil(2 * self.period)):
+                    count = 1
+                else:
+                    count = cache.incr(key)
+
+            previous = self._local_previous(source, period - 1)
+            if previous is None:
+                previous = cache.get(self.cache_key(source, period - 1),
+                                     0)
+                self._remember_previous(source, period - 1, previous)
+
+            wait = self._wait(now, period, count - 1, previous)
+            if not wait:
+                return None
+            # A webhook that we turn away takes no token.
+            cache.decr(key)
+        except Exception as e:
+            logger.warning('Unable to check rate limit '
+                           'for %s: %s' % (source, e))
+            return None
+
+        self._throttle(source, now, wait)
+        return wait
+
+    async def atake(self, source):
+        """Async counterpart of take()."""
+        now = time.time()
+        wait = self._local_wait(source, now)
+        if wait is not None:
+            return wait
+
+        period = int(now // self.period)
+        key = self.cache_key(source, period)
+        try:
+            try:
+                count = await cache.aincr(key)
+            except ValueError:
+                if await cache.aadd(key, 1, math.ceil(2 * self.period)):
+                    count = 1
+                else:
+                    count = await cache.aincr(key)
+
+            previous = self._local_previous(source, period - 1)
+            if previous is None:
+                previous = await cache.aget(
+                    self.cache_key(source, period - 1), 0)
+                self._remember_previous(source, period - 1, previous)
+
+            wait = self._wait(now, period, count - 1, previous)
+            if not wait:
+                return None
+            await cache.adecr(key)
+        except Exception as e:
+            logger.warning('Unable to check rate limit '
+                           'for %s: %s' % (source, e))
+            return None
+
+        self._throttle(source, now, wait)
+        return wait
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """Return the rate limiter for the current settings, or None if
+    we don't limit webhook rates."""
+    global _limiter
+    rate = settings.WEBHOOK_RECEIVER_RATE_LIMIT
+    if not rate:
+        return None
+    burst = max(settings.WEBHOOK_RECEIVER_RATE_LIMIT_BURST, 1)
+    with _limiter_lock:
+        if _limiter is None or (_limiter.rate,
+                                _limiter.burst) != (rate, burst):
+            _limiter = RateLimiter(rate, burst)
+        return _limiter
+
+
+def webhook_source(platform, request, header):
+    """Return the source of a webhook request: the platform, the shop
+    named in the given request header if we know it, and the client IP
+    address."""
+    shop = request.headers.get(header, '')
+    if shop:
+        try:
+            if get_shop(platform, shop) is None:
+                shop = ''
+        except ShopsNotLoadedException:
+            # Until async code has loaded the shops, we don't know
+            # any.
+            shop = ''
+    return '%s:%s:%s' % (platform, shop, client_ip(request))
+
+
+def throttled_response(wait):
+    response = HttpResponse(status=429)
+    response['Retry-After'] = str(max(math.ceil(wait), 1))
+    return response
+
+
+def reset_rate_limits():
+    """Forget the rate limiter in this process (but not the buckets
+    in the cache)."""
+    global _limiter
+    with _limiter_lock:
+        _limiter = None
@@ -0,0 +1,69 @@
+"""Accounting for webhooks that we reject before storing them.
+
+With early rejection enabled, webhooks that fail header or signature
+verification never make it into the database. Instead, we count them
+per platform and reason in memory, and log a sample of them: the
+first rejection for each platform and reason, and then every Nth
+one. Each sample includes only the headers we would have stored for
+the webhook, truncated to a fixed length, so that a flood of forged
+requests cannot flood the logs as well.
+"""
+
+import logging
+import threading
+
+from collections import Counter
+
+from django.conf import settings
+
+from .allowlist import client_ip
+
+# The maximum length of a header value in a logged sample.
+MAX_HEADER_LENGTH = 256
+
+logger = logging.getLogger(__name__)
+
+_counts = Counter()
+_counts_lock = threading.Lock()
+
+
+def reject_webhook(platform, request, exception, allowed_headers):
+    """Count a rejected webhook request, and log it if it is sampled.
+
+    platform is the name of the platform that sent the webhook,
+    exception the WebhookException we rejected it with, and
+    allowed_headers the request headers we may log.
+    """
+    key = (platform, type(exception).__name__)
+    with _counts_lock:
+        _counts[key] += 1
+        count = _counts[key]
+
+    interval = max(settings.WEBHOOK_RECEIVER_REJECTION_LOG_INTERVAL, 1)
+    if (count - 1) % interval:
+        return
+
+    ip = client_ip(request)
+    headers = {name: request.headers[name][:MAX_HEADER_LENGTH]
+               for name in allowed_headers
+               if name in request.headers}
+    logger.warning('Rejected %s webhook from %s with status %d: %s '
+                   '(%d such rejections so far), headers: %s' % (
+                       platform,
+                       ip,
+                       exception.status,
+                       exception,
+                       count,
+                       headers))
+
+
+def rejection_counts():
+    """Return the number of webhooks rejected by this process, by
+    (platform, reason) tuple."""
+    with _counts_lock:
+        return dict(_counts)
+
+
+def reset_rejection_counts():
+    with _counts_lock:
+        _counts.clear()
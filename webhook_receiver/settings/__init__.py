@@ -28,10 +28,13 @@ INSTALLED_APPS = [
     'webhook_receiver_woocommerce',
 ]
 
+# Only the Django admin needs sessions, messages, and authentication,
+# so we use variants of Django's middleware that skip webhook requests
+# (see webhook_receiver.middleware).
 MIDDLEWARE = [
-    'django.contrib.sessions.middleware.SessionMiddleware',
-    'django.contrib.messages.middleware.MessageMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'webhook_receiver.middleware.SessionMiddleware',
+    'webhook_receiver.middleware.MessageMiddleware',
+    'webhook_receiver.middleware.AuthenticationMiddleware',
 ]
 
 TEMPLATES = [
@@ -201,6 +204,276 @@ WEBHOOK_RECEIVER_SEND_ENROLLMENT_EMAIL = env.bool(
     default=True
 )
 
+# Persist each incoming webhook with a single INSERT, once it has been
+# parsed and verified, rather than saving it on every state change.
+WEBHOOK_RECEIVER_SINGLE_WRITE = env.bool(
+    'DJANGO_WEBHOOK_RECEIVER_SINGLE_WRITE',
+    default=False
+)
+
+# Acknowledge incoming webhooks as soon as they are stored, and defer
+# their verification and parsing to a Celery task.
+WEBHOOK_RECEIVER_FAST_ACK = env.bool(
+    'DJANGO_WEBHOOK_RECEIVER_FAST_ACK',
+    default=False
+)
+
+# Serve webhooks with async views. This is most useful when running
+# under ASGI (webhook_receiver.asgi).
+WEBHOOK_RECEIVER_ASYNC_VIEWS = env.bool(
+    'DJANGO_WEBHOOK_RECEIVER_ASYNC_VIEWS',
+    default=False
+)
+
+# If set, spool verified webhooks to this local directory when the
+# database is unavailable. Use the drain_webhook_spool management
+# command to move them into the database. Spooled records are flushed
+# to disk in batches, collected over the fsync interval (in seconds),
+# and each receiver process starts a new spool segment file after the
+# segment age (in seconds).
+WEBHOOK_RECEIVER_SPOOL_DIR = env.str(
+    'DJANGO_WEBHOOK_RECEIVER_SPOOL_DIR',
+    default='')
+WEBHOOK_RECEIVER_SPOOL_FSYNC_INTERVAL = env.float(
+    'DJANGO_WEBHOOK_RECEIVER_SPOOL_FSYNC_INTERVAL',
+    default=0.005)
+WEBHOOK_RECEIVER_SPOOL_SEGMENT_AGE = env.float(
+    'DJANGO_WEBHOOK_RECEIVER_SPOOL_SEGMENT_AGE',
+    default=60)
+
+# If set to a time window (in seconds), insert webhooks that arrive
+# concurrently within that window, up to the given maximum number of
+# rows, with a single bulk insert and commit. This only affects
+# webhooks inserted in a single write (see above).
+WEBHOOK_RECEIVER_GROUP_COMMIT_WINDOW = env.float(
+    'DJANGO_WEBHOOK_RECEIVER_GROUP_COMMIT_WINDOW',
+    default=0)
+WEBHOOK_RECEIVER_GROUP_COMMIT_MAX_ROWS = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_GROUP_COMMIT_MAX_ROWS',
+    default=50)
+
+# If True, verify a webhook's headers before reading its body, and
+# compute the body's HMAC signature while reading it in chunks,
+# rejecting bodies larger than WEBHOOK_RECEIVER_MAX_BODY_SIZE bytes.
+WEBHOOK_RECEIVER_STREAMING_INTAKE = env.bool(
+    'DJANGO_WEBHOOK_RECEIVER_STREAMING_INTAKE',
+    default=False)
+WEBHOOK_RECEIVER_MAX_BODY_SIZE = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_MAX_BODY_SIZE',
+    default=2621440)
+
+# If True, verify a webhook's headers and signature before storing
+# it, and rather than storing webhooks that fail verification, count
+# them in memory and log one in every
+# WEBHOOK_RECEIVER_REJECTION_LOG_INTERVAL of them.
+WEBHOOK_RECEIVER_EARLY_REJECT = env.bool(
+    'DJANGO_WEBHOOK_RECEIVER_EARLY_REJECT',
+    default=False)
+WEBHOOK_RECEIVER_REJECTION_LOG_INTERVAL = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_REJECTION_LOG_INTERVAL',
+    default=100)
+
+# The JSON library to use for parsing webhook payloads, encoding JSON
+# database fields, and serializing Celery task messages: "json" for
+# the standard library, or "orjson". If orjson is not installed, we
+# fall back to the standard library. Celery workers always accept
+# messages serialized with either.
+WEBHOOK_RECEIVER_JSON_BACKEND = env.str(
+    'DJANGO_WEBHOOK_RECEIVER_JSON_BACKEND',
+    default='json')
+CELERY_ACCEPT_CONTENT = ['json', 'webhook-json']
+CELERY_TASK_SERIALIZER = ('webhook-json'
+                          if WEBHOOK_RECEIVER_JSON_BACKEND == 'orjson'
+                          else 'json')
+
+# If True, store webhooks compactly: with a compressed body, only
+# those request headers we need for verification and auditing, and
+# no separately stored parsed content (we parse it from the body on
+# access).
+WEBHOOK_RECEIVER_COMPACT_STORAGE = env.bool(
+    'DJANGO_WEBHOOK_RECEIVER_COMPACT_STORAGE',
+    default=False)
+
+# If True, store each distinct webhook body only once, in a separate
+# table keyed by the body's SHA-256 digest, so that redelivered
+# webhooks don't cost another copy of their body.
+WEBHOOK_RECEIVER_BODY_STORE = env.bool(
+    'DJANGO_WEBHOOK_RECEIVER_BODY_STORE',
+    default=False)
+
+# If True, record the delivery IDs of accepted webhooks in the cache
+# for WEBHOOK_RECEIVER_DELIVERY_ID_TIMEOUT seconds (with an in-process
+# LRU of up to WEBHOOK_RECEIVER_DELIVERY_ID_LRU_SIZE IDs in front of
+# the cache), and acknowledge redeliveries without processing them
+# again. Shopify retries failed deliveries for up to 48 hours.
+WEBHOOK_RECEIVER_DEDUPLICATE_DELIVERIES = env.bool(
+    'DJANGO_WEBHOOK_RECEIVER_DEDUPLICATE_DELIVERIES',
+    default=False)
+WEBHOOK_RECEIVER_DELIVERY_ID_TIMEOUT = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_DELIVERY_ID_TIMEOUT',
+    default=172800)
+WEBHOOK_RECEIVER_DELIVERY_ID_LRU_SIZE = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_DELIVERY_ID_LRU_SIZE',
+    default=10000)
+
+# If True, record the IDs of processed orders in the cache for
+# WEBHOOK_RECEIVER_PROCESSED_ORDER_TIMEOUT seconds (with an in-process
+# LRU of up to WEBHOOK_RECEIVER_PROCESSED_ORDER_LRU_SIZE IDs in front
+# of the cache), so that webhooks for orders that we have already
+# processed are dismissed without a database query.
+WEBHOOK_RECEIVER_PROCESSED_ORDER_CACHE = env.bool(
+    'DJANGO_WEBHOOK_RECEIVER_PROCESSED_ORDER_CACHE',
+    default=False)
+WEBHOOK_RECEIVER_PROCESSED_ORDER_TIMEOUT = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_PROCESSED_ORDER_TIMEOUT',
+    default=604800)
+WEBHOOK_RECEIVER_PROCESSED_ORDER_LRU_SIZE = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_PROCESSED_ORDER_LRU_SIZE',
+    default=10000)
+
+# If True, accept webhooks from the shops in the Shop table, in
+# addition to those configured in WEBHOOK_RECEIVER_SETTINGS. Each
+# process reloads the Shop table at most every
+# WEBHOOK_RECEIVER_SHOP_RELOAD_INTERVAL seconds.
+WEBHOOK_RECEIVER_SHOP_TABLE = env.bool(
+    'DJANGO_WEBHOOK_RECEIVER_SHOP_TABLE',
+    default=False)
+WEBHOOK_RECEIVER_SHOP_RELOAD_INTERVAL = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_SHOP_RELOAD_INTERVAL',
+    default=60)
+
+# Shed load (see webhook_receiver.admission) while the broker queue
+# holds more than WEBHOOK_RECEIVER_MAX_QUEUE_DEPTH messages (checked
+# at most every WEBHOOK_RECEIVER_QUEUE_DEPTH_INTERVAL seconds), or
+# while webhooks took more than WEBHOOK_RECEIVER_MAX_INGEST_LATENCY
+# seconds to ingest, on average over the last
+# WEBHOOK_RECEIVER_INGEST_LATENCY_WINDOW seconds. 0 disables either
+# check. WEBHOOK_RECEIVER_ADMISSION_QUEUE is the broker queue to
+# watch, and defaults to Celery's default queue. In "reject" shed
+# mode, we respond with 503 without storing the webhook; in "defer"
+# mode, we store it, but don't process its order, and respond with
+# 429. Either way, we ask the shop to retry after
+# WEBHOOK_RECEIVER_RETRY_AFTER seconds.
+WEBHOOK_RECEIVER_MAX_QUEUE_DEPTH = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_MAX_QUEUE_DEPTH',
+    default=0)
+WEBHOOK_RECEIVER_QUEUE_DEPTH_INTERVAL = env.float(
+    'DJANGO_WEBHOOK_RECEIVER_QUEUE_DEPTH_INTERVAL',
+    default=5.0)
+WEBHOOK_RECEIVER_ADMISSION_QUEUE = env.str(
+    'DJANGO_WEBHOOK_RECEIVER_ADMISSION_QUEUE',
+    default='')
+WEBHOOK_RECEIVER_MAX_INGEST_LATENCY = env.float(
+    'DJANGO_WEBHOOK_RECEIVER_MAX_INGEST_LATENCY',
+    default=0.0)
+WEBHOOK_RECEIVER_INGEST_LATENCY_WINDOW = env.float(
+    'DJANGO_WEBHOOK_RECEIVER_INGEST_LATENCY_WINDOW',
+    default=10.0)
+WEBHOOK_RECEIVER_SHED_MODE = env.str(
+    'DJANGO_WEBHOOK_RECEIVER_SHED_MODE',
+    default='reject')
+WEBHOOK_RECEIVER_RETRY_AFTER = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_RETRY_AFTER',
+    default=60)
+
+# The reverse proxies (in CIDR notation) that we trust to tell us the
+# client IP address of a request in its X-Forwarded-For header. We
+# use the client IP address to check the platforms' allowed networks,
+# and to rate-limit webhook sources, and ignore X-Forwarded-For
+# headers on requests from anywhere else (see
+# webhook_receiver.allowlist).
+WEBHOOK_RECEIVER_TRUSTED_PROXIES = env.list(
+    'DJANGO_WEBHOOK_RECEIVER_TRUSTED_PROXIES',
+    default=[])
+
+# Limit each webhook source (a shop, as named in the webhook headers,
+# or any unknown shop, sending from a client IP address) to
+# WEBHOOK_RECEIVER_RATE_LIMIT webhooks per second, in bursts of up to
+# WEBHOOK_RECEIVER_RATE_LIMIT_BURST webhooks (see
+# webhook_receiver.ratelimit). 0 disables rate limiting. Rate limits
+# are shared between processes through the Django cache.
+WEBHOOK_RECEIVER_RATE_LIMIT = env.float(
+    'DJANGO_WEBHOOK_RECEIVER_RATE_LIMIT',
+    default=0.0)
+WEBHOOK_RECEIVER_RATE_LIMIT_BURST = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_RATE_LIMIT_BURST',
+    default=60)
+
+# Enroll the learners of all line items in an order with as few bulk
+# enrollment API requests as possible, rather than with one request
+# per line item (see webhook_receiver.utils.enroll_order_items()).
+WEBHOOK_RECEIVER_BATCH_ENROLLMENT = env.bool(
+    'DJANGO_WEBHOOK_RECEIVER_BATCH_ENROLLMENT',
+    default=False)
+
+# With batched enrollments, and if set to a time window (in seconds),
+# enroll the learners of orders that are processed concurrently in the
+# same worker process within that window, up to the given maximum
+# number of enrollments, with as few bulk enrollment API requests as
+# possible (see webhook_receiver.coalescer).
+WEBHOOK_RECEIVER_ENROLLMENT_WINDOW = env.float(
+    'DJANGO_WEBHOOK_RECEIVER_ENROLLMENT_WINDOW',
+    default=0)
+WEBHOOK_RECEIVER_ENROLLMENT_MAX_BATCH = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_ENROLLMENT_MAX_BATCH',
+    default=100)
+
+# If True, cache the course IDs that SKUs resolve to for
+# WEBHOOK_RECEIVER_SKU_CACHE_TIMEOUT seconds, and the SKUs that
+# resolve to no course ID for WEBHOOK_RECEIVER_SKU_CACHE_NEGATIVE_TIMEOUT
+# seconds, in the cache (with an in-process LRU of up to
+# WEBHOOK_RECEIVER_SKU_CACHE_LRU_SIZE SKUs in front of the cache), so
+# that we don't look up the same SKU on the LMS for every order (see
+# webhook_receiver.skucache).
+WEBHOOK_RECEIVER_SKU_CACHE = env.bool(
+    'DJANGO_WEBHOOK_RECEIVER_SKU_CACHE',
+    default=False)
+WEBHOOK_RECEIVER_SKU_CACHE_TIMEOUT = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_SKU_CACHE_TIMEOUT',
+    default=3600)
+WEBHOOK_RECEIVER_SKU_CACHE_NEGATIVE_TIMEOUT = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_SKU_CACHE_NEGATIVE_TIMEOUT',
+    default=60)
+WEBHOOK_RECEIVER_SKU_CACHE_LRU_SIZE = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_SKU_CACHE_LRU_SIZE',
+    default=1000)
+
+# If True, look up SKUs in the SKUMapping table before resolving
+# them on the LMS, and record the SKUs that we resolve there. Unless
+# WEBHOOK_RECEIVER_SKU_SYNC_INTERVAL is 0, resolve all SKUs that we
+# haven't resolved for WEBHOOK_RECEIVER_SKU_SYNC_MAX_AGE seconds
+# at that interval (in seconds), with up to
+# WEBHOOK_RECEIVER_SKU_SYNC_PARALLELISM concurrent requests (see
+# webhook_receiver.skumappings). This requires running celery beat.
+WEBHOOK_RECEIVER_SKU_MAPPING = env.bool(
+    'DJANGO_WEBHOOK_RECEIVER_SKU_MAPPING',
+    default=False)
+WEBHOOK_RECEIVER_SKU_SYNC_INTERVAL = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_SKU_SYNC_INTERVAL',
+    default=0)
+WEBHOOK_RECEIVER_SKU_SYNC_MAX_AGE = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_SKU_SYNC_MAX_AGE',
+    default=86400)
+WEBHOOK_RECEIVER_SKU_SYNC_PARALLELISM = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_SKU_SYNC_PARALLELISM',
+    default=4)
+
+# If True, resolve SKUs by following the redirects from their lookup
+# URL one at a time, and stop at the first one that points to a URL
+# containing a course ID, rather than following all redirects to the
+# final page.
+WEBHOOK_RECEIVER_SKU_SINGLE_HOP = env.bool(
+    'DJANGO_WEBHOOK_RECEIVER_SKU_SINGLE_HOP',
+    default=False)
+
+# Unless batched enrollment is enabled, and if set to more than 1,
+# resolve the SKUs of the line items in an order, and enroll their
+# learners, in up to this many concurrent threads (see
+# webhook_receiver.utils.process_order_items()).
+WEBHOOK_RECEIVER_LINE_ITEM_CONCURRENCY = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_LINE_ITEM_CONCURRENCY',
+    default=1)
+
 WEBHOOK_RECEIVER_SETTINGS = {
     'shopify': {
         'shop_domain': env.str(
@@ -209,6 +482,16 @@ WEBHOOK_RECEIVER_SETTINGS = {
         'api_key': env.str(
             'DJANGO_WEBHOOK_RECEIVER_SETTINGS_SHOPIFY_API_KEY',
             default=''),
+        # Previous API keys that we still accept, while the shop's
+        # API key is being rotated
+        'previous_api_keys': env.list(
+            'DJANGO_WEBHOOK_RECEIVER_SETTINGS_SHOPIFY_PREVIOUS_API_KEYS',
+            default=[]),
+        # The networks (in CIDR notation) that we accept webhooks
+        # from, or none to accept them from anywhere
+        'allowed_networks': env.list(
+            'DJANGO_WEBHOOK_RECEIVER_SETTINGS_SHOPIFY_ALLOWED_NETWORKS',
+            default=[]),
     },
     'woocommerce': {
         'source': env.str(
@@ -217,6 +500,16 @@ WEBHOOK_RECEIVER_SETTINGS = {
         'secret': env.str(
             'DJANGO_WEBHOOK_RECEIVER_SETTINGS_WOOCOMMERCE_SECRET',
             default=''),
+        # Previous secrets that we still accept, while the webhook
+        # secret is being rotated
+        'previous_secrets': env.list(
+            'DJANGO_WEBHOOK_RECEIVER_SETTINGS_WOOCOMMERCE_PREVIOUS_SECRETS',
+            default=[]),
+        # The networks (in CIDR notation) that we accept webhooks
+        # from, or none to accept them from anywhere
+        'allowed_networks': env.list(
+            'DJANGO_WEBHOOK_RECEIVER_SETTINGS_WOOCOMMERCE_ALLOWED_NETWORKS',
+            default=[]),
         'require_payment': env.bool(
             'DJANGO_WEBHOOK_RECEIVER_SETTINGS_WOOCOMMERCE_REQUIRE_PAYMENT',
             default=False),
@@ -0,0 +1,129 @@
+"""Sets of keys shared between receiver processes.
+
+A shared set records keys (such as webhook delivery IDs) for a
+bounded time. Its members live in the Django cache, so that all
+receiver processes, on all nodes, see the same set. In front of the
+cache, each process keeps a small LRU of the members it has recently
+added or found, so that checking for a recent member does not even
+take a round trip to the cache.
+
+Shared sets are an optimization, and never a source of truth: if the
+cache is unavailable, we log a warning, and treat every key as not
+being a member.
+"""
+
+import hashlib
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+
+from django.core.cache import cache
+
+
+logger = logging.getLogger(__name__)
+
+
+class SharedSet(object):
+
+    def __init__(self, prefix, timeout, max_size):
+        self.prefix = prefix
+        self.timeout = timeout
+        self.max_size = max_size
+
+        # Maps keys to the monotonic time at which they expire.
+        self.local = OrderedDict()
+        self.lock = threading.Lock()
+
+    def cache_key(self, key):
+        # Keys can be arbitrary strings, but some cache backends
+        # (such as memcached) restrict the characters and length of
+        # cache keys.
+        return '%s:%s' % (self.prefix,
+                          hashlib.sha256(str(key).encode('utf-8')).hexdigest())
+
+    def _local_contains(self, key):
+        with self.lock:
+            expires = self.local.get(key)
+            if expires is None:
+                return False
+            if expires < time.monotonic():
+                del self.local[key]
+                return False
+            self.local.move_to_end(key)
+            return True
+
+    def _local_add(self, key):
+        with self.lock:
+            self.local[key] = time.monotonic() + self.timeout
+            self.local.move_to_end(key)
+            while len(self.local) > self.max_size:
+                self.local.popitem(last=False)
+
+    def __contains__(self, key):
+        if self._local_contains(key):
+            return True
+
+        try:
+            found = cache.get(self.cache_key(key)) is not None
+        except Exception as e:
+            logger.warning('Unable to look up %s in cache: %s' % (key, e))
+            return False
+
+        if found:
+            self._local_add(key)
+        return found
+
+    def add(self, key):
+        self._local_add(key)
+        try:
+            cache.set(self.cache_key(key), 1, self.timeout)
+        except Exception as e:
+            logger.warning('Unable to add %s to cache: %s' % (key, e))
+
+    async def acontains(self, key):
+        """Async counterpart of the in operator."""
+        if self._local_contains(key):
+            return True
+
+        try:
+            found = await cache.aget(self.cache_key(key)) is not None
+        except Exception as e:
+            logger.warning('Unable to look up %s in cache: %s' % (key, e))
+            return False
+
+        if found:
+            self._local_add(key)
+        return found
+
+    async def aadd(self, key):
+        self._local_add(key)
+        try:
+            await cache.aset(self.cache_key(key), 1, self.timeout)
+        except Exception as e:
+            logger.warning('Unable to add %s to cache: %s' % (key, e))
+
+
+_shared_sets = {}
+_shared_sets_lock = threading.Lock()
+
+
+def get_shared_set(prefix, timeout, max_size):
+    """Return the shared set with the given cache key prefix, member
+    timeout (in seconds), and maximum in-process LRU size."""
+    with _shared_sets_lock:
+        shared_set = _shared_sets.get(prefix)
+        if shared_set is None or (shared_set.timeout,
+                                  shared_set.max_size) != (timeout,
+                                                           max_size):
+            shared_set = SharedSet(prefix, timeout, max_size)
+            _shared_sets[prefix] = shared_set
+        return shared_set
+
+
+def reset_shared_sets():
+    """Forget all shared sets in this process (but not their members
+    in the cache)."""
+    with _shared_sets_lock:
+        _shared_sets.clear()
@@ -0,0 +1,215 @@
+"""Shops that send us webhooks.
+
+Each platform's entry in WEBHOOK_RECEIVER_SETTINGS configures a shop:
+the value that identifies it (a Shopify shop domain, or a WooCommerce
+source), the secret(s) it signs its webhooks with, and options such
+as send_email and require_payment. To serve many shops per platform
+from the same endpoints, list more shops under the platform's "shops"
+key (in the YAML configuration file, for example), or enable
+WEBHOOK_RECEIVER_SHOP_TABLE and add them to the Shop table. A shop
+inherits any option that it does not set from the platform's
+settings.
+
+Rather than search the configuration for every webhook, we look up
+shops by the header that identifies them, in an index that we build
+once per process. We rebuild the index whenever the settings change,
+and, if shops come from the database, at most every
+WEBHOOK_RECEIVER_SHOP_RELOAD_INTERVAL seconds. Async code must not
+read the Shop table, so it rebuilds the index with arefresh_shops(),
+and until then looks up shops in the index it has.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import DatabaseError
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Shop as ShopRecord
+from .signing import get_verifier
+
+
+# For each platform, the settings keys of the value that identifies a
+# shop, of its current secret, and of its previous secrets.
+SHOP_KEYS = {
+    'shopify': ('shop_domain', 'api_key', 'previous_api_keys'),
+    'woocommerce': ('source', 'secret', 'previous_secrets'),
+}
+
+logger = logging.getLogger(__name__)
+
+
+class ShopsNotLoadedException(RuntimeError):
+    """Async code looked up a shop before the Shop table was read."""
+
+
+class Shop(object):
+    """A shop's settings, and the verifier for its secrets."""
+
+    def __init__(self, platform, conf):
+        identifier_key, secret_key, previous_key = SHOP_KEYS[platform]
+        self.platform = platform
+        self.conf = conf
+        self.identifier = conf.get(identifier_key)
+        secrets = [conf.get(secret_key, '')]
+        secrets.extend(conf.get(previous_key) or ())
+        self.verifier = get_verifier(secrets)
+
+
+def platform_defaults(platform):
+    """Return a platform's settings, without its list of shops."""
+    conf = dict(settings.WEBHOOK_RECEIVER_SETTINGS[platform])
+    conf.pop('shops', None)
+    return conf
+
+
+def configured_shops(platform):
+    """Yield the settings of each shop configured in
+    WEBHOOK_RECEIVER_SETTINGS."""
+    defaults = platform_defaults(platform)
+    yield defaults
+    for conf in settings.WEBHOOK_RECEIVER_SETTINGS[platform].get('shops',
+                                                                 ()):
+        yield dict(defaults, **conf)
+
+
+def stored_shops(platform):
+    """Yield the settings of each active shop in the Shop table."""
+    defaults = platform_defaults(platform)
+    identifier_key, secret_key, previous_key = SHOP_KEYS[platform]
+    for record in ShopRecord.objects.filter(platform=platform,
+                                            active=True):
+        conf = dict(defaults, **record.options)
+        conf[identifier_key] = record.identifier
+        conf[secret_key] = record.secret
+        conf[previous_key] = record.previous_secrets
+        yield conf
+
+
+def build_index(platform, previous=None):
+    """Return a dictionary of a platform's shops, keyed by the value
+    that identifies them.
+
+    If we can't read the Shop table, keep the shops that we read from
+    it previously (from the index previous).
+    """
+    index = {}
+    for conf in configured_shops(platform):
+        shop = Shop(platform, conf)
+        # A shop without an identifier is not configured at all.
+        if shop.identifier:
+            index.setdefault(shop.identifier, shop)
+
+    if settings.WEBHOOK_RECEIVER_SHOP_TABLE:
+        try:
+            stored = [Shop(platform, conf)
+                      for conf in stored_shops(platform)]
+        except DatabaseError as e:
+            logger.warning('Unable to load %s shops from '
+                           'database: %s' % (platform, e))
+            stored = (previous or {}).values()
+        for shop in stored:
+            # Shops configured in the settings take precedence.
+            index.setdefault(shop.identifier, shop)
+
+    return index
+
+
+# Maps platforms to their shop index, and the monotonic time at which
+# we built it, or None if we must rebuild it.
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def _is_stale(entry):
+    if entry is None or entry[1] is None:
+        return True
+    if not settings.WEBHOOK_RECEIVER_SHOP_TABLE:
+        return False
+    age = time.monotonic() - entry[1]
+    return age > settings.WEBHOOK_RECEIVER_SHOP_RELOAD_INTERVAL
+
+
+def refresh_shops(platform):
+    """Rebuild a platform's shop index if it's missing or stale."""
+    if not _is_stale(_indexes.get(platform)):
+        return
+    with _indexes_lock:
+        entry = _indexes.get(platform)
+        if _is_stale(entry):
+            index = build_index(platform, entry[0] if entry else None)
+            _indexes[platform] = (index, time.monotonic())
+
+
+async def arefresh_shops(platform):
+    """Async counterpart of refresh_shops().
+
+    Call this before looking up shops from async code, which must not
+    read the Shop table itself.
+    """
+    await sync_to_async(refresh_shops)(platform)
+
+
+def get_shop(platform, identifier):
+    """Return the shop with the given identifier (the value of the
+    header that identifies it), or None if we don't know that shop.
+
+    From async code, with WEBHOOK_RECEIVER_SHOP_TABLE set, look up the
+    shop in the index as of the last refresh, even if it is stale, and
+    raise ShopsNotLoadedException if there is none.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        # We're not in async code, so we may refresh the index.
+        refresh_shops(platform)
+    else:
+        if not settings.WEBHOOK_RECEIVER_SHOP_TABLE:
+            # Without the Shop table, refreshing the index does not
+            # touch the database.
+            refresh_shops(platform)
+    entry = _indexes.get(platform)
+    if entry is None:
+        raise ShopsNotLoadedException(
+            'Call arefresh_shops() before looking up %s shops '
+            'from async code' % platform)
+    return entry[0].get(identifier)
+
+
+def shop_conf(platform, identifier):
+    """Return the settings of the shop with the given identifier, or
+    the platform's settings if we don't know that shop."""
+    shop = get_shop(platform, identifier)
+    if shop is None:
+        return platform_defaults(platform)
+    return shop.conf
+
+
+def reset_shops():
+    """Mark all shop indexes as stale, so that we rebuild them on the
+    next lookup (or from async code, on the next arefresh_shops())."""
+    with _indexes_lock:
+        for platform, (index, built) in list(_indexes.items()):
+            _indexes[platform] = (index, None)
+
+
+@receiver(setting_changed)
+def shop_settings_changed(setting, **kwargs):
+    if setting in ('WEBHOOK_RECEIVER_SETTINGS',
+                   'WEBHOOK_RECEIVER_SHOP_TABLE'):
+        reset_shops()
+
+
+@receiver(post_save, sender=ShopRecord)
+@receiver(post_delete, sender=ShopRecord)
+def shop_record_changed(**kwargs):
+    # Other processes pick up the change when they next reload their
+    # shops.
+    reset_shops()
@@ -0,0 +1,230 @@
+"""Caching the course IDs that SKUs resolve to.
+
+Resolving a SKU that is not itself a course ID takes a request to the
+LMS (see webhook_receiver.utils.lookup_course_id()), but the course ID
+that a SKU resolves to almost never changes. The SKU cache keeps
+resolved course IDs in the Django cache, so that all worker processes
+share them, and in front of that, each process keeps an LRU of the
+SKUs it has recently resolved or found. SKUs that resolve to no course
+ID at all are cached, too, but only briefly, so that fixing the
+product on the LMS side takes effect soon.
+
+When many orders for the same SKU arrive at once, only one thread in
+each process, and (as long as the cache is available) only one process
+overall, resolves the SKU, while the others wait for its result.
+
+Like shared sets (see webhook_receiver.sharedset), the SKU cache is an
+optimization, and never a source of truth: if the cache is
+unavailable, we log a warning, and resolve the SKU.
+"""
+
+import hashlib
+import logging
+import threading
+import time
+
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+# Cached in place of a course ID, for SKUs that resolve to none.
+NEGATIVE = ''
+
+# The number of seconds that a process may take to resolve a SKU,
+# before another one tries.
+RESOLVE_TIMEOUT = 2
+
+# The number of seconds between checks for a SKU that another process
+# is resolving.
+RESOLVE_POLL_INTERVAL = 0.05
+
+logger = logging.getLogger(__name__)
+
+
+class Resolution(object):
+    """A SKU being resolved by one thread, which others wait for."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SKUCache(object):
+
+    def __init__(self, timeout, negative_timeout, max_size):
+        self.timeout = timeout
+        self.negative_timeout = negative_timeout
+        self.max_size = max_size
+
+        # Maps keys to (value, the monotonic time at which it expires)
+        # tuples.
+        self.local = OrderedDict()
+        self.resolutions = {}
+        self.lock = threading.Lock()
+        self.counters = Counter()
+
+    def cache_key(self, key):
+        return 'webhook_receiver:sku:%s' % (
+            hashlib.sha256(str(key).encode('utf-8')).hexdigest())
+
+    def lease_key(self, key):
+        return '%s:lease' % self.cache_key(key)
+
+    def stats(self):
+        """Return the counts of local hits, shared (Django cache) hits,
+        negative hits (which are also counted as local or shared
+        hits), and misses, in this process."""
+        with self.lock:
+            return {name: self.counters[name]
+                    for name in ('local_hits',
+                                 'shared_hits',
+                                 'negative_hits',
+                                 'misses')}
+
+    def _count(self, name, value=None):
+        # Called with self.lock held.
+        self.counters[name] += 1
+        if value == NEGATIVE:
+            self.counters['negative_hits'] += 1
+
+    def _timeout(self, value):
+        return self.negative_timeout if value == NEGATIVE else self.timeout
+
+    def _local_get(self, key):
+        # Called with self.lock held.
+        entry = self.local.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires < time.monotonic():
+            del self.local[key]
+            return None
+        self.local.move_to_end(key)
+        return value
+
+    def _local_set(self, key, value):
+        with self.lock:
+            self.local[key] = (value,
+                               time.monotonic() + self._timeout(value))
+            self.local.move_to_end(key)
+            while len(self.local) > self.max_size:
+                self.local.popitem(last=False)
+
+    def lookup(self, key, resolve):
+        """Return the course ID cached for key, or else call resolve()
+        to resolve it, and cache its result. resolve() must return the
+        course ID, or None if the SKU does not resolve to one, which
+        lookup() then returns, too.
+
+        Exceptions that resolve() raises are not cached.
+        """
+        with self.lock:
+            value = self._local_get(key)
+            if value is not None:
+                self._count('local_hits', value)
+                return value or None
+
+            resolution = self.resolutions.get(key)
+            leader = resolution is None
+            if leader:
+                resolution = Resolution()
+                self.resolutions[key] = resolution
+
+        if not leader:
+            # Another thread is resolving the same SKU.
+            resolution.done.wait()
+            if resolution.error is not None:
+                raise resolution.error
+            return resolution.value or None
+
+        try:
+            resolution.value = self._shared_lookup(key, resolve)
+            self._local_set(key, resolution.value)
+        except Exception as e:
+            resolution.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.resolutions[key]
+            resolution.done.set()
+        return resolution.value or None
+
+    def _cache_get(self, key):
+        try:
+            return cache.get(self.cache_key(key))
+        except Exception as e:
+            logger.warning('Unable to look up SKU %s in cache: %s' % (key, e))
+            return None
+
+    def _shared_lookup(self, key, resolve):
+        value = self._cache_get(key)
+        if value is not None:
+            with self.lock:
+                self._count('shared_hits', value)
+            return value
+
+        try:
+            leased = cache.add(self.lease_key(key), 1, RESOLVE_TIMEOUT)
+        except Exception as e:
+            logger.warning('Unable to lease SKU %s: %s' % (key, e))
+            leased = True
+
+        if not leased:
+            # Another process is resolving the same SKU.
+            deadline = time.monotonic() + RESOLVE_TIMEOUT
+            while time.monotonic() < deadline:
+                time.sleep(RESOLVE_POLL_INTERVAL)
+                value = self._cache_get(key)
+                if value is not None:
+                    with self.lock:
+                        self._count('shared_hits', value)
+                    return value
+
+        with self.lock:
+            self.counters['misses'] += 1
+        try:
+            value = resolve() or NEGATIVE
+            try:
+                cache.set(self.cache_key(key), value, self._timeout(value))
+            except Exception as e:
+                logger.warning('Unable to add SKU %s to cache: %s' % (key, e))
+        finally:
+            if leased:
+                try:
+                    cache.delete(self.lease_key(key))
+                except Exception:
+                    pass
+        return value
+
+
+_sku_cache = None
+_sku_cache_lock = threading.Lock()
+
+
+def get_sku_cache():
+    """Return the SKU cache, or None if SKU caching is disabled."""
+    global _sku_cache
+
+    if not settings.WEBHOOK_RECEIVER_SKU_CACHE:
+        return None
+
+    conf = (settings.WEBHOOK_RECEIVER_SKU_CACHE_TIMEOUT,
+            settings.WEBHOOK_RECEIVER_SKU_CACHE_NEGATIVE_TIMEOUT,
+            settings.WEBHOOK_RECEIVER_SKU_CACHE_LRU_SIZE)
+    with _sku_cache_lock:
+        if _sku_cache is None or (_sku_cache.timeout,
+                                  _sku_cache.negative_timeout,
+                                  _sku_cache.max_size) != conf:
+            _sku_cache = SKUCache(*conf)
+        return _sku_cache
+
+
+def reset_sku_cache():
+    """Forget the SKUs cached in this process (but not those in the
+    Django cache), and the counters."""
+    global _sku_cache
+    with _sku_cache_lock:
+        _sku_cache = None
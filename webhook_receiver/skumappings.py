@@ -0,0 +1,101 @@
+"""Syncing SKU mappings from the LMS.
+
+With WEBHOOK_RECEIVER_SKU_MAPPING set, lookup_course_id() consults the
+SKUMapping table before resolving a SKU on the LMS, and records each
+SKU that it does resolve there. To make sure that we already know
+the SKUs in the table (and those of the orders we have processed)
+when an order for one of them comes in, and that we notice when a
+SKU is changed to point to a different course, we resolve them up
+front, and then periodically resolve those that we haven't resolved
+for some time.
+
+The SKUs are resolved on the LMS concurrently, by up to a given number
+of threads, while the mappings are updated in the calling thread.
+"""
+
+import datetime
+import logging
+import re
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.apps import apps
+from django.conf import settings
+from django.utils import timezone
+
+from .models import OrderItem, SKUMapping
+from .utils import COURSE_ID_REGEX, resolve_sku
+
+
+logger = logging.getLogger(__name__)
+
+
+def known_skus():
+    """Return the set of SKUs in the SKUMapping table, and of all
+    order items, that aren't course IDs themselves."""
+    skus = set(SKUMapping.objects.values_list('sku', flat=True))
+    for model in apps.get_models():
+        if issubclass(model, OrderItem):
+            skus.update(model.objects.values_list('sku',
+                                                  flat=True).distinct())
+    return {sku for sku in skus if not re.match(COURSE_ID_REGEX, sku)}
+
+
+def stale_skus(skus, max_age):
+    """Return those of skus that we have no mapping for, or haven't
+    resolved for max_age seconds, in sorted order."""
+    cutoff = timezone.now() - datetime.timedelta(seconds=max_age)
+    fresh = set(SKUMapping.objects.filter(
+        resolved__gt=cutoff).values_list('sku', flat=True))
+    return sorted(set(skus) - fresh)
+
+
+def resolve(sku):
+    # Resolving a SKU that does not map to a course (any more) is not
+    # an error, but everything else is, and we don't want a single
+    # error to stop the sync.
+    try:
+        return sku, resolve_sku(sku), None
+    except Exception as e:
+        return sku, None, e
+
+
+def sync_sku_mappings(skus=None, max_age=None, parallelism=None):
+    """Resolve skus (or else all SKUs that we know of) that we haven't
+    resolved for max_age seconds, with up to parallelism concurrent
+    requests to the LMS, and update their mappings.
+
+    Return a dictionary with the numbers of SKUs that were updated
+    (or newly mapped), that were unmapped because they do not resolve
+    to a course ID any more, and that we failed to resolve.
+    """
+    if skus is None:
+        skus = known_skus()
+    if max_age is None:
+        max_age = settings.WEBHOOK_RECEIVER_SKU_SYNC_MAX_AGE
+    if parallelism is None:
+        parallelism = settings.WEBHOOK_RECEIVER_SKU_SYNC_PARALLELISM
+
+    counts = {'updated': 0, 'unmapped': 0, 'failed': 0}
+    skus = stale_skus(skus, max_age)
+    if not skus:
+        return counts
+
+    with ThreadPoolExecutor(max_workers=max(1, parallelism)) as executor:
+        for sku, course_id, error in executor.map(resolve, skus):
+            if error is not None:
+                logger.warning('Unable to resolve SKU %s: %s' % (sku,
+                                                                 error))
+                counts['failed'] += 1
+            elif course_id is None:
+                logger.info('SKU %s does not resolve to '
+                            'a course ID' % sku)
+                SKUMapping.objects.filter(sku=sku).delete()
+                counts['unmapped'] += 1
+            else:
+                SKUMapping.objects.update_or_create(
+                    sku=sku,
+                    defaults={'course_id': course_id,
+                              'resolved': timezone.now()})
+                counts['updated'] += 1
+    return counts
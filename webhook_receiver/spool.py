@@ -0,0 +1,308 @@
+"""A local, append-only spool for verified webhooks.
+
+When the database is unavailable, the webhook views append verified
+webhooks to a spool on local disk, and acknowledge them. The
+drain_webhook_spool management command later inserts spooled
+webhooks into the database, and dispatches them for processing.
+
+Each receiver process writes to its own segment files, which it holds
+an exclusive lock on while they are open. A segment is closed (and
+thus becomes eligible for draining) once it reaches a configurable
+age (whether or not the receiver spools any more webhooks), once the
+receiver manages to write to the database again, or when the receiver
+process exits.
+
+Each segment contains one JSON record per line. Appends are flushed to
+disk with fsync(), but rather than calling fsync() once per webhook,
+we let concurrent appends share a single fsync() call.
+"""
+
+import atexit
+import base64
+import fcntl
+import glob
+import json
+import logging
+import os
+import platform
+import threading
+import time
+
+from dateutil.parser import parse as parse_date
+
+from django.conf import settings
+from django.db import transaction
+
+from kombu.utils.imports import symbol_by_name
+
+from . import jsonbackend
+from .groupcommit import insert_webhooks
+from .models import JSONWebhookData
+
+
+SEGMENT_SUFFIX = '.spool'
+
+logger = logging.getLogger(__name__)
+
+
+class Spool(object):
+    """The spool segment writer of one receiver process."""
+
+    def __init__(self, directory, fsync_interval=0.005, segment_age=60):
+        self.pid = os.getpid()
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.segment_age = segment_age
+
+        # The lock protects the current segment file, and the number
+        # of records written to the spool.
+        self.lock = threading.Lock()
+        self.file = None
+        self.opened = None
+        self.timer = None
+        self.written = 0
+
+        # The condition protects the number of records we know to be
+        # on disk, and whether some thread is currently calling
+        # fsync() on behalf of all others.
+        self.cond = threading.Condition()
+        self.synced = 0
+        self.syncing = False
+
+    def append(self, record):
+        """Append a record to the spool, and return once it is on
+        disk."""
+        line = json.dumps(record).encode('utf-8') + b'\n'
+        with self.lock:
+            if self.file is not None:
+                if time.monotonic() - self.opened > self.segment_age:
+                    self._close_segment()
+            if self.file is None:
+                self._open_segment()
+            self.file.write(line)
+            self.file.flush()
+            self.written += 1
+            seq = self.written
+
+        self._sync(seq)
+
+    def close(self):
+        """Close the current segment, if any, making it eligible for
+        draining."""
+        with self.lock:
+            if self.file is not None:
+                self._close_segment()
+
+    def _sync(self, seq):
+        # Group fsync: the first thread to find no fsync() in progress
+        # waits briefly for other appends to join in, and then calls
+        # fsync() for all of them. All other threads wait until their
+        # record is covered by some fsync() call.
+        while True:
+            with self.cond:
+                while self.syncing and self.synced < seq:
+                    self.cond.wait()
+                if self.synced >= seq:
+                    return
+                self.syncing = True
+
+            target = 0
+            try:
+                time.sleep(self.fsync_interval)
+                with self.lock:
+                    target = self.written
+                    if self.file is not None:
+                        os.fsync(self.file.fileno())
+            finally:
+                with self.cond:
+                    self.syncing = False
+                    self.synced = max(self.synced, target)
+                    self.cond.notify_all()
+
+    def _open_segment(self):
+        # Create and lock the segment under a temporary name, so that
+        # the drainer never sees a segment that we don't yet hold a
+        # lock on.
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory,
+                            '%s-%d-%d' % (platform.node().split('.')[0],
+                                          os.getpid(),
+                                          time.time_ns()))
+        self.file = open(path + '.tmp', 'ab')
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        os.rename(path + '.tmp', path + SEGMENT_SUFFIX)
+        self.opened = time.monotonic()
+        logger.warning('Spooling webhooks to %s' % self.file.name)
+
+        # Close the segment once it reaches its age, even if we don't
+        # append to the spool any more.
+        self.timer = threading.Timer(self.segment_age,
+                                     self._expire_segment,
+                                     args=(self.file,))
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _expire_segment(self, file):
+        with self.lock:
+            if self.file is file:
+                logger.info('Closing spool segment %s' % file.name)
+                self._close_segment()
+
+    def _close_segment(self):
+        # Records in a segment we close are on disk, even if no
+        # thread has yet called fsync() for them.
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = None
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        with self.cond:
+            self.synced = max(self.synced, self.written)
+            self.cond.notify_all()
+
+
+_spool = None
+_spool_lock = threading.Lock()
+
+
+def get_spool():
+    """Return the spool of the current process, or None if spooling
+    is disabled."""
+    global _spool
+
+    if not settings.WEBHOOK_RECEIVER_SPOOL_DIR:
+        return None
+
+    directory = settings.WEBHOOK_RECEIVER_SPOOL_DIR
+    with _spool_lock:
+        # Don't reuse a spool inherited from a parent process, or one
+        # that writes to a directory we are no longer configured for.
+        if _spool is None or (_spool.pid, _spool.directory) != (os.getpid(),
+                                                                directory):
+            _spool = Spool(
+                directory,
+                settings.WEBHOOK_RECEIVER_SPOOL_FSYNC_INTERVAL,
+                settings.WEBHOOK_RECEIVER_SPOOL_SEGMENT_AGE,
+            )
+            atexit.register(_spool.close)
+        return _spool
+
+
+def release_spool():
+    """Close the current spool segment of this process, if any.
+
+    We call this once we have managed to write to the database again,
+    so that the drainer can pick up what we have spooled.
+    """
+    if _spool is not None and _spool.file is not None:
+        _spool.close()
+
+
+def spool_webhook(data, task):
+    """Append a verified webhook to the spool.
+
+    task is the dotted name of the task that the drainer dispatches
+    with the ID of the webhook, once it has inserted the webhook into
+    the database.
+    """
+    get_spool().append({
+        'task': task,
+        'status': data.status,
+        'received': data.received.isoformat(),
+        'source': data.source,
+        'headers': data.headers,
+        'body': base64.b64encode(bytes(data.body)).decode(),
+    })
+
+
+def read_segment(path):
+    """Read the records in a spool segment.
+
+    Return a list of (task, webhook data) tuples. Skip any line that
+    is not a valid record, which can only be the last line of a
+    segment whose writer crashed mid-append (and which thus never
+    acknowledged that webhook).
+    """
+    records = []
+    with open(path, 'rb') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                body = base64.b64decode(record['body'])
+                records.append((record['task'], JSONWebhookData(
+                    status=record['status'],
+                    received=parse_date(record['received']),
+                    source=record['source'],
+                    headers=record['headers'],
+                    body=body,
+                    content=jsonbackend.loads(body),
+                )))
+            except (ValueError, KeyError):
+                logger.warning('Skipping incomplete record '
+                               'in spool segment %s' % path)
+    return records
+
+
+def segment_mtime(path):
+    # Another drainer may have removed the segment since we listed it,
+    # in which case we skip it once we try to open it.
+    try:
+        return os.path.getmtime(path)
+    except FileNotFoundError:
+        return 0
+
+
+def closed_segments(directory):
+    """Yield the paths of segments that no receiver holds open,
+    oldest first, while holding a lock on each of them."""
+    for path in sorted(glob.glob(os.path.join(directory,
+                                              '*%s' % SEGMENT_SUFFIX)),
+                       key=segment_mtime):
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            continue
+        with f:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.debug('Skipping open spool segment %s' % path)
+                continue
+            # Another drainer may have drained and removed the segment
+            # between our opening and locking it.
+            try:
+                current = os.stat(path)
+            except FileNotFoundError:
+                continue
+            locked = os.fstat(f.fileno())
+            if (current.st_dev, current.st_ino) != (locked.st_dev,
+                                                    locked.st_ino):
+                continue
+            yield path
+
+
+def drain(directory):
+    """Insert the webhooks in all closed spool segments into the
+    database, and dispatch them for processing.
+
+    We remove a segment only after we have inserted and dispatched
+    all its webhooks. If we crash before that, a subsequent drain
+    inserts and dispatches the same webhooks again, which is harmless
+    since order processing is idempotent. Return the number of
+    webhooks drained.
+    """
+    count = 0
+    for path in closed_segments(directory):
+        records = read_segment(path)
+        if records:
+            with transaction.atomic():
+                webhooks = insert_webhooks([data for task, data in records])
+            for (task, _), data in zip(records, webhooks):
+                symbol_by_name(task).delay(data.id)
+        logger.info('Drained %d webhooks from '
+                    'spool segment %s' % (len(records), path))
+        os.remove(path)
+        count += len(records)
+
+    return count
@@ -1,8 +1,12 @@
-from celery import Task
+from asgiref.sync import sync_to_async
+
+from celery import Task, shared_task
 from celery.utils.log import get_task_logger
 
 from django.db import transaction
 
+from . import skumappings
+
 logger = get_task_logger(__name__)
 
 
@@ -22,7 +26,7 @@ class OrderTask(Task):
     def on_success(self, retval, task_id, args, kwargs):
         "Success handler: log successful order processing."
         logger.info('Successfully processed '
-                    'order %s' % self.order.id)
+                    'order %s' % self.order)
 
     def on_retry(self, exc, task_id, args, kwargs, einfo):
         """Retry handler: log an exception stack trace and a prose message,
@@ -31,7 +35,7 @@ class OrderTask(Task):
         """
         logger.warning('Failed to fully '
                        'process order %s '
-                       '(task ID %s), retrying: %s' % (self.order.id,
+                       '(task ID %s), retrying: %s' % (self.order,
                                                        task_id,
                                                        exc))
 
@@ -42,9 +46,39 @@ class OrderTask(Task):
         """
         logger.error('Failed to fully '
                      'process order %s '
-                     '(task ID %s): %s' % (self.order.id,
+                     '(task ID %s): %s' % (self.order,
                                            task_id,
                                            exc))
         self.order.fail()
         with transaction.atomic():
             self.order.save()
+
+
+async def adelay(task, *args, **kwargs):
+    """Publish a task message from async code, without blocking the
+    event loop.
+
+    Celery has no asyncio-native producer, so we publish from a worker
+    thread. In always-eager mode, however, the task itself runs in
+    that thread and talks to the database, so we must then use
+    Django's thread-sensitive executor.
+    """
+    thread_sensitive = bool(task.app.conf.task_always_eager)
+    return await sync_to_async(task.delay,
+                               thread_sensitive=thread_sensitive)(*args,
+                                                                  **kwargs)
+
+
+@shared_task
+def sync_sku_mappings():
+    """Resolve the SKUs that we haven't resolved for a while, and
+    update their mappings.
+
+    We run this periodically, every WEBHOOK_RECEIVER_SKU_SYNC_INTERVAL
+    seconds, if that is set.
+    """
+    counts = skumappings.sync_sku_mappings()
+    logger.info('Synced SKU mappings: updated %(updated)d, '
+                'unmapped %(unmapped)d, failed to resolve '
+                '%(failed)d SKUs' % counts)
+    return counts
@@ -1,25 +1,47 @@
 import base64
 import hashlib
 import hmac
-import json
 import logging
 import re
 import requests
 
-from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urljoin, urlparse
 
+from asgiref.sync import sync_to_async
+
+from django.core.exceptions import ValidationError
 from django.core.validators import validate_email
 from django.conf import settings
-from django.db import transaction
+from django.db import DatabaseError, transaction
+from django.utils import timezone
 
-from edx_rest_api_client.client import OAuthAPIClient
 from ipware import get_client_ip
+from requests.exceptions import HTTPError, TooManyRedirects
+from requests.models import DEFAULT_REDIRECT_LIMIT
+
+from . import jsonbackend
+from .coalescer import get_enrollment_coalescer
+from .groupcommit import get_group_commit
+from .lmsclient import get_lms_client
+from .models import JSONWebhookData, SKUMapping
+from .sharedset import get_shared_set
+from .signing import decode_signature, get_verifier
+from .skucache import get_sku_cache
+from .spool import get_spool, release_spool, spool_webhook
+
 
-from .models import JSONWebhookData
+COURSE_ID_REGEX = 'course-v1:[^/]+'
 
+# The errors that we retry processing an order on.
+RETRYABLE_ERRORS = (HTTPError,)
 
 EDX_BULK_ENROLLMENT_API_PATH = '%s/api/bulk_enroll/v1/bulk_enroll'
 
+# The size of the chunks in which read_signed_body() reads a request
+# body.
+BODY_CHUNK_SIZE = 64 * 1024
+
 logger = logging.getLogger(__name__)
 
 
@@ -27,34 +49,77 @@ class SKULookupException(Exception):
     pass
 
 
-def receive_json_webhook(request):
-    # Grab data from the request, and save it to the database right
-    # away.
-    data = JSONWebhookData(headers=dict(request.headers),
-                           body=request.body)
-    with transaction.atomic():
-        data.save()
+class WebhookException(Exception):
+    """A webhook that we refuse to process.
+
+    The status attribute holds the HTTP status code with which we
+    respond to the webhook sender.
+    """
+    status = 400
+
+
+class MalformedWebhookException(WebhookException):
+    """A webhook that lacks information we need to verify it."""
+    status = 400
+
+
+class InvalidWebhookException(WebhookException):
+    """A well-formed webhook that fails verification."""
+    status = 403
+
+
+class UnknownSourceException(InvalidWebhookException):
+    """A webhook from a shop or source that we don't know."""
+
+
+class DisallowedNetworkException(InvalidWebhookException):
+    """A webhook from a client IP address outside the networks we
+    accept webhooks from."""
+
+
+class OversizedWebhookException(WebhookException):
+    """A webhook whose body exceeds our maximum body size."""
+    status = 413
+
+
+def receive_json_webhook(request, body=None, allowed_headers=None):
+    # If the caller has already read the request body (see
+    # read_signed_body()), it passes it in as body. In compact storage
+    # mode, we only keep those request headers that are listed in
+    # allowed_headers.
+    # In single-write mode, we do all our preparatory work in memory,
+    # and leave it to fail_and_save() or finish_and_save() to persist
+    # the webhook, with a single INSERT, once its final state is
+    # known. Otherwise, we save the webhook to the database right
+    # away, and again on every change. Spooling implies single-write
+    # mode, since we can only spool a webhook that we have verified
+    # without touching the database.
+    single_write = any((settings.WEBHOOK_RECEIVER_SINGLE_WRITE,
+                        settings.WEBHOOK_RECEIVER_SPOOL_DIR))
+
+    # Grab data from the request.
+    data = JSONWebhookData(headers=request_headers(request,
+                                                   allowed_headers),
+                           body=request.body if body is None else body)
+    if not single_write:
+        with transaction.atomic():
+            data.save()
 
     # Transition the state from NEW to PROCESSING
     data.start_processing()
-    with transaction.atomic():
-        data.save()
+    if not single_write:
+        with transaction.atomic():
+            data.save()
 
     # Look up the source IP
-    ip, is_routable = get_client_ip(request)
-    if ip is None:
-        logger.warning("Unable to get client IP for webhook %s" % data.id)
-    data.source = ip
-    with transaction.atomic():
-        data.save()
+    set_source_ip(data, request)
+    if not single_write:
+        with transaction.atomic():
+            data.save()
 
     # Parse the payload as JSON
     try:
-        try:
-            data.content = json.loads(data.body)
-        except TypeError:
-            # Python <3.6 can't call json.loads() on a byte string
-            data.content = json.loads(data.body.decode('utf-8'))
+        parse_json_webhook(data)
     except Exception:
         # For any other exception, set the state to ERROR and then
         # throw the exception up the stack.
@@ -64,18 +129,193 @@ def receive_json_webhook(request):
     return data
 
 
+async def areceive_json_webhook(request, body=None, allowed_headers=None):
+    """Async counterpart of receive_json_webhook().
+
+    This always behaves as in single-write mode: we do not touch the
+    database until afail_and_save() or afinish_and_save() persist the
+    webhook in its final state.
+    """
+    data = JSONWebhookData(headers=request_headers(request,
+                                                   allowed_headers),
+                           body=request.body if body is None else body)
+    data.start_processing()
+    set_source_ip(data, request)
+
+    try:
+        parse_json_webhook(data)
+    except Exception:
+        await afail_and_save(data)
+        raise
+
+    return data
+
+
+def set_source_ip(data, request):
+    """Look up the client IP of a request, and record it as the
+    webhook source."""
+    ip, is_routable = get_client_ip(request)
+    if ip is None:
+        logger.warning("Unable to get client IP for webhook "
+                       "received at %s" % data.received)
+    data.source = ip
+
+
+def parse_json_webhook(data):
+    """Parse the webhook body as JSON, and store the result in
+    data.content."""
+    # Depending on the database backend, a BinaryField we read
+    # back from the database may be a memoryview rather than a
+    # bytestring.
+    data.content = jsonbackend.loads(bytes(data.body))
+
+
 def fail_and_save(data):
     data.fail()
-    with transaction.atomic():
-        data.save()
+    save_webhook(data)
 
 
 def finish_and_save(data):
     data.finish_processing()
+    save_webhook(data)
+
+
+def save_webhook(data):
+    """Save a webhook.
+
+    With group commit enabled, insert a new webhook together with
+    those of concurrent requests.
+    """
+    group_commit = get_group_commit()
+    if data.pk is None and group_commit is not None:
+        group_commit.insert(data)
+        return
+
     with transaction.atomic():
         data.save()
 
 
+def finish_or_spool(data, task):
+    """Mark a verified webhook as processed, and save it.
+
+    If the database is unavailable and we have a spool, append the
+    webhook to the spool instead. Once the spool is drained, the
+    webhook's ID is dispatched to the Celery task named task. Return
+    True if we saved the webhook to the database, and False if we
+    spooled it.
+    """
+    try:
+        finish_and_save(data)
+    except DatabaseError:
+        if get_spool() is None:
+            raise
+        logger.exception('Unable to save webhook, spooling it')
+        spool_webhook(data, task)
+        return False
+
+    release_spool()
+    return True
+
+
+# The async variants of fail_and_save() and finish_and_save() only
+# ever insert a webhook that areceive_json_webhook() has kept in
+# memory. A single INSERT needs no explicit transaction.
+async def afail_and_save(data):
+    data.fail()
+    await data.asave()
+
+
+async def afinish_and_save(data):
+    data.finish_processing()
+    await data.asave()
+
+
+async def afinish_or_spool(data, task):
+    """Async counterpart of finish_or_spool()."""
+    try:
+        await afinish_and_save(data)
+    except DatabaseError:
+        if get_spool() is None:
+            raise
+        logger.exception('Unable to save webhook, spooling it')
+        await sync_to_async(spool_webhook,
+                            thread_sensitive=False)(data, task)
+        return False
+
+    release_spool()
+    return True
+
+
+def request_headers(request, allowed_headers):
+    """Return the request headers that we store for a webhook.
+
+    Those are all of them, unless we are in compact storage mode and
+    allowed_headers is given.
+    """
+    if allowed_headers and settings.WEBHOOK_RECEIVER_COMPACT_STORAGE:
+        return filter_headers(request, allowed_headers)
+    return dict(request.headers)
+
+
+def filter_headers(request, allowed_headers):
+    """Return those request headers that are in allowed_headers."""
+    return {name: request.headers[name]
+            for name in allowed_headers
+            if name in request.headers}
+
+
+def store_json_webhook(request, allowed_headers, body=None):
+    """Store an incoming webhook verbatim, for deferred processing.
+
+    Save only the request body, those headers that are listed in
+    allowed_headers, and the source IP, with a single INSERT. Parsing
+    and verification are left to ingest_json_webhook(). If the caller
+    has already read the request body, it passes it in as body.
+    """
+    data = JSONWebhookData(headers=filter_headers(request,
+                                                  allowed_headers),
+                           body=request.body if body is None else body)
+    set_source_ip(data, request)
+    save_webhook(data)
+
+    return data
+
+
+async def astore_json_webhook(request, allowed_headers, body=None):
+    """Async counterpart of store_json_webhook()."""
+    data = JSONWebhookData(headers=filter_headers(request,
+                                                  allowed_headers),
+                           body=request.body if body is None else body)
+    set_source_ip(data, request)
+    await data.asave()
+
+    return data
+
+
+def ingest_json_webhook(webhook_id, verify):
+    """Parse and verify a webhook stored by store_json_webhook().
+
+    verify is a callable that takes the webhook data and raises
+    WebhookException if it fails verification. Return the webhook
+    data in the PROCESSED state, or None if the webhook could not be
+    parsed or verified, in which case it is saved in the ERROR
+    state.
+    """
+    data = JSONWebhookData.objects.get(id=webhook_id)
+    data.start_processing()
+
+    try:
+        parse_json_webhook(data)
+        verify(data)
+    except Exception as e:
+        logger.error('Unable to ingest webhook %s: %s' % (data.id, e))
+        fail_and_save(data)
+        return None
+
+    finish_and_save(data)
+    return data
+
+
 def get_hmac(key, body):
     digest = hmac.new(key.encode('utf-8'),
                       body,
@@ -84,36 +324,198 @@ def get_hmac(key, body):
 
 
 def hmac_is_valid(key, body, hmac_to_verify):
-    return get_hmac(key, body) == hmac_to_verify
+    return get_verifier((key,)).verify(body, hmac_to_verify)
+
+
+def read_signed_body(request, verifier, hmac_to_verify):
+    """Read a request body in chunks, computing its HMAC signature
+    as we go.
+
+    Rather than have Django read the whole body into memory before we
+    compute its signature, we feed each chunk into both the
+    verifier's signer and the buffer that becomes the stored webhook
+    body. Before reading anything, reject a signature header that
+    cannot possibly match, and a body whose declared length exceeds
+    WEBHOOK_RECEIVER_MAX_BODY_SIZE; stop reading as soon as the body
+    turns out to exceed it. Return the body, and its raw digest with
+    the current secret, for passing on to Verifier.verify().
+    """
+    if decode_signature(hmac_to_verify) is None:
+        raise InvalidWebhookException('Malformed HMAC signature')
+
+    max_size = settings.WEBHOOK_RECEIVER_MAX_BODY_SIZE
+    try:
+        content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        content_length = 0
+    if content_length > max_size:
+        raise OversizedWebhookException(
+            'Request body of %d bytes exceeds maximum '
+            'of %d bytes' % (content_length, max_size))
+
+    signer = verifier.signer()
+    chunks = []
+    size = 0
+    while True:
+        chunk = request.read(BODY_CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_size:
+            raise OversizedWebhookException(
+                'Request body exceeds maximum '
+                'of %d bytes' % max_size)
+        signer.update(chunk)
+        chunks.append(chunk)
+
+    return b''.join(chunks), signer.digest()
+
+
+def get_deliveries(platform):
+    """Return the shared set of accepted delivery IDs for a platform,
+    or None if we don't deduplicate deliveries."""
+    if not settings.WEBHOOK_RECEIVER_DEDUPLICATE_DELIVERIES:
+        return None
+    return get_shared_set('webhook_receiver:delivery:%s' % platform,
+                          settings.WEBHOOK_RECEIVER_DELIVERY_ID_TIMEOUT,
+                          settings.WEBHOOK_RECEIVER_DELIVERY_ID_LRU_SIZE)
+
+
+def delivery_key(headers, header, shop_header):
+    """Return the key under which we record the delivery of a webhook
+    with the given headers, or None if it has no delivery ID.
+
+    Different shops may use the same delivery IDs, so the key is the
+    pair of the shop (from shop_header) and the delivery ID (from
+    header).
+    """
+    delivery_id = headers.get(header)
+    if not delivery_id:
+        return None
+    return (headers.get(shop_header, ''), delivery_id)
+
+
+def record_delivery(platform, data, header, shop_header):
+    """Record the delivery of a webhook that we have verified, by its
+    stored headers."""
+    deliveries = get_deliveries(platform)
+    key = delivery_key(data.headers or {}, header, shop_header)
+    if deliveries is None or key is None:
+        return
+    deliveries.add(key)
+
+
+def processed_orders(platform):
+    """Return the shared set of a platform's orders that are known to
+    be processed, as (shop, order ID) pairs, or None if we don't keep
+    track of them.
+
+    Processed is a final state, so once an order is in this set, we
+    need not look it up in the database ever again.
+    """
+    if not settings.WEBHOOK_RECEIVER_PROCESSED_ORDER_CACHE:
+        return None
+    return get_shared_set('webhook_receiver:processed:%s' % platform,
+                          settings.WEBHOOK_RECEIVER_PROCESSED_ORDER_TIMEOUT,
+                          settings.WEBHOOK_RECEIVER_PROCESSED_ORDER_LRU_SIZE)
 
 
 def lookup_course_id(sku):
     """Look up the course ID for a SKU"""
-    course_id_regex = 'course-v1:[^/]+'
+    course_id = mapped_course_id(sku)
+    if course_id is not None:
+        return course_id
+    return record_course_id(sku, resolve_course_id(sku))
+
+
+def mapped_course_id(sku):
+    """Return the course ID for a SKU that is a course ID itself, or
+    that we have a SKU mapping for, or else None."""
 
     # If the SKU we're given matches the regex from the beginning of
     # its string, great. It looks like a course ID, use it verbatim.
-    if re.match(course_id_regex, sku):
+    if re.match(COURSE_ID_REGEX, sku):
         return sku
 
-    # OK, the SKU does not look like a course ID. So, expect to be
-    # able to look up the actual course ID via an HTTP redirect.
-    lookup_url = '%s/%s%s' % (settings.WEBHOOK_RECEIVER_LMS_BASE_URL,
-                              settings.WEBHOOK_RECEIVER_SKU_PREFIX,
-                              sku)
+    # If we keep SKU mappings, and have one for this SKU, use it.
+    if settings.WEBHOOK_RECEIVER_SKU_MAPPING:
+        mapping = SKUMapping.objects.filter(sku=sku).first()
+        if mapping is not None:
+            logger.debug('SKU %s is mapped to '
+                         'course ID %s.' % (sku, mapping.course_id))
+            return mapping.course_id
+
+    return None
+
+
+def resolve_course_id(sku):
+    """Resolve a SKU that does not look like a course ID on the LMS,
+    and return its course ID, or None if it does not resolve to one.
+
+    This does not touch the database, so it is safe to call from any
+    thread.
+    """
+    # Expect to be able to look up the actual course ID via an HTTP
+    # redirect, unless we've recently resolved the SKU (with the same
+    # LMS URL and SKU prefix), in which case we use the cached course
+    # ID.
+    sku_cache = get_sku_cache()
+    if sku_cache is None:
+        return resolve_sku(sku)
+    return sku_cache.lookup(sku_lookup_url(sku),
+                            lambda: resolve_sku(sku))
+
+
+def record_course_id(sku, course_id):
+    """Return the course ID that a SKU has been resolved to, and record
+    the SKU mapping, or raise SKULookupException if the SKU didn't
+    resolve to a course ID."""
+
+    # We haven't found a match, so we can't resolve to a proper course
+    # ID.
+    if course_id is None:
+        raise SKULookupException('Unable to find a course ID '
+                                 'matching SKU %s' % sku)
+
+    # Record the SKU mapping, so that we don't have to resolve the
+    # SKU again.
+    if settings.WEBHOOK_RECEIVER_SKU_MAPPING:
+        SKUMapping.objects.update_or_create(
+            sku=sku,
+            defaults={'course_id': course_id,
+                      'resolved': timezone.now()})
+    return course_id
+
+
+def sku_lookup_url(sku):
+    """Return the LMS URL that redirects to the course for a SKU."""
+    return '%s/%s%s' % (settings.WEBHOOK_RECEIVER_LMS_BASE_URL,
+                        settings.WEBHOOK_RECEIVER_SKU_PREFIX,
+                        sku)
+
+
+def resolve_sku(sku):
+    """Resolve a SKU to a course ID by looking up the URL that its
+    lookup URL redirects to, or return None if that URL does not
+    contain a course ID."""
+    lookup_url = sku_lookup_url(sku)
     logger.debug('Resolving SKU %s by looking up %s.' % (sku, lookup_url))
-    resp = requests.head(lookup_url,
-                         allow_redirects=True)
-    resp.raise_for_status()
+    if settings.WEBHOOK_RECEIVER_SKU_SINGLE_HOP:
+        url = follow_redirects_to_course(lookup_url)
+    else:
+        resp = requests.head(lookup_url,
+                             allow_redirects=True)
+        resp.raise_for_status()
+        url = resp.url
 
     # The redirect could point to anywhere in the course: the course
     # URL, the course /about page, the course /course page. Thus,
     # extract the path from the redirect URL, and match it against the
     # pattern. That way, we'll catch anything from the marker
     # "course-v1" up to and excluding the next slash, if there is one.
-    logger.debug('Resolving SKU %s returned URL %s.' % (sku, resp.url))
-    path = urlparse(resp.url).path
-    matches = re.findall(course_id_regex,
+    logger.debug('Resolving SKU %s returned URL %s.' % (sku, url))
+    path = urlparse(url).path
+    matches = re.findall(COURSE_ID_REGEX,
                          path)
 
     # We've found a match, great. Evidently this redirect helped us to
@@ -124,10 +526,32 @@ def lookup_course_id(sku):
                      'course ID %s.' % (sku, course_id))
         return course_id
 
-    # We haven't found a match, so we can't resolve to a proper course
-    # ID.
-    raise SKULookupException('Unable to find a course ID '
-                             'matching SKU %s' % sku)
+    return None
+
+
+def follow_redirects_to_course(url):
+    """Follow the redirects from url, one at a time, until one points
+    to a URL whose path contains a course ID, and return that URL
+    without requesting it. If none does, return the URL that the last
+    redirect points to.
+
+    Like requests, give up after requests.models.DEFAULT_REDIRECT_LIMIT
+    redirects.
+    """
+    for i in range(DEFAULT_REDIRECT_LIMIT + 1):
+        resp = requests.head(url,
+                             allow_redirects=False)
+        if not resp.is_redirect:
+            resp.raise_for_status()
+            return url
+
+        # The Location header may be relative to the URL we requested.
+        url = urljoin(url, resp.headers['Location'])
+        if re.search(COURSE_ID_REGEX, urlparse(url).path):
+            return url
+
+    raise TooManyRedirects('Exceeded %d redirects.' % DEFAULT_REDIRECT_LIMIT,
+                           response=resp)
 
 
 def enroll_in_course(
@@ -145,25 +569,39 @@ def enroll_in_course(
     # Raises ValidationError if invalid
     validate_email(email)
 
-    client = OAuthAPIClient(
-        settings.WEBHOOK_RECEIVER_LMS_BASE_URL,
-        settings.WEBHOOK_RECEIVER_EDX_OAUTH2_KEY,
-        settings.WEBHOOK_RECEIVER_EDX_OAUTH2_SECRET,
-    )
-
-    bulk_enroll_url = EDX_BULK_ENROLLMENT_API_PATH % settings.WEBHOOK_RECEIVER_LMS_BASE_URL  # noqa: E501
-
     # The bulk enrollment API allows us to enroll multiple identifiers
     # at once, using a comma-separated list for the courses and
-    # identifiers parameters. We deliberately want to process
+    # identifiers parameters. Unless we batch enrollments (see
+    # enroll_order_items()), we deliberately want to process
     # enrollments one by one, so we use a single request for each
     # course/identifier combination.
+    bulk_enroll([course_id], [email], send_email, auto_enroll)
+
+
+def bulk_enroll(
+        course_ids,
+        emails,
+        send_email=settings.WEBHOOK_RECEIVER_SEND_ENROLLMENT_EMAIL,
+        auto_enroll=settings.WEBHOOK_RECEIVER_AUTO_ENROLL
+):
+    """
+    Auto-enroll each of a list of emails in each of a list of courses,
+    with a single request to the bulk enrollment API, and return the
+    API's response, parsed from JSON.
+    """
+
+    # Reuse this process's client, its access token, and its
+    # connections to the LMS.
+    client = get_lms_client()
+
+    bulk_enroll_url = EDX_BULK_ENROLLMENT_API_PATH % settings.WEBHOOK_RECEIVER_LMS_BASE_URL  # noqa: E501
+
     request_params = {
         "auto_enroll": auto_enroll,
         "email_students": send_email,
         "action": "enroll",
-        "courses": course_id,
-        "identifiers": email,
+        "courses": ','.join(course_ids),
+        "identifiers": ','.join(emails),
     }
 
     logger.debug("Sending POST request "
@@ -192,8 +630,253 @@ def enroll_in_course(
                      "returned HTTP %s" % (bulk_enroll_url,
                                            request_params,
                                            response.status_code))
+    if response.status_code == 401:
+        # Fetch a new access token when we retry.
+        client.invalidate_token()
     response.raise_for_status()
 
     # If all is well, log the response at the debug level.
+    result = response.json()
     logger.debug("Received response from %s: %s " % (bulk_enroll_url,
-                                                     response.json()))
+                                                     result))
+    return result
+
+
+def failed_identifiers(result, course_id, identifiers):
+    """Return those of identifiers that the bulk enrollment API
+    reports to have failed to enroll in a course, in its response
+    result.
+
+    If the response has no results for the course, we can't tell
+    whether any of them were enrolled, so they all count as failed.
+    """
+    try:
+        results = result['courses'][course_id]['results']
+    except (KeyError, TypeError):
+        logger.error('Bulk enrollment response lacks '
+                     'results for course %s' % course_id)
+        return set(identifiers)
+    # The API flags an identifier that is neither a valid username
+    # nor a valid email address with invalidIdentifier, and one that
+    # it failed to enroll with error.
+    return {r.get('identifier') for r in results
+            if r.get('error') or r.get('invalidIdentifier')}
+
+
+def enrollment_batches(enrollments):
+    """Group (course ID, email) pairs into batches for the bulk
+    enrollment API, which enrolls every email in a request in every
+    course in it.
+
+    Return a list of (course IDs, emails) tuples, with one tuple for
+    each distinct set of emails that are to be enrolled in a course.
+    """
+    emails_by_course = {}
+    for course_id, email in enrollments:
+        emails_by_course.setdefault(course_id, set()).add(email)
+
+    courses_by_emails = {}
+    for course_id, emails in emails_by_course.items():
+        courses_by_emails.setdefault(frozenset(emails),
+                                     []).append(course_id)
+
+    return [(sorted(course_ids), sorted(emails))
+            for emails, course_ids in courses_by_emails.items()]
+
+
+class EnrollmentException(Exception):
+    """The bulk enrollment API failed to enroll some learners."""
+
+
+def send_enrollments(enrollments):
+    """Send a list of (course ID, email, send_email) enrollments to the
+    bulk enrollment API, with as few requests as possible. send_email
+    applies to a whole request, so enrollments that differ in it are
+    never sent together.
+
+    Return a list with an error for each enrollment: None if it
+    succeeded, EnrollmentException if the API reports that it failed,
+    or whatever exception its request raised.
+    """
+    by_send_email = {}
+    for course_id, email, send_email in enrollments:
+        by_send_email.setdefault(send_email, []).append((course_id, email))
+
+    errors = {}
+    for send_email, pairs in by_send_email.items():
+        for course_ids, emails in enrollment_batches(pairs):
+            try:
+                result = bulk_enroll(course_ids, emails, send_email)
+            except Exception as e:
+                for course_id in course_ids:
+                    for email in emails:
+                        errors[(course_id, email, send_email)] = e
+                continue
+
+            for course_id in course_ids:
+                for email in failed_identifiers(result, course_id,
+                                                emails):
+                    error = EnrollmentException(
+                        'Failed to enroll %s in course %s' % (email,
+                                                              course_id))
+                    errors[(course_id, email, send_email)] = error
+
+    return [errors.get(enrollment) for enrollment in enrollments]
+
+
+def finish_order_item(order_item):
+    order_item.finish_processing()
+    with transaction.atomic():
+        order_item.save()
+
+
+def fail_order_item(order_item):
+    order_item.fail()
+    with transaction.atomic():
+        order_item.save()
+
+
+def enroll_order_items(
+        order_items,
+        send_email=settings.WEBHOOK_RECEIVER_SEND_ENROLLMENT_EMAIL
+):
+    """Enroll the learners of several order items, which we have
+    started processing, in their courses, with as few bulk enrollment
+    requests as possible (and if enrollment coalescing is enabled,
+    together with the order items of concurrently processed orders).
+
+    Mark each order item as processed or failed, according to the
+    result for its learner and course. If any order item fails, raise
+    EnrollmentException once we are done with all of them. Propagate
+    any other error, to be handled up the stack.
+    """
+    # Look up each SKU only once.
+    course_ids = {}
+    for order_item in order_items:
+        if order_item.sku not in course_ids:
+            course_ids[order_item.sku] = lookup_course_id(order_item.sku)
+
+    failed = []
+    valid_items = []
+    for order_item in order_items:
+        try:
+            validate_email(order_item.email)
+        except ValidationError:
+            logger.error('Invalid email address %s in order '
+                         'item %s' % (order_item.email, order_item.id))
+            failed.append(order_item)
+            continue
+        valid_items.append(order_item)
+
+    enrollments = [(course_ids[order_item.sku],
+                    order_item.email,
+                    send_email)
+                   for order_item in valid_items]
+    coalescer = get_enrollment_coalescer(send_enrollments)
+    if coalescer is None:
+        errors = send_enrollments(enrollments)
+    else:
+        errors = coalescer.enroll(enrollments)
+
+    retry_error = None
+    for order_item, error in zip(valid_items, errors):
+        if error is None:
+            finish_order_item(order_item)
+        elif isinstance(error, EnrollmentException):
+            logger.error(error)
+            failed.append(order_item)
+        elif retry_error is None:
+            retry_error = error
+
+    # We only mark failed order items once there is nothing left to
+    # retry, so that when we retry, we don't trip over order items in
+    # the ERROR state.
+    if retry_error is not None:
+        raise retry_error
+
+    if failed:
+        for order_item in failed:
+            fail_order_item(order_item)
+        raise EnrollmentException('Failed to process order '
+                                  'items %s' % ', '.join(
+                                      str(order_item.id)
+                                      for order_item in failed))
+
+
+def process_order_items(
+        order_items,
+        send_email=settings.WEBHOOK_RECEIVER_SEND_ENROLLMENT_EMAIL
+):
+    """Resolve the SKUs of several order items, which we have started
+    processing, and enroll their learners, in up to
+    WEBHOOK_RECEIVER_LINE_ITEM_CONCURRENCY concurrent threads.
+
+    Mark each order item as processed as soon as its learner is
+    enrolled, and leave the others in the PROCESSING state, so that we
+    process them again when we retry. Once all order items are done,
+    raise the error of the first that failed with an error we retry
+    on (see RETRYABLE_ERRORS), or else that of the first that failed.
+
+    Each distinct SKU is resolved only once. The worker threads only
+    talk to the LMS, while the SKU mappings are read and recorded in
+    the calling thread, like all other database access. Should the
+    task's soft time limit interrupt us, we don't wait for SKUs or
+    order items that are still being processed.
+    """
+    max_workers = settings.WEBHOOK_RECEIVER_LINE_ITEM_CONCURRENCY
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    errors = {}
+    try:
+        # Resolve the SKUs that are neither course IDs nor mapped to
+        # one concurrently.
+        course_ids = {}
+        sku_errors = {}
+        futures = {}
+        for sku in dict.fromkeys(order_item.sku
+                                 for order_item in order_items):
+            try:
+                course_id = mapped_course_id(sku)
+            except Exception as e:
+                sku_errors[sku] = e
+                continue
+            if course_id is None:
+                futures[executor.submit(resolve_course_id, sku)] = sku
+            else:
+                course_ids[sku] = course_id
+        for future in as_completed(futures):
+            sku = futures[future]
+            try:
+                course_ids[sku] = record_course_id(sku, future.result())
+            except Exception as e:
+                sku_errors[sku] = e
+
+        futures = {}
+        for i, order_item in enumerate(order_items):
+            if order_item.sku in sku_errors:
+                logger.warning('Failed to process order item %s: '
+                               '%s' % (order_item.id,
+                                       sku_errors[order_item.sku]))
+                errors[i] = sku_errors[order_item.sku]
+                continue
+            futures[executor.submit(enroll_in_course,
+                                    course_ids[order_item.sku],
+                                    order_item.email,
+                                    send_email)] = i
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                logger.warning('Failed to process order item '
+                               '%s: %s' % (order_items[i].id, e))
+                errors[i] = e
+                continue
+            finish_order_item(order_items[i])
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    if errors:
+        errors = [errors[i] for i in sorted(errors)]
+        retryable = [error for error in errors
+                     if isinstance(error, RETRYABLE_ERRORS)]
+        raise (retryable or errors)[0]
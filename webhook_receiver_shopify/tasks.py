@@ -1,12 +1,17 @@
 from celery import shared_task
 from celery.utils.log import get_task_logger
 
-from requests.exceptions import HTTPError
+from django.conf import settings
 
-from webhook_receiver.tasks import OrderTask
+from webhook_receiver.models import JSONWebhookData
+from webhook_receiver.tasks import OrderTask, adelay
+from webhook_receiver.utils import ingest_json_webhook, processed_orders
+from webhook_receiver.utils import RETRYABLE_ERRORS, record_delivery
 
 from .models import ShopifyOrder as Order
-from .utils import process_order
+from .utils import process_order, record_order, verify_webhook
+from .utils import DELIVERY_ID_HEADER, SHOP_HEADER
+from .utils import arecord_order, get_shop_conf, order_shop
 
 
 logger = get_task_logger(__name__)
@@ -16,8 +21,8 @@ logger = get_task_logger(__name__)
              max_retries=3,
              soft_time_limit=5,
              base=OrderTask,
-             autoretry_for=(HTTPError,))
-def process(self, data, send_email=False):
+             autoretry_for=RETRYABLE_ERRORS)
+def process(self, data, send_email=False, shop=None):
     """Parse input data for line items, and create enrollments.
 
     On any error, raise the exception in order to be handled by
@@ -25,6 +30,116 @@ def process(self, data, send_email=False):
     """
 
     logger.debug('Processing order data: %s' % data)
-    self.order = Order.objects.get(id=data['id'])
+    orders = Order.objects.filter(order_id=data['id'])
+    # Tasks scheduled before we recorded the shop of each order don't
+    # name one.
+    if shop is not None:
+        orders = orders.filter(shop=shop)
+    self.order = orders.get()
 
     process_order(self.order, data, send_email)
+
+
+@shared_task
+def ingest(webhook_id):
+    """Parse and verify a webhook that was stored without
+    verification, and schedule its order for processing.
+
+    This is the deferred counterpart of the checks that the view
+    otherwise applies while receiving the webhook.
+    """
+
+    data = ingest_json_webhook(webhook_id, verify_webhook)
+    if data is None:
+        return
+
+    record_delivery('shopify', data, DELIVERY_ID_HEADER, SHOP_HEADER)
+
+    schedule_order(data)
+
+
+@shared_task
+def dispatch(webhook_id):
+    """Record and schedule the order in a webhook that we have
+    verified, but not acted upon yet.
+
+    This happens when we receive a webhook while the database is
+    unavailable: we then spool the webhook, and dispatch it once the
+    spool is drained.
+    """
+
+    data = JSONWebhookData.objects.get(id=webhook_id)
+    schedule_order(data)
+
+
+def schedule_order(data):
+    """Record the order contained in a verified webhook, and schedule
+    it for processing unless that has already happened.
+
+    Return the order, or None if we know that it has been processed
+    without even looking it up.
+    """
+    conf = get_shop_conf(data)
+
+    processed = processed_orders('shopify')
+    if processed is not None:
+        order_id = data.content['id']
+        if (order_shop(data), order_id) in processed:
+            logger.info('Order %s already processed, '
+                        'nothing to do' % order_id)
+            return None
+
+    order, created = record_order(data)
+    if created:
+        logger.info('Created order %s' % order)
+    else:
+        logger.info('Retrieved order %s' % order)
+
+    send_email = conf.get('send_email',
+                          settings.WEBHOOK_RECEIVER_SEND_ENROLLMENT_EMAIL)
+
+    # Process order
+    if order.status == Order.NEW:
+        logger.info('Scheduling order %s for processing' % order)
+        process.delay(data.content, send_email, order.shop)
+    else:
+        logger.info('Order %s already processed, '
+                    'nothing to do' % order)
+        if processed is not None and order.status == Order.PROCESSED:
+            processed.add((order.shop, order.order_id))
+
+    return order
+
+
+async def aschedule_order(data):
+    """Async counterpart of schedule_order()."""
+    conf = get_shop_conf(data)
+
+    processed = processed_orders('shopify')
+    if processed is not None:
+        order_id = data.content['id']
+        if await processed.acontains((order_shop(data), order_id)):
+            logger.info('Order %s already processed, '
+                        'nothing to do' % order_id)
+            return None
+
+    order, created = await arecord_order(data)
+    if created:
+        logger.info('Created order %s' % order)
+    else:
+        logger.info('Retrieved order %s' % order)
+
+    send_email = conf.get('send_email',
+                          settings.WEBHOOK_RECEIVER_SEND_ENROLLMENT_EMAIL)
+
+    # Process order
+    if order.status == Order.NEW:
+        logger.info('Scheduling order %s for processing' % order)
+        await adelay(process, data.content, send_email, order.shop)
+    else:
+        logger.info('Order %s already processed, '
+                    'nothing to do' % order)
+        if processed is not None and order.status == Order.PROCESSED:
+            await processed.aadd((order.shop, order.order_id))
+
+    return order
@@ -1,7 +1,13 @@
-from .views import order_create
-
+from django.conf import settings
 from django.urls import path
 
+from . import views
+
+if settings.WEBHOOK_RECEIVER_ASYNC_VIEWS:
+    order_create = views.aorder_create
+else:
+    order_create = views.order_create
+
 urlpatterns = [
     path('order/create',
          order_create,
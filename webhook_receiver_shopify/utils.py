@@ -2,42 +2,160 @@ from __future__ import unicode_literals
 
 import logging
 
+from django.conf import settings
 from django.db import transaction
 
+from webhook_receiver.shops import get_shop, shop_conf
 from webhook_receiver.utils import enroll_in_course, lookup_course_id
+from webhook_receiver.utils import enroll_order_items, process_order_items
+from webhook_receiver.utils import read_signed_body, processed_orders
+from webhook_receiver.utils import MalformedWebhookException
+from webhook_receiver.utils import InvalidWebhookException
+from webhook_receiver.utils import UnknownSourceException
 
 from .models import ShopifyOrder as Order
 from .models import ShopifyOrderItem as OrderItem
 
 
+# The request headers that we need for verifying and auditing a
+# webhook.
+WEBHOOK_HEADERS = (
+    'Content-Type',
+    'User-Agent',
+    'X-Shopify-Api-Version',
+    'X-Shopify-Hmac-Sha256',
+    'X-Shopify-Shop-Domain',
+    'X-Shopify-Topic',
+    'X-Shopify-Triggered-At',
+    'X-Shopify-Webhook-Id',
+)
+
+# The request header that identifies a webhook delivery. It is the
+# same for all attempts to deliver a webhook.
+DELIVERY_ID_HEADER = 'X-Shopify-Webhook-Id'
+
+# The request header that names the shop that sent a webhook.
+SHOP_HEADER = 'X-Shopify-Shop-Domain'
+
 logger = logging.getLogger(__name__)
 
 
+def verify_headers(headers):
+    """Look up the shop that a webhook comes from by its shop domain
+    header, and return the shop and the webhook's HMAC signature
+    header.
+
+    Raise MalformedWebhookException if the webhook lacks the headers
+    we need, and InvalidWebhookException if it comes from an unknown
+    shop.
+    """
+    try:
+        shop_domain = headers['X-Shopify-Shop-Domain']
+    except KeyError:
+        raise MalformedWebhookException(
+            'Request is missing X-Shopify-Shop-Domain header')
+
+    shop = get_shop('shopify', shop_domain)
+    if shop is None:
+        raise UnknownSourceException(
+            'Unknown shop domain %s' % shop_domain)
+
+    try:
+        return shop, headers['X-Shopify-Hmac-Sha256']
+    except KeyError:
+        raise MalformedWebhookException(
+            'Request is missing X-Shopify-Hmac-Sha256 header')
+
+
+def get_shop_conf(data):
+    """Return the settings of the shop that a webhook comes from."""
+    return shop_conf('shopify', data.headers.get('X-Shopify-Shop-Domain'))
+
+
+def read_webhook(request):
+    """Verify the headers of a webhook request, and then read its
+    body.
+
+    In streaming mode, compute the body's signature while reading it.
+    With early rejection enabled, also verify the signature, so that
+    we reject a forged webhook before we store anything. Return the
+    body and its signature, for passing on to receive_json_webhook()
+    and verify_webhook(), respectively.
+    """
+    shop, hmac = verify_headers(request.headers)
+    if settings.WEBHOOK_RECEIVER_STREAMING_INTAKE:
+        body, signature = read_signed_body(request, shop.verifier, hmac)
+    else:
+        body = request.body
+        signature = shop.verifier.sign(body)
+
+    if settings.WEBHOOK_RECEIVER_EARLY_REJECT:
+        if not shop.verifier.verify(body, hmac, signature):
+            raise InvalidWebhookException(
+                'Failed to verify HMAC signature')
+
+    return body, signature
+
+
+def verify_webhook(data, signature=None):
+    """Verify the shop domain and HMAC signature of a webhook.
+
+    If we have already computed the signature of the webhook body
+    while reading it (see read_webhook()), pass it in as signature.
+
+    Raise MalformedWebhookException if the webhook lacks the headers
+    we need, and InvalidWebhookException if it comes from an unknown
+    shop or its signature does not match.
+    """
+    shop, hmac = verify_headers(data.headers)
+    if not shop.verifier.verify(data.body, hmac, signature):
+        raise InvalidWebhookException(
+            'Failed to verify HMAC signature')
+
+
 def record_order(data):
     return Order.objects.get_or_create(
-        id=data.content['id'],
-        defaults={
-            'webhook': data,
-            'email': data.content['customer']['email'],
-            'first_name': data.content['customer']['first_name'],
-            'last_name': data.content['customer']['last_name']
-        }
+        shop=order_shop(data),
+        order_id=data.content['id'],
+        defaults=order_defaults(data)
     )
 
 
+async def arecord_order(data):
+    return await Order.objects.aget_or_create(
+        shop=order_shop(data),
+        order_id=data.content['id'],
+        defaults=order_defaults(data)
+    )
+
+
+def order_shop(data):
+    """Return the identifier of the shop that a webhook comes from."""
+    return data.headers.get(SHOP_HEADER, '')
+
+
+def order_defaults(data):
+    return {
+        'webhook': data,
+        'email': data.content['customer']['email'],
+        'first_name': data.content['customer']['first_name'],
+        'last_name': data.content['customer']['last_name']
+    }
+
+
 def process_order(order, data, send_email=False):
     if order.status == Order.PROCESSED:
         logger.warning('Order %s has already '
-                       'been processed, ignoring' % order.id)
+                       'been processed, ignoring' % order)
         return
     elif order.status == Order.ERROR:
         logger.warning('Order %s has previously '
-                       'failed to process, ignoring' % order.id)
+                       'failed to process, ignoring' % order)
         return
 
     if order.status == Order.PROCESSING:
         logger.warning('Order %s is already '
-                       'being processed, retrying' % order.id)
+                       'being processed, retrying' % order)
     else:
         # Start processing the order. A concurrent attempt to access the
         # same order will result in django_fsm.ConcurrentTransition on
@@ -47,28 +165,55 @@ def process_order(order, data, send_email=False):
             order.save()
 
     # Process line items
-    for item in data['line_items']:
-        # Process the line item. If the enrollment throws
-        # an exception, we throw that exception up the stack so we can
-        # attempt to retry order processing.
-        process_line_item(order, item)
-        logger.debug('Successfully processed line item '
-                     '%s for order %s' % (item, order.id))
+    if settings.WEBHOOK_RECEIVER_BATCH_ENROLLMENT:
+        # Record all line items first, and then enroll their learners
+        # with as few requests as possible. Again, we throw any
+        # exception up the stack.
+        order_items = [order_item for order_item in
+                       (prepare_line_item(order, item)
+                        for item in data['line_items'])
+                       if order_item is not None]
+        enroll_order_items(order_items, send_email)
+        logger.debug('Successfully processed %d line items '
+                     'for order %s' % (len(order_items), order))
+    elif settings.WEBHOOK_RECEIVER_LINE_ITEM_CONCURRENCY > 1:
+        # Record all line items first, and then resolve their SKUs
+        # and enroll their learners concurrently. Again, we throw
+        # any exception up the stack.
+        order_items = [order_item for order_item in
+                       (prepare_line_item(order, item)
+                        for item in data['line_items'])
+                       if order_item is not None]
+        process_order_items(order_items, send_email)
+        logger.debug('Successfully processed %d line items '
+                     'for order %s' % (len(order_items), order))
+    else:
+        for item in data['line_items']:
+            # Process the line item. If the enrollment throws
+            # an exception, we throw that exception up the stack so we
+            # can attempt to retry order processing.
+            process_line_item(order, item, send_email)
+            logger.debug('Successfully processed line item '
+                         '%s for order %s' % (item, order))
 
     # Mark the order status
     order.finish_processing()
     with transaction.atomic():
         order.save()
 
+    processed = processed_orders('shopify')
+    if processed is not None:
+        processed.add((order.shop, order.order_id))
+
     return order
 
 
-def process_line_item(order, item):
-    """Process a line item of an order.
+def prepare_line_item(order, item):
+    """Record a line item of an order, and start processing it.
 
-    Extract sku and properties.email, create an OrderItem, create an
-    enrollment, and mark the OrderItem as processed. Propagate any
-    errors, to be handled up the stack.
+    Extract sku and properties.email, and create an OrderItem. Return
+    the OrderItem, or None if it has already been processed.
+    Propagate any errors, to be handled up the stack.
     """
 
     # Fetch relevant fields from the item
@@ -88,7 +233,7 @@ def process_line_item(order, item):
     if order_item.status == OrderItem.PROCESSED:
         logger.warning('Order item %s has already '
                        'been processed, ignoring' % order_item.id)
-        return
+        return None
     elif order_item.status == OrderItem.PROCESSING:
         logger.warning('Order item %s is already '
                        'being processed, retrying' % order_item.id)
@@ -97,11 +242,25 @@ def process_line_item(order, item):
         with transaction.atomic():
             order_item.save()
 
+    return order_item
+
+
+def process_line_item(order, item, send_email=False):
+    """Process a line item of an order.
+
+    Extract sku and properties.email, create an OrderItem, create an
+    enrollment, and mark the OrderItem as processed. Propagate any
+    errors, to be handled up the stack.
+    """
+    order_item = prepare_line_item(order, item)
+    if order_item is None:
+        return None
+
     # Create an enrollment for the line item. If the enrollment throws
     # an exception, we throw that exception up the stack so we can
     # attempt to retry order processing.
-    course_id = lookup_course_id(sku)
-    enroll_in_course(course_id, email)
+    course_id = lookup_course_id(order_item.sku)
+    enroll_in_course(course_id, order_item.email, send_email)
 
     # Mark the item as processed
     order_item.finish_processing()
@@ -7,12 +7,24 @@ from django.http import HttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 
-from webhook_receiver.utils import receive_json_webhook, hmac_is_valid
-from webhook_receiver.utils import fail_and_save, finish_and_save
-
-from .utils import record_order
-from .models import Order
-from .tasks import process
+from webhook_receiver.decorators import async_csrf_exempt, async_require_POST
+from webhook_receiver.admission import deferred_response
+from webhook_receiver.admission import processing_deferred
+from webhook_receiver.decorators import admission_control
+from webhook_receiver.decorators import deduplicate_deliveries
+from webhook_receiver.decorators import rate_limit, restrict_networks
+from webhook_receiver.rejections import reject_webhook
+from webhook_receiver.shops import arefresh_shops
+from webhook_receiver.tasks import adelay
+from webhook_receiver.utils import receive_json_webhook, store_json_webhook
+from webhook_receiver.utils import fail_and_save, finish_or_spool
+from webhook_receiver.utils import areceive_json_webhook, astore_json_webhook
+from webhook_receiver.utils import afail_and_save, afinish_or_spool
+from webhook_receiver.utils import WebhookException
+
+from .utils import read_webhook, verify_webhook
+from .utils import DELIVERY_ID_HEADER, SHOP_HEADER, WEBHOOK_HEADERS
+from .tasks import dispatch, ingest, schedule_order, aschedule_order
 
 
 logger = logging.getLogger(__name__)
@@ -20,62 +32,120 @@ logger = logging.getLogger(__name__)
 
 @csrf_exempt
 @require_POST
+@restrict_networks('shopify', WEBHOOK_HEADERS)
+@rate_limit('shopify', SHOP_HEADER)
+@deduplicate_deliveries('shopify', DELIVERY_ID_HEADER, SHOP_HEADER)
+@admission_control
 def order_create(request):
-    # Load configuration
-    conf = settings.WEBHOOK_RECEIVER_SETTINGS['shopify']
-
+    # In streaming mode, and with early rejection enabled, verify
+    # the headers (and with early rejection, the signature) before we
+    # store anything.
+    body = signature = None
+    if any((settings.WEBHOOK_RECEIVER_STREAMING_INTAKE,
+            settings.WEBHOOK_RECEIVER_EARLY_REJECT)):
+        try:
+            body, signature = read_webhook(request)
+        except WebhookException as e:
+            reject_webhook('shopify', request, e, WEBHOOK_HEADERS)
+            return HttpResponse(status=e.status)
+
+    # In fast-ack mode, store the webhook as received, and leave
+    # verification and processing to a Celery task.
+    if settings.WEBHOOK_RECEIVER_FAST_ACK:
+        if processing_deferred(request):
+            # We are shedding load, so leave the webhook to a later
+            # delivery. We don't even store it, as nothing would
+            # ever ingest it.
+            return deferred_response()
+        data = store_json_webhook(request, WEBHOOK_HEADERS, body)
+        logger.info('Scheduling webhook %s for ingestion' % data.id)
+        ingest.delay(data.id)
+        return HttpResponse(status=200)
+
+    # Otherwise, let's start processing it right away.
     try:
-        data = receive_json_webhook(request)
+        data = receive_json_webhook(request, body, WEBHOOK_HEADERS)
     except Exception:
         return HttpResponse(status=400)
 
     try:
-        shop_domain = data.headers['X-Shopify-Shop-Domain']
-    except KeyError:
-        logger.error('Request is missing X-Shopify-Shop-Domain header')
+        verify_webhook(data, signature)
+    except WebhookException as e:
+        logger.error(e)
         fail_and_save(data)
-        return HttpResponse(status=400)
+        return HttpResponse(status=e.status)
 
-    if (conf['shop_domain'] != shop_domain):
-        logger.error('Unknown shop domain %s' % shop_domain)
-        fail_and_save(data)
-        return HttpResponse(status=403)
+    if not finish_or_spool(data, dispatch.name):
+        # We record and process the order once the spool is drained.
+        return HttpResponse(status=200)
 
-    try:
-        hmac = data.headers['X-Shopify-Hmac-Sha256']
-    except KeyError:
-        logger.error('Request is missing X-Shopify-Hmac-Sha256 header')
-        fail_and_save(data)
-        return HttpResponse(status=400)
+    # While we are shedding load, leave the order to a later delivery
+    # of the webhook.
+    if processing_deferred(request):
+        return deferred_response()
+
+    # Record and process order
+    schedule_order(data)
+
+    return HttpResponse(status=200)
 
-    if (not hmac_is_valid(conf['api_key'],
-                          data.body,
-                          hmac)):
-        logger.error('Failed to verify HMAC signature')
-        fail_and_save(data)
-        return HttpResponse(status=403)
 
-    finish_and_save(data)
+@async_csrf_exempt
+@async_require_POST
+@restrict_networks('shopify', WEBHOOK_HEADERS)
+@rate_limit('shopify', SHOP_HEADER)
+@deduplicate_deliveries('shopify', DELIVERY_ID_HEADER, SHOP_HEADER)
+@admission_control
+async def aorder_create(request):
+    """Async counterpart of order_create()."""
+    # We look up shops from async code below, so make sure we don't
+    # have to reload them from the database there.
+    await arefresh_shops('shopify')
+
+    # In streaming mode, and with early rejection enabled, verify
+    # the headers (and with early rejection, the signature) before we
+    # store anything.
+    body = signature = None
+    if any((settings.WEBHOOK_RECEIVER_STREAMING_INTAKE,
+            settings.WEBHOOK_RECEIVER_EARLY_REJECT)):
+        try:
+            body, signature = read_webhook(request)
+        except WebhookException as e:
+            reject_webhook('shopify', request, e, WEBHOOK_HEADERS)
+            return HttpResponse(status=e.status)
+
+    if settings.WEBHOOK_RECEIVER_FAST_ACK:
+        if processing_deferred(request):
+            # We are shedding load, so leave the webhook to a later
+            # delivery. We don't even store it, as nothing would
+            # ever ingest it.
+            return deferred_response()
+        data = await astore_json_webhook(request, WEBHOOK_HEADERS, body)
+        logger.info('Scheduling webhook %s for ingestion' % data.id)
+        await adelay(ingest, data.id)
+        return HttpResponse(status=200)
 
-    # Record order
-    order, created = record_order(data)
-    if created:
-        logger.info('Created order %s' % order.id)
-    else:
-        logger.info('Retrieved order %s' % order.id)
+    try:
+        data = await areceive_json_webhook(request, body, WEBHOOK_HEADERS)
+    except Exception:
+        return HttpResponse(status=400)
 
-    send_email = True
     try:
-        send_email = conf['send_email']
-    except KeyError:
-        pass
-
-    # Process order
-    if order.status == Order.NEW:
-        logger.info('Scheduling order %s for processing' % order.id)
-        process.delay(data.content, send_email)
-    else:
-        logger.info('Order %s already processed, '
-                    'nothing to do' % order.id)
+        verify_webhook(data, signature)
+    except WebhookException as e:
+        logger.error(e)
+        await afail_and_save(data)
+        return HttpResponse(status=e.status)
+
+    if not await afinish_or_spool(data, dispatch.name):
+        return HttpResponse(status=200)
+
+    # While we are shedding load, leave the order to a later delivery
+    # of the webhook.
+    if processing_deferred(request):
+        return deferred_response()
+
+    # Record and process order
+    await aschedule_order(data)
 
     return HttpResponse(status=200)
@@ -0,0 +1,66 @@
+from django.core.management.color import no_style
+from django.db import migrations, models
+
+
+# The request header that names the shop that sent a webhook.
+SHOP_HEADER = 'X-Wc-Webhook-Source'
+
+
+def populate_shop_order_ids(apps, schema_editor):
+    """Orders used to be keyed by their ID alone. Keep that as their
+    order ID, and take their shop from the webhook that they came
+    with, if we still have it."""
+    Order = apps.get_model('webhook_receiver_woocommerce', 'WooCommerceOrder')
+    Order.objects.update(order_id=models.F('id'))
+    for pk, headers in Order.objects.exclude(webhook=None).values_list(
+            'pk', 'webhook__headers'):
+        shop = (headers or {}).get(SHOP_HEADER)
+        if shop:
+            Order.objects.filter(pk=pk).update(shop=shop)
+
+
+def reset_order_sequence(apps, schema_editor):
+    """Existing orders keep their primary keys, so make sure that new
+    orders get higher ones."""
+    Order = apps.get_model('webhook_receiver_woocommerce', 'WooCommerceOrder')
+    for sql in schema_editor.connection.ops.sequence_reset_sql(no_style(),
+                                                               [Order]):
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webhook_receiver_woocommerce', '0004_fix_unique_constraint_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='woocommerceorder',
+            name='shop',
+            field=models.CharField(blank=True, default='', max_length=254),
+        ),
+        migrations.AddField(
+            model_name='woocommerceorder',
+            name='order_id',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.RunPython(populate_shop_order_ids,
+                             migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='woocommerceorder',
+            name='order_id',
+            field=models.BigIntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='woocommerceorder',
+            name='id',
+            field=models.BigAutoField(editable=False, primary_key=True, serialize=False),
+        ),
+        migrations.RunPython(reset_order_sequence,
+                             migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='woocommerceorder',
+            constraint=models.UniqueConstraint(fields=('shop', 'order_id'), name='unique_woocommerce_shop_order_id'),
+        ),
+    ]
@@ -11,6 +11,10 @@ class WooCommerceOrder(Order):
     class Meta:
         app_label = APP_LABEL
         abstract = False
+        constraints = [
+            UniqueConstraint(fields=['shop', 'order_id'],
+                             name='unique_woocommerce_shop_order_id')
+        ]
 
     webhook = ForeignKey(
         JSONWebhookData,
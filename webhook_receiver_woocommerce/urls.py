@@ -1,7 +1,13 @@
-from .views import order_create_or_update
-
+from django.conf import settings
 from django.urls import path
 
+from . import views
+
+if settings.WEBHOOK_RECEIVER_ASYNC_VIEWS:
+    order_create_or_update = views.aorder_create_or_update
+else:
+    order_create_or_update = views.order_create_or_update
+
 urlpatterns = [
     path('order/create',
          order_create_or_update,
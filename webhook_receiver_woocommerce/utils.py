@@ -2,42 +2,192 @@ from __future__ import unicode_literals
 
 import logging
 
+from dateutil.parser import parse as parse_date
+
+from django.conf import settings
 from django.db import transaction
 
+from webhook_receiver.shops import get_shop, shop_conf
 from webhook_receiver.utils import enroll_in_course, lookup_course_id
+from webhook_receiver.utils import enroll_order_items, process_order_items
+from webhook_receiver.utils import read_signed_body, processed_orders
+from webhook_receiver.utils import MalformedWebhookException
+from webhook_receiver.utils import InvalidWebhookException
+from webhook_receiver.utils import UnknownSourceException
 
 from .models import WooCommerceOrder as Order
 from .models import WooCommerceOrderItem as OrderItem
 
 
+# The request headers that we need for verifying and auditing a
+# webhook.
+WEBHOOK_HEADERS = (
+    'Content-Type',
+    'User-Agent',
+    'X-Wc-Webhook-Delivery-Id',
+    'X-Wc-Webhook-Event',
+    'X-Wc-Webhook-Id',
+    'X-Wc-Webhook-Resource',
+    'X-Wc-Webhook-Signature',
+    'X-Wc-Webhook-Source',
+    'X-Wc-Webhook-Topic',
+)
+
+# The request header that identifies a webhook delivery. It is the
+# same for all attempts to deliver a webhook.
+DELIVERY_ID_HEADER = 'X-Wc-Webhook-Delivery-Id'
+
+# The request header that names the shop that sent a webhook.
+SHOP_HEADER = 'X-Wc-Webhook-Source'
+
 logger = logging.getLogger(__name__)
 
 
+def verify_headers(headers):
+    """Look up the shop that a webhook comes from by its source
+    header, and return the shop and the webhook's HMAC signature
+    header.
+
+    Raise MalformedWebhookException if the webhook lacks the headers
+    we need, and InvalidWebhookException if it comes from an unknown
+    source.
+    """
+    try:
+        source = headers['X-Wc-Webhook-Source']
+    except KeyError:
+        raise MalformedWebhookException(
+            'Request is missing X-WC-Webhook-Source header')
+
+    shop = get_shop('woocommerce', source)
+    if shop is None:
+        raise UnknownSourceException(
+            'Unknown source %s' % source)
+
+    try:
+        return shop, headers['X-Wc-Webhook-Signature']
+    except KeyError:
+        raise MalformedWebhookException(
+            'Request is missing X-WC-Webhook-Signature header')
+
+
+def get_shop_conf(data):
+    """Return the settings of the shop that a webhook comes from."""
+    return shop_conf('woocommerce', data.headers.get('X-Wc-Webhook-Source'))
+
+
+def read_webhook(request):
+    """Verify the headers of a webhook request, and then read its
+    body.
+
+    In streaming mode, compute the body's signature while reading it.
+    With early rejection enabled, also verify the signature, so that
+    we reject a forged webhook before we store anything. Return the
+    body and its signature, for passing on to receive_json_webhook()
+    and verify_webhook(), respectively.
+    """
+    shop, hmac = verify_headers(request.headers)
+    if settings.WEBHOOK_RECEIVER_STREAMING_INTAKE:
+        body, signature = read_signed_body(request, shop.verifier, hmac)
+    else:
+        body = request.body
+        signature = shop.verifier.sign(body)
+
+    if settings.WEBHOOK_RECEIVER_EARLY_REJECT:
+        if not shop.verifier.verify(body, hmac, signature):
+            raise InvalidWebhookException(
+                'Failed to verify HMAC signature')
+
+    return body, signature
+
+
+def verify_webhook(data, signature=None):
+    """Verify the source and HMAC signature of a webhook.
+
+    If we have already computed the signature of the webhook body
+    while reading it (see read_webhook()), pass it in as signature.
+
+    Raise MalformedWebhookException if the webhook lacks the headers
+    we need, and InvalidWebhookException if it comes from an unknown
+    source or its signature does not match.
+    """
+    shop, hmac = verify_headers(data.headers)
+    if not shop.verifier.verify(data.body, hmac, signature):
+        raise InvalidWebhookException(
+            'Failed to verify HMAC signature')
+
+
+def order_is_payable(data):
+    """Check whether we can process the order in a webhook.
+
+    If we require that an order be paid before we can process it,
+    and it isn't, return False, so that we can wait for the order to
+    be subsequently updated.
+    """
+    conf = get_shop_conf(data)
+
+    require_payment = conf.get('require_payment', False)
+    if require_payment:
+        date_paid_gmt = data.content.get('date_paid_gmt')
+        if date_paid_gmt:
+            try:
+                parse_date(date_paid_gmt)
+            except ValueError:
+                logger.error('Webhook payload %s contains '
+                             'invalid value for '
+                             'date_paid_gmt: %s' % (data.id,
+                                                    date_paid_gmt))
+        else:
+            logger.warn('Webhook payload %s contains '
+                        'empty value for '
+                        'date_paid_gmt' % data.id)
+            return False
+
+    return True
+
+
 def record_order(data):
     return Order.objects.get_or_create(
-        id=data.content['id'],
-        defaults={
-            'webhook': data,
-            'email': data.content['billing']['email'],
-            'first_name': data.content['billing']['first_name'],
-            'last_name': data.content['billing']['last_name']
-        }
+        shop=order_shop(data),
+        order_id=data.content['id'],
+        defaults=order_defaults(data)
     )
 
 
+async def arecord_order(data):
+    return await Order.objects.aget_or_create(
+        shop=order_shop(data),
+        order_id=data.content['id'],
+        defaults=order_defaults(data)
+    )
+
+
+def order_shop(data):
+    """Return the identifier of the shop that a webhook comes from."""
+    return data.headers.get(SHOP_HEADER, '')
+
+
+def order_defaults(data):
+    return {
+        'webhook': data,
+        'email': data.content['billing']['email'],
+        'first_name': data.content['billing']['first_name'],
+        'last_name': data.content['billing']['last_name']
+    }
+
+
 def process_order(order, data, send_email=False):
     if order.status == Order.PROCESSED:
         logger.warning('Order %s has already '
-                       'been processed, ignoring' % order.id)
+                       'been processed, ignoring' % order)
         return
     elif order.status == Order.ERROR:
         logger.warning('Order %s has previously '
-                       'failed to process, ignoring' % order.id)
+                       'failed to process, ignoring' % order)
         return
 
     if order.status == Order.PROCESSING:
         logger.warning('Order %s is already '
-                       'being processed, retrying' % order.id)
+                       'being processed, retrying' % order)
     else:
         # Start processing the order. A concurrent attempt to access the
         # same order will result in django_fsm.ConcurrentTransition on
@@ -47,28 +197,56 @@ def process_order(order, data, send_email=False):
             order.save()
 
     # Process line items
-    for item in data['line_items']:
-        # Process the line item. If the enrollment throws
-        # an exception, we throw that exception up the stack so we can
-        # attempt to retry order processing.
-        process_line_item(order, item)
-        logger.debug('Successfully processed line item '
-                     '%s for order %s' % (item, order.id))
+    if settings.WEBHOOK_RECEIVER_BATCH_ENROLLMENT:
+        # Record all line items first, and then enroll their learners
+        # with as few requests as possible. Again, we throw any
+        # exception up the stack.
+        order_items = [order_item for order_item in
+                       (prepare_line_item(order, item)
+                        for item in data['line_items'])
+                       if order_item is not None]
+        enroll_order_items(order_items, send_email)
+        logger.debug('Successfully processed %d line items '
+                     'for order %s' % (len(order_items), order))
+    elif settings.WEBHOOK_RECEIVER_LINE_ITEM_CONCURRENCY > 1:
+        # Record all line items first, and then resolve their SKUs
+        # and enroll their learners concurrently. Again, we throw
+        # any exception up the stack.
+        order_items = [order_item for order_item in
+                       (prepare_line_item(order, item)
+                        for item in data['line_items'])
+                       if order_item is not None]
+        process_order_items(order_items, send_email)
+        logger.debug('Successfully processed %d line items '
+                     'for order %s' % (len(order_items), order))
+    else:
+        for item in data['line_items']:
+            # Process the line item. If the enrollment throws
+            # an exception, we throw that exception up the stack so we
+            # can attempt to retry order processing.
+            process_line_item(order, item, send_email)
+            logger.debug('Successfully processed line item '
+                         '%s for order %s' % (item, order))
 
     # Mark the order status
     order.finish_processing()
     with transaction.atomic():
         order.save()
 
+    processed = processed_orders('woocommerce')
+    if processed is not None:
+        processed.add((order.shop, order.order_id))
+
     return order
 
 
-def process_line_item(order, item):
-    """Process a line item of an order.
+def prepare_line_item(order, item):
+    """Record a line item of an order, and start processing it.
 
-    Extract sku and properties.email, create an OrderItem, create an
-    enrollment, and mark the OrderItem as processed. Propagate any
-    errors, to be handled up the stack.
+    Extract the SKU and the participant email address from the line
+    item meta data, and create an OrderItem. Return
+    the OrderItem, or None if it has already been processed.
+    Propagate any errors, to be handled up the stack.
     """
 
     # Fetch SKU from the item
@@ -92,15 +270,15 @@ def process_line_item(order, item):
                 # OK, we've found a learner email address, let's use
                 # that.
                 email = meta_item['_value']
-                logger.debug('Email address for order %i, SKU %s: "%s"',
-                             order.id,
+                logger.debug('Email address for order %s, SKU %s: "%s"',
+                             order,
                              sku,
                              email)
                 break
         except (IndexError, KeyError, TypeError):
-            logger.debug('Unknown metadata in order %i, SKU %s: "%s". '
+            logger.debug('Unknown metadata in order %s, SKU %s: "%s". '
                          'Ignoring.',
-                         order.id,
+                         order,
                          sku,
                          meta)
 
@@ -114,7 +292,7 @@ def process_line_item(order, item):
     if order_item.status == OrderItem.PROCESSED:
         logger.warning('Order item %s has already '
                        'been processed, ignoring' % order_item.id)
-        return
+        return None
     elif order_item.status == OrderItem.PROCESSING:
         logger.warning('Order item %s is already '
                        'being processed, retrying' % order_item.id)
@@ -123,9 +301,23 @@ def process_line_item(order, item):
         with transaction.atomic():
             order_item.save()
 
+    return order_item
+
+
+def process_line_item(order, item, send_email=False):
+    """Process a line item of an order.
+
+    Extract sku and properties.email, create an OrderItem, create an
+    enrollment, and mark the OrderItem as processed. Propagate any
+    errors, to be handled up the stack.
+    """
+    order_item = prepare_line_item(order, item)
+    if order_item is None:
+        return None
+
     # Create an enrollment for the line item
-    course_id = lookup_course_id(sku)
-    enroll_in_course(course_id, email)
+    course_id = lookup_course_id(order_item.sku)
+    enroll_in_course(course_id, order_item.email, send_email)
 
     # Mark the item as processed
     order_item.finish_processing()
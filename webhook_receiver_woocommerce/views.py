@@ -2,8 +2,6 @@ from __future__ import unicode_literals
 
 import logging
 
-from dateutil.parser import parse as parse_date
-
 from django.conf import settings
 from django.http import HttpResponse
 from django.views.decorators.csrf import csrf_exempt
@@ -11,11 +9,24 @@ from django.views.decorators.http import require_POST
 
 from ipware import get_client_ip
 
-from webhook_receiver.utils import receive_json_webhook, hmac_is_valid
-from webhook_receiver.utils import fail_and_save, finish_and_save
-from .utils import record_order
-from .models import WooCommerceOrder as Order
-from .tasks import process
+from webhook_receiver.decorators import async_csrf_exempt, async_require_POST
+from webhook_receiver.admission import deferred_response
+from webhook_receiver.admission import processing_deferred
+from webhook_receiver.decorators import admission_control
+from webhook_receiver.decorators import deduplicate_deliveries
+from webhook_receiver.decorators import rate_limit, restrict_networks
+from webhook_receiver.rejections import reject_webhook
+from webhook_receiver.shops import arefresh_shops
+from webhook_receiver.tasks import adelay
+from webhook_receiver.utils import receive_json_webhook, store_json_webhook
+from webhook_receiver.utils import fail_and_save, finish_or_spool
+from webhook_receiver.utils import areceive_json_webhook, astore_json_webhook
+from webhook_receiver.utils import afail_and_save, afinish_or_spool
+from webhook_receiver.utils import WebhookException
+
+from .utils import order_is_payable, read_webhook, verify_webhook
+from .utils import DELIVERY_ID_HEADER, SHOP_HEADER, WEBHOOK_HEADERS
+from .tasks import dispatch, ingest, schedule_order, aschedule_order
 
 
 logger = logging.getLogger(__name__)
@@ -23,113 +34,170 @@ logger = logging.getLogger(__name__)
 
 @csrf_exempt
 @require_POST
+@restrict_networks('woocommerce', WEBHOOK_HEADERS)
+@rate_limit('woocommerce', SHOP_HEADER)
+@deduplicate_deliveries('woocommerce', DELIVERY_ID_HEADER, SHOP_HEADER)
+@admission_control
 def order_create_or_update(request):
-    # Load configuration
-    conf = settings.WEBHOOK_RECEIVER_SETTINGS['woocommerce']
-
-    # When WooCommerce web hooks are first created or enabled,
-    # WooCommerce sends a POST request that is not JSON, but instead
-    # application/x-www-form-urlencoded with a single form value:
-    # "webhook_id=<num>". If we receive that, we return OK
-    # immediately. Any other non-JSON content is unexpected, and we
-    # send a Bad Request response.
-    content_type = request.content_type
-    if content_type != 'application/json':
-        remote_host, is_routable = get_client_ip(request)
-        user_agent = request.headers.get('user-agent')
-        if content_type == 'application/x-www-form-urlencoded':
-            try:
-                webhook_id = request.POST['webhook_id']
-                logger.info('Webhook with webhook_id %s created or '
-                            'enabled from %s (%s)' % (webhook_id,
-                                                      remote_host,
-                                                      user_agent))
-                return HttpResponse(status=200)
-            except KeyError:
-                logger.warn('Received application/x-www-form-urlencoded '
-                            'request without a webhook_id parameter '
-                            'from %s (%s)' % (remote_host, user_agent))
-                return HttpResponse(status=400)
-        else:
-            logger.warn('Received request with unexpected '
-                        'content type %s '
-                        'from %s (%s)' % (content_type,
-                                          remote_host,
-                                          user_agent))
-            return HttpResponse(status=400)
-
-    # Here, we're sure that what we got is JSON, so let's start
-    # processing it.
+    if request.content_type != 'application/json':
+        return handle_non_json_request(request)
+
+    # Here, we're sure that what we got is JSON. In streaming mode,
+    # and with early rejection enabled, verify the headers (and with
+    # early rejection, the signature) before we store anything.
+    body = signature = None
+    if any((settings.WEBHOOK_RECEIVER_STREAMING_INTAKE,
+            settings.WEBHOOK_RECEIVER_EARLY_REJECT)):
+        try:
+            body, signature = read_webhook(request)
+        except WebhookException as e:
+            reject_webhook('woocommerce', request, e, WEBHOOK_HEADERS)
+            return HttpResponse(status=e.status)
+
+    # In fast-ack mode, store the webhook as received, and leave
+    # verification and processing to a Celery task.
+    if settings.WEBHOOK_RECEIVER_FAST_ACK:
+        if processing_deferred(request):
+            # We are shedding load, so leave the webhook to a later
+            # delivery. We don't even store it, as nothing would
+            # ever ingest it.
+            return deferred_response()
+        data = store_json_webhook(request, WEBHOOK_HEADERS, body)
+        logger.info('Scheduling webhook %s for ingestion' % data.id)
+        ingest.delay(data.id)
+        return HttpResponse(status=200)
+
+    # Otherwise, let's start processing it right away.
     try:
-        data = receive_json_webhook(request)
+        data = receive_json_webhook(request, body, WEBHOOK_HEADERS)
     except Exception:
         return HttpResponse(status=400)
 
     try:
-        source = data.headers['X-Wc-Webhook-Source']
-    except KeyError:
-        logger.error('Request is missing X-WC-Webhook-Source header')
+        verify_webhook(data, signature)
+    except WebhookException as e:
+        logger.error(e)
         fail_and_save(data)
-        return HttpResponse(status=400)
+        return HttpResponse(status=e.status)
+
+    # OK, we have valid, signed, JSON data. Put that into the
+    # database (or if that is unavailable, the spool), so we have a
+    # record of the transaction.
+    if not finish_or_spool(data, dispatch.name):
+        # We record and process the order once the spool is drained.
+        return HttpResponse(status=200)
+
+    # If we require that an order be paid before we can process it,
+    # and it isn't, bail here and wait for the order to be
+    # subsequently updated.
+    if not order_is_payable(data):
+        return HttpResponse(status=402)
+
+    # While we are shedding load, leave the order to a later delivery
+    # of the webhook.
+    if processing_deferred(request):
+        return deferred_response()
+
+    # Record and process order
+    schedule_order(data)
+
+    return HttpResponse(status=200)
 
-    if (conf['source'] != source):
-        logger.error('Unknown source %s' % source)
-        fail_and_save(data)
-        return HttpResponse(status=403)
+
+@async_csrf_exempt
+@async_require_POST
+@restrict_networks('woocommerce', WEBHOOK_HEADERS)
+@rate_limit('woocommerce', SHOP_HEADER)
+@deduplicate_deliveries('woocommerce', DELIVERY_ID_HEADER, SHOP_HEADER)
+@admission_control
+async def aorder_create_or_update(request):
+    """Async counterpart of order_create_or_update()."""
+    if request.content_type != 'application/json':
+        return handle_non_json_request(request)
+
+    # We look up shops from async code below, so make sure we don't
+    # have to reload them from the database there.
+    await arefresh_shops('woocommerce')
+
+    # In streaming mode, and with early rejection enabled, verify
+    # the headers (and with early rejection, the signature) before we
+    # store anything.
+    body = signature = None
+    if any((settings.WEBHOOK_RECEIVER_STREAMING_INTAKE,
+            settings.WEBHOOK_RECEIVER_EARLY_REJECT)):
+        try:
+            body, signature = read_webhook(request)
+        except WebhookException as e:
+            reject_webhook('woocommerce', request, e, WEBHOOK_HEADERS)
+            return HttpResponse(status=e.status)
+
+    if settings.WEBHOOK_RECEIVER_FAST_ACK:
+        if processing_deferred(request):
+            # We are shedding load, so leave the webhook to a later
+            # delivery. We don't even store it, as nothing would
+            # ever ingest it.
+            return deferred_response()
+        data = await astore_json_webhook(request, WEBHOOK_HEADERS, body)
+        logger.info('Scheduling webhook %s for ingestion' % data.id)
+        await adelay(ingest, data.id)
+        return HttpResponse(status=200)
 
     try:
-        hmac = data.headers['X-Wc-Webhook-Signature']
-    except KeyError:
-        logger.error('Request is missing X-WC-Webhook-Signature header')
-        fail_and_save(data)
+        data = await areceive_json_webhook(request, body, WEBHOOK_HEADERS)
+    except Exception:
         return HttpResponse(status=400)
 
-    if (not hmac_is_valid(conf['secret'],
-                          data.body,
-                          hmac)):
-        logger.error('Failed to verify HMAC signature')
-        fail_and_save(data)
-        return HttpResponse(status=403)
+    try:
+        verify_webhook(data, signature)
+    except WebhookException as e:
+        logger.error(e)
+        await afail_and_save(data)
+        return HttpResponse(status=e.status)
 
-    # OK, we have valid, signed, JSON data. Put that into the
-    # database, so we have a record of the transaction.
-    finish_and_save(data)
+    if not await afinish_or_spool(data, dispatch.name):
+        return HttpResponse(status=200)
 
-    # If we require that an order be paid before we can process it,
-    # and it isn't, bail here and wait for the order to be
-    # subsequently updated.
-    require_payment = conf.get('require_payment', False)
-    if require_payment:
-        date_paid_gmt = data.content.get('date_paid_gmt')
-        if date_paid_gmt:
-            try:
-                parse_date(date_paid_gmt)
-            except ValueError:
-                logger.error('Webhook payload %s contains '
-                             'invalid value for '
-                             'date_paid_gmt: %s' % (data.id,
-                                                    date_paid_gmt))
-        else:
-            logger.warn('Webhook payload %s contains '
-                        'empty value for '
-                        'date_paid_gmt' % data.id)
-            return HttpResponse(status=402)
-
-    # Record order
-    order, created = record_order(data)
-    if created:
-        logger.info('Created order %s' % order.id)
-    else:
-        logger.info('Retrieved order %s' % order.id)
+    if not order_is_payable(data):
+        return HttpResponse(status=402)
 
-    send_email = conf.get('send_email', True)
+    # While we are shedding load, leave the order to a later delivery
+    # of the webhook.
+    if processing_deferred(request):
+        return deferred_response()
 
-    # Process order
-    if order.status == Order.NEW:
-        logger.info('Scheduling order %s for processing' % order.id)
-        process.delay(data.content, send_email)
-    else:
-        logger.info('Order %s already processed, '
-                    'nothing to do' % order.id)
+    # Record and process order
+    await aschedule_order(data)
 
     return HttpResponse(status=200)
+
+
+def handle_non_json_request(request):
+    # When WooCommerce web hooks are first created or enabled,
+    # WooCommerce sends a POST request that is not JSON, but instead
+    # application/x-www-form-urlencoded with a single form value:
+    # "webhook_id=<num>". If we receive that, we return OK
+    # immediately. Any other non-JSON content is unexpected, and we
+    # send a Bad Request response.
+    content_type = request.content_type
+    remote_host, is_routable = get_client_ip(request)
+    user_agent = request.headers.get('user-agent')
+    if content_type == 'application/x-www-form-urlencoded':
+        try:
+            webhook_id = request.POST['webhook_id']
+            logger.info('Webhook with webhook_id %s created or '
+                        'enabled from %s (%s)' % (webhook_id,
+                                                  remote_host,
+                                                  user_agent))
+            return HttpResponse(status=200)
+        except KeyError:
+            logger.warn('Received application/x-www-form-urlencoded '
+                        'request without a webhook_id parameter '
+                        'from %s (%s)' % (remote_host, user_agent))
+            return HttpResponse(status=400)
+    else:
+        logger.warn('Received request with unexpected '
+                    'content type %s '
+                    'from %s (%s)' % (content_type,
+                                      remote_host,
+                                      user_agent))
+        return HttpResponse(status=400)